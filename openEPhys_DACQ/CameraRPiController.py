@@ -7,14 +7,14 @@ from time import sleep, time
 import cv2
 import csv
 import zmq
-import json
 import pigpio
 import os
 from scipy.spatial.distance import euclidean
-from multiprocessing import Manager, Process, RawArray, Value
+from multiprocessing import Process, Value
 from threading import Thread
 from copy import copy
-from ZMQcomms import remote_controlled_class
+from ZMQcomms import remote_controlled_class, encode_position_message, encode_json_position_message
+from SharedMemoryBuffers import SharedArrayQueue
 import argparse
 from ctypes import c_uint8, c_uint16, c_bool
 import warnings
@@ -23,7 +23,6 @@ import socket
 import struct
 from PIL import Image
 from subprocess import PIPE, Popen
-from functools import reduce
 import psutil
 
 
@@ -167,6 +166,7 @@ class OnlineTracker(object):
             'tracking_mode' - str
             'LED_separation' - float
             'frame_shape' - tuple - (height, width, channels) of incoming frames
+            'position_message_format' - str - 'binary' (default) or 'json'
         '''
         params['LED_separation_pix'] = convert_centimeters_to_pixel_distance(params['LED_separation'], 
                                                                              params['calibrationTmatrix'], 
@@ -380,10 +380,13 @@ class OnlineTracker(object):
 
     def send_data_with_ZMQpublisher(self, linedata):
         '''
-        Publishes data with ZMQ.
+        Publishes data with ZMQ as binary position message with current time as timestamp,
+        or as JSON encoded list if params['position_message_format'] is 'json'.
         '''
-        message = json.dumps(linedata)  # Convert data to string format
-        message = message.encode()  # Convert data into bytes format
+        if self.params.get('position_message_format', 'binary') == 'json':
+            message = encode_json_position_message(linedata)
+        else:
+            message = encode_position_message(linedata)
         self.ZMQpublisher.send(message) # Send the message using ZeroMQ
 
     def write_to_logfile(self, linedata):
@@ -459,116 +462,6 @@ class TTLpulse_CameraTime_Writer(object):
         self.csv_writer.close()
 
 
-class SharedArrayQueue(object):
-    '''
-    Replicates Queue functionality for specified size and ctype of numpy arrays,
-    for fast transfer of data between processes using pre-allocated shared memory.
-    '''
-    def __init__(self, ctype, array_shape, max_queue_length):
-        '''
-        ctype - ctypes of the arrays e.g. c_uint8.
-        array_shape - tuple - dimensions of the array, e.g. (480, 720).
-        max_queue_length - int - number of pre-allocated shared arrays.
-            Note! Too high value for large arrays could cause Out Of Memory errors.
-        '''
-        self.ctype = ctype
-        self.array_shape = array_shape
-        self.manager = Manager()
-        self.data_indices = list(range(max_queue_length))
-        self.occupied_data_indices = self.manager.list()
-        self.shared_arrays, self.shared_array_wrappers = SharedArrayQueue.create_shared_arrays(ctype, array_shape, max_queue_length)
-
-    @staticmethod
-    def create_shared_array(ctype, array_shape):
-        '''
-        Returns a multiprocessing.RawArray and its Numpy wrapper.
-        '''
-        numel = int(reduce(lambda x, y: x*y, array_shape))
-        shared_array = RawArray(ctype, numel)
-        shared_array_wrapper = np.frombuffer(shared_array, dtype=ctype).reshape(array_shape)
-
-        return shared_array, shared_array_wrapper
-
-    @staticmethod
-    def create_shared_arrays(ctype, array_shape, max_queue_length):
-        '''
-        Arranges shared_array and shared_array_wrapper from create_shared_array 
-        into lists of length max_queue_length.
-        '''
-        shared_arrays = []
-        shared_array_wrappers = []
-        for _ in range(max_queue_length):
-            shared_array, shared_array_wrapper = SharedArrayQueue.create_shared_array(ctype, array_shape)
-            shared_arrays.append(shared_array)
-            shared_array_wrappers.append(shared_array_wrapper)
-
-        return shared_arrays, shared_array_wrappers
-
-    def put(self, data, block=False):
-        '''
-        Stores data into available location in shared memory if data is numpy.ndarray.
-        If data is not numpy.ndarray, using get on this item in the queue will return string 'IncorrectItem'.
-        If max_queue_length has been reached and block=False (default), an Exception is raised.
-        If max_queue_length has been reached and block=True, method waits until space in queue is available.
-        '''
-        if isinstance(data, np.ndarray):
-            # Find available data indices
-            unavailable_data_indices = list(self.occupied_data_indices)
-            available_data_indices = list(set(self.data_indices) - set(unavailable_data_indices))
-            # Find single available index to use or if none available, raise Exception
-            if len(available_data_indices) > 0:
-                array_position = available_data_indices.pop(0)
-                # Place array into shared array
-                np.copyto(self.shared_array_wrappers[array_position], data)
-                # Update available 
-                self.occupied_data_indices.append(array_position)
-            else:
-                if block:
-                    sleep(0.001)
-                    self.put(data, block)
-                else:
-                    raise Exception('SharedArrayQueue pre-allocated memory full!')
-        else:
-            self.occupied_data_indices.append(-1)
-
-    def get(self, timeout=None):
-        '''
-        Returns the next numpy.ndarray in the queue and waits until available.
-        If anything else has been put into queue, get() returns 'IncorrectItem'.
-        If timeout is specified and item is not available, get()
-        waits until timeout seconds and returns 'TimeoutReached'.
-        '''
-        if not (timeout is None):
-            timeout_start_time = time()
-        while True:
-            if len(self.occupied_data_indices) == 0:
-                sleep(0.001)
-            else:
-                array_position = self.occupied_data_indices.pop(0)
-                if array_position >= 0:
-                    data = np.frombuffer(self.shared_arrays[array_position], dtype=self.ctype)
-                    return data.reshape(self.array_shape)
-                else:
-                    return 'IncorrectItem'
-            # Return None if timeout has been reached
-            if not (timeout is None):
-                if time() - timeout_start_time > timeout:
-                    return 'TimeoutReached'
-
-    def qsize(self):
-        '''
-        Returns the number of items currently in the queue.
-        '''
-        return len(self.occupied_data_indices)
-
-    def join(self):
-        '''
-        Waits until all items have been acquired from the queue.
-        '''
-        while len(self.occupied_data_indices) > 0:
-            sleep(0.001)
-
-
 class RawYUV_Processor(object):
     '''
     Used by RawYUV_Output to process each incoming frame.
@@ -611,7 +504,7 @@ class RawYUV_Processor(object):
         self.queue.put(frame)
 
     def close(self):
-        self.queue.put('STOP')
+        self.queue.put('STOP', block=True)
         self.queue.join()
         self.P_OnlineTracker_Process.join()
         if hasattr(self, '_MonitorLogger'):
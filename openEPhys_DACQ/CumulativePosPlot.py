@@ -10,7 +10,6 @@ import numpy as np
 from PyQt5.QtCore import QTimer
 from time import sleep, time
 from scipy import ndimage
-from copy import copy, deepcopy
 
 
 def angle_clockwise(p1, p2, invertedY=True):
@@ -192,9 +191,8 @@ class PosPlot(QtWidgets.QWidget):
 
     def showPath(self):
         if self.showPathButton.isChecked():
-            posHistory = copy(self.processed_position_list[0:])
-            posHistory = [i for i in posHistory if i is not None]
-            posHistory = np.array(posHistory)[:, :2]
+            _, posHistory, valid = self.processed_position_list.last(len(self.processed_position_list))
+            posHistory = posHistory[valid, :2]
             posHistory = posHistory + self.histogramParameters['margins']
             posHistory = posHistory / float(self.histogramParameters['binSize'])
             self.trackedPath = pg.PlotDataItem()
@@ -208,7 +206,8 @@ class PosPlot(QtWidgets.QWidget):
         if self.keep_updating_plot and self.online_tracker_is_alive.get():
 
             # Get latest position data
-            pastPos, currPos = self.processed_position_list[-2:]
+            _, positions, valid = self.processed_position_list.last(2)
+            pastPos, currPos = [position if is_valid else None for position, is_valid in zip(positions, valid)]
             positionHistogram = np.reshape(self.position_histogram_array,
                                            self.histogram_array_shape)
 
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 import sys
-from scipy.signal import butter, lfilter, decimate
+from scipy.signal import butter, lfilter, sosfilt, firwin, upfirdn
 import os
 import numpy as np
 from PyQt5 import QtWidgets
@@ -11,6 +11,7 @@ import threading
 from time import sleep
 import psutil
 from datetime import datetime
+from functools import lru_cache
 import codecs
 
 
@@ -106,13 +107,16 @@ class multiprocess(object):
         """
         This method called by run method in a separate process to utilize multiprocessing
         """
-        # Evaluate the function with input arguments
-        output = f(*args, **kwargs)
-        # Update output list and active process counter
-        with output_list_Lock:
-            output_list[list_pos] = output
-        # Release CPU core lock to inform CPU_availability_tracker
-        cpu_lock.release()
+        try:
+            # Evaluate the function with input arguments
+            output = f(*args, **kwargs)
+            # Update output list and active process counter
+            with output_list_Lock:
+                output_list[list_pos] = output
+        finally:
+            # Release CPU core lock to inform CPU_availability_tracker,
+            # also if f raised an exception, so that the core can be used by other processes
+            cpu_lock.release()
 
     def run(self, f, args=(), kwargs=None, single_cpu_affinity=False):
         """
@@ -235,11 +239,159 @@ def proceed_when_enough_memory_available(memory_needed=None, percent=None, array
     return memory_available
 
 
+def get_pool_size(memory_per_process, n_jobs=None, max_memory_fraction=0.5):
+    """
+    Returns the number of worker processes to use, limited by the number of CPU cores,
+    the number of jobs and the number of processes that fit into available memory.
+
+    memory_per_process  - int - estimated peak memory use of a single process in bytes
+    n_jobs              - int - number of jobs to process. If None (default), not used as limit.
+    max_memory_fraction - float - fraction of currently available memory to use for all processes
+    """
+    n_processes = multiprocessing.cpu_count()
+    n_processes = min(n_processes, int(psutil.virtual_memory().available * max_memory_fraction
+                                       // max(1, memory_per_process)))
+    if not (n_jobs is None):
+        n_processes = min(n_processes, n_jobs)
+
+    return max(1, n_processes)
+
+
+def get_downsampling_factor(sampling_rate_in, sampling_rate_out, suppress_division_by_two_error=False):
+    """
+    Returns downsampling factor, see lowpass_and_downsample for requirements of the sampling rates.
+    """
+    # Ensure sampling rates can be divided without remainder
+    if sampling_rate_in % sampling_rate_out != 0:
+        raise Exception('sampling_rate_out must be a factor of sampling_rate_in.')
+
+    # Compute downsampling factor
+    downsampling_factor = int(sampling_rate_in / sampling_rate_out)
+
+    # Verify that downsampling factor can be divided by 2 without remainder
+    if not suppress_division_by_two_error:
+        if downsampling_factor % 2 != 0:
+            raise Exception('Quotient of sampling_rate_in and sampling_rate_out '
+                            + 'must have zero remainder when divided by 2.')
+
+    return downsampling_factor
+
+
+class PolyphaseDownsampler(object):
+    """
+    Streaming lowpass filter and downsampler of signals provided in consecutive chunks.
+
+    Uses the same FIR filter as `scipy.signal.decimate` with ftype='fir' and computes only the
+    retained output samples with `scipy.signal.upfirdn` (polyphase implementation).
+    With zero_phase=True, the output is identical to `scipy.signal.decimate` with zero_phase=True
+    on the full signal, within floating point error, by delaying each output sample until
+    the filter half-length of look-ahead samples is available. With zero_phase=False, output
+    is identical to `scipy.signal.decimate` with zero_phase=False and requires no look-ahead.
+
+    Only the last filter length of input samples is kept in memory between chunks.
+
+    Usage:
+        downsampler = PolyphaseDownsampler(downsampling_factor)
+        outputs = [downsampler.process(chunk) for chunk in chunks] + [downsampler.flush()]
+    """
+
+    def __init__(self, downsampling_factor, zero_phase=True, axis=0):
+        """
+        downsampling_factor - int - output has every downsampling_factor sample of filtered input
+        zero_phase - bool - if True (default), filter delay is compensated with look-ahead
+        axis - int - axis of time in chunks
+        """
+        self.downsampling_factor = int(downsampling_factor)
+        self.zero_phase = zero_phase
+        self.axis = axis
+        half_len = 10 * self.downsampling_factor
+        self.taps = firwin(2 * half_len + 1, 1. / self.downsampling_factor, window='hamming')
+        self.lookahead = half_len if zero_phase else 0
+        # Input is prepended with zeros, so that the first tap of each output sample
+        # falls on a multiple of downsampling_factor in the input to upfirdn
+        self._n_alignment_zeros = (-(self.taps.size - 1)) % self.downsampling_factor
+        self._buffer = None
+        self._buffer_start = 0
+        self._n_input = 0
+        self._n_output = 0
+
+    def _take(self, array, start, stop):
+        index = [slice(None)] * array.ndim
+        index[self.axis] = slice(start, stop)
+        return array[tuple(index)]
+
+    def _pad_front(self, array, n):
+        pad_width = [(0, 0)] * array.ndim
+        pad_width[self.axis] = (n, 0)
+        return np.pad(array, pad_width, mode='constant')
+
+    def _compute(self, buffer, buffer_start, last_output):
+        """
+        Returns output samples from self._n_output to last_output (inclusive), given buffer
+        of input samples starting at buffer_start, and drops input samples no longer needed.
+        """
+        first_output = self._n_output
+        n_outputs = last_output - first_output + 1
+        if n_outputs > 0:
+            first_input = first_output * self.downsampling_factor + self.lookahead - (self.taps.size - 1)
+            last_input = last_output * self.downsampling_factor + self.lookahead
+            segment = self._take(buffer, max(0, first_input - buffer_start), last_input - buffer_start + 1)
+            # Input before start of signal is zero, as in scipy.signal.resample_poly
+            n_zeros = self._n_alignment_zeros + max(0, buffer_start - first_input)
+            segment = self._pad_front(segment, n_zeros)
+            first_position = (self.taps.size - 1 + self._n_alignment_zeros) // self.downsampling_factor
+            signal_out = upfirdn(self.taps, segment, up=1, down=self.downsampling_factor, axis=self.axis)
+            signal_out = self._take(signal_out, first_position, first_position + n_outputs)
+            self._n_output = last_output + 1
+        else:
+            shape = list(buffer.shape)
+            shape[self.axis] = 0
+            signal_out = np.zeros(shape, dtype=np.float64)
+        # Keep input samples required for following output samples
+        next_first_input = self._n_output * self.downsampling_factor + self.lookahead - (self.taps.size - 1)
+        n_drop = min(max(0, next_first_input - buffer_start), buffer.shape[self.axis])
+        self._buffer = self._take(buffer, n_drop, None)
+        self._buffer_start = buffer_start + n_drop
+
+        return signal_out
+
+    def process(self, chunk):
+        """
+        Returns all output samples that can be computed with input up to the end of chunk.
+        Output is float64 numpy array.
+
+        chunk - numpy array with time along axis and same shape as previous chunks on other axes
+        """
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if self._buffer is None:
+            buffer = chunk
+        else:
+            buffer = np.concatenate((self._buffer, chunk), axis=self.axis)
+        self._n_input += chunk.shape[self.axis]
+        last_output = (self._n_input - 1 - self.lookahead) // self.downsampling_factor
+
+        return self._compute(buffer, self._buffer_start, last_output)
+
+    def flush(self):
+        """
+        Returns remaining output samples, assuming zeros after the last chunk,
+        so that total output length is ceil(n_input / downsampling_factor).
+        """
+        if self._buffer is None:
+            return np.zeros(0, dtype=np.float64)
+        pad_width = [(0, 0)] * self._buffer.ndim
+        pad_width[self.axis] = (0, self.lookahead + self.downsampling_factor)
+        buffer = np.pad(self._buffer, pad_width, mode='constant')
+        last_output = (self._n_input + self.downsampling_factor - 1) // self.downsampling_factor - 1
+
+        return self._compute(buffer, self._buffer_start, last_output)
+
+
 def lowpass_and_downsample(signal_in, sampling_rate_in, sampling_rate_out, 
                            suppress_division_by_two_error=False):
     """
     Implements `scipy.signal.decimate` method with FIR forward pass filter and
-    phase shift correction.
+    phase shift correction, using PolyphaseDownsampler.
 
     signal_in         - numpy array with shape (N,).
                         Input shapes (N, 1) and (1, N) are also accepted but these
@@ -272,21 +424,12 @@ def lowpass_and_downsample(signal_in, sampling_rate_in, sampling_rate_out,
         else:
             raise Exception('signal_in must have shape (N,), (N, 1) or (1, N)')
 
-    # Ensure sampling rates can be divided without remainder
-    if sampling_rate_in % sampling_rate_out != 0:
-        raise Exception('sampling_rate_out must be a factor of sampling_rate_in.')
-
-    # Compute downsampling factor
-    downsampling_factor = int(sampling_rate_in / sampling_rate_out)
-
-    # Verify that downsampling factor can be divided by 2 without remainder
-    if not suppress_division_by_two_error:
-        if downsampling_factor % 2 != 0:
-            raise Exception('Quotient of sampling_rate_in and sampling_rate_out '
-                            + 'must have zero remainder when divided by 2.')
+    downsampling_factor = get_downsampling_factor(sampling_rate_in, sampling_rate_out,
+                                                  suppress_division_by_two_error=suppress_division_by_two_error)
 
     # Filter and downsample the signal
-    signal_out = decimate(signal_in, downsampling_factor, ftype='fir', zero_phase=True)
+    downsampler = PolyphaseDownsampler(downsampling_factor)
+    signal_out = np.concatenate((downsampler.process(signal_in), downsampler.flush()))
 
     # Ensure output is in same dtype as input signal
     if not (signal_in.dtype is signal_out.dtype):
@@ -295,6 +438,29 @@ def lowpass_and_downsample(signal_in, sampling_rate_in, sampling_rate_out,
     return signal_out
 
 
+def lowpass_and_downsample_chunks(chunks, sampling_rate_in, sampling_rate_out, dtype=None,
+                                  suppress_division_by_two_error=False):
+    """
+    Streaming version of lowpass_and_downsample for consecutive chunks of a signal,
+    with time along first axis. Yields downsampled output for each chunk as it becomes
+    available, with the remaining output samples yielded after the last chunk.
+    Concatenated output is identical to lowpass_and_downsample on the full signal.
+
+    chunks - iterable of numpy arrays with shape (N,) or (N, n_channels)
+    dtype  - numpy dtype of the output. If None (default), dtype of first chunk is used.
+
+    See lowpass_and_downsample for description of other arguments.
+    """
+    downsampling_factor = get_downsampling_factor(sampling_rate_in, sampling_rate_out,
+                                                  suppress_division_by_two_error=suppress_division_by_two_error)
+    downsampler = PolyphaseDownsampler(downsampling_factor)
+    for chunk in chunks:
+        if dtype is None:
+            dtype = chunk.dtype
+        yield downsampler.process(chunk).astype(dtype)
+    yield downsampler.flush().astype(np.float64 if dtype is None else dtype)
+
+
 def butter_bandpass(lowcut, highcut, fs, order=5):
     nyq = 0.5 * fs
     low = lowcut / nyq
@@ -308,6 +474,91 @@ def butter_bandpass_filter(signal_in, sampling_rate=30000.0, highpass_frequency=
     return signal_out
 
 
+@lru_cache(maxsize=None)
+def butter_bandpass_sos(lowcut, highcut, fs, order=5):
+    """
+    Returns second-order sections of the butter_bandpass filter.
+    Output is cached, so the same array is returned for repeated calls with same arguments.
+    It must not be modified.
+    """
+    nyq = 0.5 * fs
+    return butter(order, [lowcut / nyq, highcut / nyq], btype='band', output='sos')
+
+
+@lru_cache(maxsize=None)
+def butter_lowpass_sos(cutoff, fs, order=5):
+    """
+    Returns second-order sections of the butter_lowpass filter.
+    Output is cached, so the same array is returned for repeated calls with same arguments.
+    It must not be modified.
+    """
+    nyq = 0.5 * fs
+    return butter(order, cutoff / nyq, btype='low', analog=False, output='sos')
+
+
+def sosfilt_multichannel(sos, signal_in, axis=0, float32=False, in_place=False, block_size=300000):
+    """
+    Filters all channels of a multichannel signal with second-order sections in a single call.
+
+    sos        - numpy array - second-order sections, e.g. from butter_bandpass_sos
+    signal_in  - numpy array - signal with samples along axis, e.g. shape (samples, channels) with axis=0
+    axis       - int - axis along which samples are arranged (default is 0)
+    float32    - bool - if True, filtering is computed in numpy.float32, otherwise in numpy.float64 (default)
+    in_place   - bool - if True, the output is written into signal_in, which must then have
+                 dtype matching the float32 argument. The signal is filtered in blocks of
+                 block_size samples, carrying the filter state, to avoid a full size temporary array.
+    """
+    dtype = np.float32 if float32 else np.float64
+    sos = sos.astype(dtype)
+    if not in_place:
+        return sosfilt(sos, signal_in.astype(dtype, copy=False), axis=axis)
+    if signal_in.dtype != dtype:
+        raise ValueError('In place filtering requires signal_in dtype {}, but it is {}'.format(
+            np.dtype(dtype), signal_in.dtype))
+    axis = axis % signal_in.ndim
+    zi_shape = [sos.shape[0]] + list(signal_in.shape)
+    zi_shape[axis + 1] = 2
+    zi = np.zeros(zi_shape, dtype=dtype)
+    index = [slice(None)] * signal_in.ndim
+    for block_start in range(0, signal_in.shape[axis], block_size):
+        index[axis] = slice(block_start, block_start + block_size)
+        signal_in[tuple(index)], zi = sosfilt(sos, signal_in[tuple(index)], axis=axis, zi=zi)
+
+    return signal_in
+
+
+def butter_bandpass_filter_multichannel(signal_in, sampling_rate=30000.0, highpass_frequency=300.0,
+                                        lowpass_frequency=6000.0, filt_order=4, axis=0,
+                                        float32=False, in_place=False):
+    """
+    Batch variant of butter_bandpass_filter for multichannel signals, e.g. shape (samples, channels).
+    Uses second-order sections. See sosfilt_multichannel for description of other arguments.
+    """
+    sos = butter_bandpass_sos(highpass_frequency, lowpass_frequency, sampling_rate, order=filt_order)
+    return sosfilt_multichannel(sos, signal_in, axis=axis, float32=float32, in_place=in_place)
+
+
+def butter_bandpass_filter_chunk(signal_in, zi=None, sampling_rate=30000.0, highpass_frequency=300.0,
+                                 lowpass_frequency=6000.0, filt_order=4, axis=-1):
+    """
+    Applies the same filter as butter_bandpass_filter_multichannel to one of consecutive chunks of a signal.
+
+    signal_in - numpy array - chunk of signal, filtered along axis.
+    zi        - numpy array - filter state returned for the previous chunk.
+                If None (default), filtering starts from zero state, as with butter_bandpass_filter_multichannel.
+
+    Returns signal_out and zf, the filter state to pass on as zi with the next chunk.
+    Filtering consecutive chunks this way gives the same output as filtering the whole signal at once.
+    """
+    sos = butter_bandpass_sos(highpass_frequency, lowpass_frequency, sampling_rate, order=filt_order)
+    if zi is None:
+        zi_shape = [sos.shape[0]] + list(signal_in.shape)
+        zi_shape[(axis % signal_in.ndim) + 1] = 2
+        zi = np.zeros(zi_shape, dtype=np.float64)
+    signal_out, zf = sosfilt(sos, signal_in, axis=axis, zi=zi)
+    return signal_out, zf
+
+
 def butter_lowpass(cutoff, fs, order=5):
     nyq = 0.5 * fs
     normal_cutoff = cutoff / nyq
@@ -323,6 +574,16 @@ def butter_lowpass_filter(signal_in, lowpass_frequency=125.0, sampling_rate=3000
     return signal_out
 
 
+def butter_lowpass_filter_multichannel(signal_in, lowpass_frequency=125.0, sampling_rate=30000.0, filt_order=4,
+                                       axis=0, float32=False, in_place=False):
+    """
+    Batch variant of butter_lowpass_filter for multichannel signals, e.g. shape (samples, channels).
+    Uses second-order sections. See sosfilt_multichannel for description of other arguments.
+    """
+    sos = butter_lowpass_sos(lowpass_frequency, sampling_rate, order=filt_order)
+    return sosfilt_multichannel(sos, signal_in, axis=axis, float32=float32, in_place=in_place)
+
+
 # Print iterations progress
 def print_progress(iteration, total, prefix='', suffix='', decimals=1, bar_length=40, initiation=False):
     """
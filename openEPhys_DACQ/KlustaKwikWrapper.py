@@ -7,13 +7,143 @@ Created on Mon Jun 18 18:31:31 2012
 import numpy as np
 import os
 import re
+import json
+import hashlib
 from subprocess import Popen, PIPE, STDOUT
+from threading import Thread
+from collections import deque
+from time import time, sleep
 import tempfile
 import shutil
+try:
+    import resource
+except ImportError:
+    resource = None
 
 from openEPhys_DACQ.package_configuration import package_config
 
 
+def write_formatted_rows(f, array, fmt, chunk_size=10000):
+    '''
+    Writes rows of a 2-D array into open text file f with output identical to
+    numpy.savetxt(f, array, fmt=fmt), but formats chunk_size rows at a time
+    with a single string formatting operation, instead of one row at a time.
+    '''
+    row_format = ' '.join([fmt] * array.shape[1]) + '\n'
+    for start in range(0, array.shape[0], chunk_size):
+        chunk = array[start:start + chunk_size]
+        f.write((row_format * chunk.shape[0]) % tuple(chunk.ravel().tolist()))
+
+
+def read_clu_file(clu_filename):
+    '''
+    Returns contents of a KlustaKwik .clu.n file as an integer array.
+    The first element is the number of clusters, followed by cluster ID of each spike.
+    '''
+    return np.fromfile(clu_filename, dtype=np.int64, sep=' ')
+
+
+# Seconds after which KlustaKwik is stopped and started again with fewer MaxPossibleClusters
+KLUSTAKWIK_TIMEOUT = 12 * 3600
+
+# Fraction of physical memory that a single KlustaKwik process is allowed to use
+KLUSTAKWIK_MEMORY_LIMIT_FRACTION = 0.5
+
+# Number of times KlustaKwik is started on a tetrode before giving up
+KLUSTAKWIK_MAX_ATTEMPTS = 3
+
+# Value of KlustaKwik -MinClusters option and lowest MaxPossibleClusters used when retrying
+KLUSTAKWIK_MIN_CLUSTERS = 5
+
+KLUSTAKWIK_PROGRESS_PATTERN = re.compile(r'Iteration\s+(\d+)\D.*?(\d+)\s+clusters')
+
+
+def get_klustakwik_memory_limit(fraction=KLUSTAKWIK_MEMORY_LIMIT_FRACTION):
+    """
+    Returns the memory limit in bytes for a KlustaKwik process or None if it can not be set on this system.
+    """
+    if resource is None or fraction is None or not hasattr(os, 'sysconf'):
+        return None
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * fraction)
+    except (ValueError, OSError):
+        return None
+
+
+def get_cpu_core(cpu_core_nr):
+    """
+    Returns the CPU core the process is allowed to run on, that corresponds to cpu_core_nr
+    counting from 0, for example as assigned by HelperFunctions.CPU_availability_tracker.
+    """
+    allowed_cores = sorted(os.sched_getaffinity(0))
+
+    return allowed_cores[int(cpu_core_nr) % len(allowed_cores)]
+
+
+def run_klustakwik_process(arguments, cpu_core_nr=None, timeout=None, memory_limit=None, check_interval=0.1):
+    """
+    Runs KlustaKwik with list of arguments, without shell, and returns a dictionary:
+        'returncode' - exit code of the process, negative if killed by a signal
+        'timed_out'  - True if the process was killed after running for timeout seconds
+        'duration'   - seconds the process was running
+        'iteration'  - last iteration reported by KlustaKwik in its output or None
+        'clusters'   - number of clusters at that iteration or None
+        'output'     - last lines of the output of KlustaKwik
+
+    cpu_core_nr - int - if provided, KlustaKwik only runs on that core, see get_cpu_core
+    timeout - float - seconds after which KlustaKwik is killed
+    memory_limit - int - bytes of memory that KlustaKwik is allowed to allocate
+    """
+    cpu_core = None
+    if not (cpu_core_nr is None) and hasattr(os, 'sched_setaffinity'):
+        cpu_core = get_cpu_core(cpu_core_nr)
+    if not (memory_limit is None) and not (resource is None):
+        # The limit can not be raised above the hard limit of this process
+        hard_limit = resource.getrlimit(resource.RLIMIT_AS)[1]
+        if hard_limit != resource.RLIM_INFINITY:
+            memory_limit = min(memory_limit, hard_limit)
+    else:
+        memory_limit = None
+
+    def limit_process():
+        # Called in the new process before KlustaKwik is started
+        if not (cpu_core is None):
+            os.sched_setaffinity(0, {cpu_core})
+        if not (memory_limit is None):
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard_limit))
+
+    progress = {'iteration': None, 'clusters': None, 'output': deque(maxlen=20)}
+
+    def read_output(stdout):
+        for line in iter(stdout.readline, ''):
+            progress['output'].append(line.rstrip())
+            match = KLUSTAKWIK_PROGRESS_PATTERN.search(line)
+            if match:
+                progress['iteration'] = int(match.group(1))
+                progress['clusters'] = int(match.group(2))
+        stdout.close()
+
+    start = time()
+    kk_proc = Popen(arguments, stdout=PIPE, stderr=STDOUT, universal_newlines=True,
+                    preexec_fn=limit_process if os.name == 'posix' else None)
+    T_read_output = Thread(target=read_output, args=(kk_proc.stdout,))
+    T_read_output.daemon = True
+    T_read_output.start()
+    timed_out = False
+    while kk_proc.poll() is None:
+        if not (timeout is None) and time() - start > timeout:
+            kk_proc.kill()
+            kk_proc.wait()
+            timed_out = True
+            break
+        sleep(check_interval)
+    T_read_output.join(1)
+
+    return {'returncode': kk_proc.returncode, 'timed_out': timed_out, 'duration': time() - start,
+            'iteration': progress['iteration'], 'clusters': progress['clusters'],
+            'output': list(progress['output'])}
+
+
 class Kluster():
     '''
     Runs KlustaKwik (KK) against data recorded on the Axona dacqUSB recording
@@ -41,7 +171,7 @@ class Kluster():
         self.filename = filename
         self.tet_num = tet_num
         self.feature_array = feature_array
-        self.n_features = feature_array.shape[1] / 4
+        self.n_features = feature_array.shape[1] // 4
         self.distribution = 1
         self.feature_mask = None
 
@@ -54,7 +184,7 @@ class Kluster():
         with open(fet_filename, 'w') as f:
             f.write(str(self.feature_array.shape[1]))
             f.write('\n')
-            np.savetxt(f, self.feature_array, fmt='%1.5f')
+            write_formatted_rows(f, self.feature_array, '%1.5f')
 
     def get_mask(self):
         '''
@@ -75,7 +205,7 @@ class Kluster():
         '''
         #  use the feature array a to calculate which channels to include etc
         sums = np.sum(self.feature_array, 0)
-        feature_mask = np.repeat(np.ones(4, dtype=np.int), self.n_features)
+        feature_mask = np.repeat(np.ones(4, dtype=np.int64), self.n_features)
         #  if there are "missing" channels use the older version of KK
         zero_sums = sums == 0
         if np.any(zero_sums):
@@ -101,85 +231,101 @@ class Kluster():
             description from github site)
         '''
         fmask_filename = self.filename + '.fmask.' + str(self.tet_num)
-        mask = np.tile(feature_mask, (self.feature_array.shape[0], 1))
+        # All rows of the mask are identical, so the formatted row is only created once
+        mask_row = ' '.join(['%1d' % value for value in feature_mask]) + '\n'
         with open(fmask_filename, 'w') as f:
             f.write(str(self.feature_array.shape[1]))
             f.write('\n')
-            np.savetxt(f, mask, fmt='%1d')
+            f.write(mask_row * self.feature_array.shape[0])
 
-    def kluster(self, max_possible_clusters=31, cpu_core_nr=None):
+    def get_klustakwik_arguments(self, kk_path, max_possible_clusters=31):
+        '''
+        Returns the list of arguments to start KlustaKwik with on the .fet.n file
         '''
-        Using a .fet.n file this makes a system call to KlustaKwik (KK) which
-        clusters data and saves istributional ' + str(self.distribution) + 
-            ' -MinClusters 5'
-            ' -MaxPossibleClusters 31'
-            ' -MaskStarts 30'
-            ' -FullStepEvery 1'
-            ' -SplitEvery 40'
-            ' -UseMaskedInitialConditions 1'
-            ' -AssignToFirstClosestMask 1'
-            ' -DropLastNFeatures 1'
-            ' -RandomSeed 123'
-            ' -PriorPoint 1'
-            ' -MaxIter 10000'
-            ' -PenaltyK 1'
-            ' -PenaltyKLogN 0'
-            ' -Log 0'
-            ' -DistThthe result in a cut file that can be read into
-        Axona's Tint cluster cutting app
+        return [kk_path, self.filename, str(self.tet_num),
+                '-UseDistributional', str(self.distribution),
+                '-MinClusters', str(KLUSTAKWIK_MIN_CLUSTERS),
+                '-MaxPossibleClusters', str(max_possible_clusters),
+                '-MaskStarts', '30',
+                '-FullStepEvery', '1',
+                '-SplitEvery', '40',
+                '-UseMaskedInitialConditions', '1',
+                '-AssignToFirstClosestMask', '1',
+                '-DropLastNFeatures', '1',
+                '-RandomSeed', '123',
+                '-PriorPoint', '1',
+                '-MaxIter', '10000',
+                '-PenaltyK', '1',
+                '-PenaltyKLogN', '0',
+                '-Log', '0',
+                '-DistThresh', '9.6',
+                '-Verbose', '0',
+                '-UseFeatures', ''.join(map(str, self.feature_mask))]
+
+    def kluster(self, max_possible_clusters=31, cpu_core_nr=None, timeout=KLUSTAKWIK_TIMEOUT, memory_limit=None,
+                max_attempts=KLUSTAKWIK_MAX_ATTEMPTS, kk_path=None):
+        '''
+        Using a .fet.n file this runs KlustaKwik (KK), which clusters data
+        and saves the result in a .clu.n file, and then creates a cut file
+        that can be read into Axona's Tint cluster cutting app
+
+        KlustaKwik is started without a shell with run_klustakwik_process.
+        If it fails or does not finish in timeout seconds, it is killed and started again
+        with half the MaxPossibleClusters, up to max_attempts times. The outcome
+        of each attempt is stored in attempts attribute.
         Inputs:
-            fname - the root name of the file (i.e. without the .fet.n)
+            max_possible_clusters - MaxPossibleClusters option of KlustaKwik
+            cpu_core_nr - if provided, KlustaKwik only runs on this CPU core
+            timeout - seconds after which KlustaKwik is stopped, None for no limit
+            memory_limit - bytes of memory KlustaKwik can allocate,
+                           by default KLUSTAKWIK_MEMORY_LIMIT_FRACTION of physical memory
+            max_attempts - number of times KlustaKwik is started before RuntimeError is raised
+            kk_path - path to KlustaKwik executable, by default klustakwik_path in package configuration
         Outputs:
             None but saves a Tint-friendly cut file in the same directory as
             the spike data
         '''
-        if cpu_core_nr is None:
-            taskset_cpu_affinity = ''
-        else:
-            taskset_cpu_affinity = 'taskset -c ' + str(int(cpu_core_nr)) + ' '
         # specify path to KlustaKwik exe
-        kk_path = package_config()['klustakwik_path']
+        if kk_path is None:
+            kk_path = package_config()['klustakwik_path']
         if not os.path.exists(kk_path):
             print(kk_path)
             raise IOError()
-        # This FNULL stops klustakwik from printing progress reports
-        FNULL = open(os.devnull, 'w')
-        kk_proc = Popen(
-            taskset_cpu_affinity +
-            kk_path + ' ' +
-            self.filename + ' ' +
-            str(self.tet_num) +
-            ' -UseDistributional ' + str(self.distribution) + 
-            ' -MinClusters 5'
-            ' -MaxPossibleClusters ' + str(max_possible_clusters) + 
-            ' -MaskStarts 30'
-            ' -FullStepEvery 1'
-            ' -SplitEvery 40'
-            ' -UseMaskedInitialConditions 1'
-            ' -AssignToFirstClosestMask 1'
-            ' -DropLastNFeatures 1'
-            ' -RandomSeed 123'
-            ' -PriorPoint 1'
-            ' -MaxIter 10000'
-            ' -PenaltyK 1'
-            ' -PenaltyKLogN 0'
-            ' -Log 0'
-            ' -DistThresh 9.6'
-            ' -Verbose 0'
-            ' -UseFeatures ' + ''.join(map(str, self.feature_mask))
-        , shell=True, stdout=FNULL, stderr=STDOUT)
-        # Print the output of the KlustaKwik algo
-        kk_proc.communicate()
-        if kk_proc.stderr:
-            for line in kk_proc.stderr:
-                print(line.replace('\n', ''))
-            
+        if memory_limit is None:
+            memory_limit = get_klustakwik_memory_limit()
+        clu_filename = self.filename + '.clu.' + str(self.tet_num)
+        self.attempts = []
+        for n_attempt in range(max_attempts):
+            if os.path.isfile(clu_filename):
+                os.remove(clu_filename)
+            result = run_klustakwik_process(self.get_klustakwik_arguments(kk_path, max_possible_clusters),
+                                            cpu_core_nr=cpu_core_nr, timeout=timeout, memory_limit=memory_limit)
+            result['max_possible_clusters'] = max_possible_clusters
+            self.attempts.append(result)
+            if result['returncode'] == 0 and os.path.isfile(clu_filename):
+                break
+            if result['timed_out']:
+                reason = 'timed out after {:.0f} s'.format(result['duration'])
+            else:
+                reason = 'failed with exit code {}'.format(result['returncode'])
+            if not (result['iteration'] is None):
+                reason += ' at iteration {} with {} clusters'.format(result['iteration'], result['clusters'])
+            if n_attempt + 1 == max_attempts:
+                raise RuntimeError('KlustaKwik ' + reason + ' on ' + clu_filename + ' with MaxPossibleClusters '
+                                   + str(max_possible_clusters) + '. Output:\n' + '\n'.join(result['output']))
+            max_possible_clusters = max(KLUSTAKWIK_MIN_CLUSTERS, max_possible_clusters // 2)
+            print('KlustaKwik ' + reason + ' on ' + clu_filename + ', retrying with MaxPossibleClusters '
+                  + str(max_possible_clusters))
+
+        self.make_cut()
+
+    def make_cut(self):
         '''
-        now read in the .clu.n file that has been created as a result of this
-        process and create the Tint-friendly cut file
+        now read in the .clu.n file that has been created as a result of 
+        kluster method and create the Tint-friendly cut file
         '''
         clu_filename = self.filename + '.clu.' + str(self.tet_num)
-        clu_data = np.loadtxt(clu_filename)
+        clu_data = read_clu_file(clu_filename)
         n_clusters = clu_data[0]
         clu_data = clu_data[1:] - 1  # -1 so cluster 0 is junk
         n_chan = 4
@@ -195,8 +341,30 @@ class Kluster():
                 f.write('                min:{zeros}\n'.format(i=i, zeros='    0    0    0    0    0    0    0    0'))
                 f.write('                max:{zeros}\n'.format(i=i, zeros='    0    0    0    0    0    0    0    0'))
             f.write('Exact_cut_for: {fname} spikes: {nSpikes}\n'.format(fname=os.path.basename(self.filename), nSpikes=str(n_spikes)))
-            for spk in clu_data:
-                f.write('{spk}  '.format(spk=spk.astype(int)))
+            f.write(('%d  ' * n_spikes) % tuple(clu_data.tolist()))
+
+    def assign_remaining_spikes(self, feature_array, fit_idx, method='mahalanobis'):
+        '''
+        Assigns spikes in feature_array to clusters found by kluster method using only rows fit_idx
+        of feature_array, which must have been the feature_array of this Kluster instance.
+        The .clu.n and cut files are then rewritten for all spikes in feature_array.
+
+        Spikes in fit_idx keep their KlustaKwik cluster IDs. Other spikes are assigned with
+        assign_spikes_to_clusters, using features that were used by KlustaKwik,
+        as set by feature_mask and -DropLastNFeatures 1 option.
+        '''
+        clu_filename = self.filename + '.clu.' + str(self.tet_num)
+        clu_data = read_clu_file(clu_filename)
+        used_features = np.where(self.feature_mask[:feature_array.shape[1] - 1] > 0)[0]
+        clusterIDs = assign_spikes_to_clusters(feature_array[:, used_features],
+                                               feature_array[fit_idx][:, used_features],
+                                               clu_data[1:], method=method)
+        clusterIDs[fit_idx] = clu_data[1:]
+        self.feature_array = feature_array
+        with open(clu_filename, 'w') as f:
+            f.write(str(clu_data[0]) + '\n')
+            f.write(''.join(['%d\n' % clusterID for clusterID in clusterIDs.tolist()]))
+        self.make_cut()
 
 #   def cleanup(self):
 #       '''
@@ -211,6 +379,268 @@ class Kluster():
 #           except IOError:
 #               pass
 
+# Number of waveforms processed at a time when fitting PCA and projecting waveforms on components
+PCA_BATCH_SIZE = 100000
+
+# Features computed by applyKlustaKwik_on_spike_data_tet
+KLUSTAKWIK_FEATURES = ['PC1', 'PC2', 'PC3', 'Amp', 'Vt']
+
+# Identifies the method used to compute features in get_klustakwik_feature_key.
+# This must be changed if changes to getParams would change the output.
+KLUSTAKWIK_FEATURE_VERSION = 'shared_channel_pca_1'
+
+
+def fit_pca_over_channels(waveforms, n_components):
+    """
+    Returns mean (nSamples,) and components (n_components x nSamples) of PCA
+    fitted on waveforms of all channels together.
+
+    The covariance matrix is accumulated over batches of PCA_BATCH_SIZE waveforms, such that
+    memory use does not depend on the number of spikes, and components are its eigenvectors
+    with largest eigenvalues, with signs set as in sklearn.decomposition.PCA.
+
+    waveforms - numpy array nSpikes x nChannels x nSamples of integer values, such as int16
+    """
+    n_samples = waveforms.shape[2]
+    waveforms = np.ascontiguousarray(waveforms).reshape(waveforms.shape[0] * waveforms.shape[1], n_samples)
+    sum_x = np.zeros(n_samples, dtype=np.float64)
+    sum_xx = np.zeros((n_samples, n_samples), dtype=np.float64)
+    for start in range(0, waveforms.shape[0], PCA_BATCH_SIZE):
+        batch = waveforms[start:start + PCA_BATCH_SIZE].astype(np.float64)
+        sum_x += np.sum(batch, axis=0)
+        sum_xx += np.dot(batch.T, batch)
+
+    return pca_from_sums(waveforms.shape[0], sum_x, sum_xx, n_components)
+
+
+def pca_from_sums(n, sum_x, sum_xx, n_components):
+    """
+    Returns mean (nSamples,) and components (n_components x nSamples) of PCA
+    of n waveforms with sum sum_x (nSamples,) and sum of outer products sum_xx (nSamples x nSamples).
+    """
+    mean = sum_x / n
+    covariance = (sum_xx - n * np.outer(mean, mean)) / max(n - 1, 1)
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    components = eigenvectors[:, np.argsort(eigenvalues)[::-1][:n_components]].T
+    signs = np.sign(components[np.arange(components.shape[0]), np.argmax(np.abs(components), axis=1)])
+    components = components * signs[:, None]
+
+    return mean, components
+
+
+def accumulate_pca_statistics(waveforms, statistics=None):
+    """
+    Returns statistics dictionary for fit_pca_on_statistics with sums over waveforms
+    (nSpikes x nChannels x nSamples) added separately for each channel, in batches of PCA_BATCH_SIZE.
+
+    Statistics of waveforms from multiple recordings can be accumulated by passing
+    the output of the previous call as statistics.
+    """
+    n_channels, n_samples = waveforms.shape[1], waveforms.shape[2]
+    if statistics is None:
+        statistics = {'n': 0,
+                      'sum_x': np.zeros((n_channels, n_samples), dtype=np.float64),
+                      'sum_xx': np.zeros((n_channels, n_samples, n_samples), dtype=np.float64),
+                      'nonzero': np.zeros(n_channels, dtype=bool)}
+    for start in range(0, waveforms.shape[0], PCA_BATCH_SIZE):
+        batch = waveforms[start:start + PCA_BATCH_SIZE].astype(np.float64)
+        statistics['nonzero'] |= np.any(batch != 0, axis=(0, 2))
+        statistics['sum_x'] += np.sum(batch, axis=0)
+        for channel in range(n_channels):
+            statistics['sum_xx'][channel] += np.dot(batch[:, channel, :].T, batch[:, channel, :])
+    statistics['n'] += waveforms.shape[0]
+
+    return statistics
+
+
+def fit_pca_on_statistics(statistics, n_components):
+    """
+    Returns (valid_channels, mean, components) of a single PCA fitted to waveforms of all valid channels
+    in statistics from accumulate_pca_statistics, as used by project_on_pca_model.
+    Channels that are all zeros or contain NaNs are not valid. If no channels are valid,
+    mean and components are all zeros.
+    """
+    valid_channels = np.where(statistics['nonzero'] & ~np.any(np.isnan(statistics['sum_x']), axis=1))[0]
+    if valid_channels.size == 0:
+        n_samples = statistics['sum_x'].shape[1]
+        return valid_channels, np.zeros(n_samples), np.zeros((n_components, n_samples))
+    mean, components = pca_from_sums(statistics['n'] * valid_channels.size,
+                                     np.sum(statistics['sum_x'][valid_channels], axis=0),
+                                     np.sum(statistics['sum_xx'][valid_channels], axis=0),
+                                     n_components)
+
+    return valid_channels, mean, components
+
+
+def project_on_pca_model(waveforms, pca):
+    """
+    Returns projections (nSpikes x nChannels x n_components) of waveforms (nSpikes x nChannels x nSamples)
+    on pca from fit_pca_on_statistics. Channels that are not valid get 0 for all components.
+    """
+    valid_channels, mean, components = pca
+    if valid_channels.size == waveforms.shape[1]:
+        return project_on_pca_components(waveforms, mean, components)
+    out = np.zeros((waveforms.shape[0], waveforms.shape[1], components.shape[0]))
+    if valid_channels.size > 0:
+        out[:, valid_channels, :] = project_on_pca_components(waveforms[:, valid_channels, :], mean, components)
+
+    return out
+
+
+def project_on_pca_components(waveforms, mean, components):
+    """
+    Returns projections (nSpikes x nChannels x n_components) of waveforms (nSpikes x nChannels x nSamples)
+    on components, computed in batches of PCA_BATCH_SIZE spikes.
+    """
+    out = np.zeros((waveforms.shape[0], waveforms.shape[1], components.shape[0]))
+    for start in range(0, waveforms.shape[0], PCA_BATCH_SIZE):
+        out[start:start + PCA_BATCH_SIZE] = np.dot(waveforms[start:start + PCA_BATCH_SIZE].astype(np.float64),
+                                                   components.T) - np.dot(mean, components.T)
+
+    return out
+
+
+def subsample_spike_indices(n_spikes, max_spikes, random_seed=0):
+    """
+    Returns sorted indices of a random subsample of max_spikes out of n_spikes,
+    or indices of all spikes if n_spikes is not larger than max_spikes.
+    """
+    if n_spikes <= max_spikes:
+        return np.arange(n_spikes)
+    rng = np.random.RandomState(random_seed)
+
+    return np.sort(rng.choice(n_spikes, size=max_spikes, replace=False))
+
+
+def assign_spikes_to_clusters(features, fit_features, fit_clusterIDs, method='mahalanobis', batch_size=100000):
+    """
+    Returns cluster IDs for each row of features, based on clusters in fit_features.
+
+    features       - numpy array nSpikes x nFeatures
+    fit_features   - numpy array nFitSpikes x nFeatures of spikes with known clusters
+    fit_clusterIDs - numpy array nFitSpikes of cluster IDs of fit_features
+    method         - str - 'mahalanobis' (default) assigns each spike to the cluster with highest
+                     likelihood of a Gaussian with mean and covariance of the cluster in fit_features,
+                     weighted by the fraction of fit spikes in the cluster.
+                     Covariance of small clusters is shrunk towards the covariance of all fit_features.
+                     'nearest' assigns each spike to the nearest cluster mean
+                     after scaling each feature to unit variance in fit_features.
+    batch_size     - int - number of spikes processed at a time
+    """
+    fit_features = np.asarray(fit_features, dtype=np.float64)
+    cluster_ids = np.unique(fit_clusterIDs)
+    n_features = fit_features.shape[1]
+    if method == 'nearest':
+        scale = np.std(fit_features, axis=0)
+        scale[scale == 0] = 1
+        centres = np.array([np.mean(fit_features[fit_clusterIDs == cluster_id], axis=0) for cluster_id in cluster_ids])
+        centres = centres / scale
+        centre_norms = np.sum(centres ** 2, axis=1)
+
+        def compute_scores(batch):
+            return 2 * np.dot(batch / scale, centres.T) - centre_norms[None, :]
+
+    elif method == 'mahalanobis':
+        pooled_covariance = np.atleast_2d(np.cov(fit_features, rowvar=False))
+        regularization = 1e-9 * max(np.trace(pooled_covariance) / n_features, 1e-12) * np.eye(n_features)
+        clusters = []
+        for cluster_id in cluster_ids:
+            cluster_features = fit_features[fit_clusterIDs == cluster_id]
+            n = cluster_features.shape[0]
+            mean = np.mean(cluster_features, axis=0)
+            scatter = np.dot((cluster_features - mean).T, cluster_features - mean)
+            covariance = (scatter + n_features * pooled_covariance) / (n - 1 + n_features) + regularization
+            cholesky = np.linalg.cholesky(covariance)
+            whitening = np.linalg.inv(cholesky).T
+            log_det = 2 * np.sum(np.log(np.diag(cholesky)))
+            log_prior = np.log(n / float(fit_features.shape[0]))
+            clusters.append((mean, whitening, log_prior - 0.5 * log_det))
+
+        def compute_scores(batch):
+            scores = np.zeros((batch.shape[0], len(clusters)))
+            for i, (mean, whitening, constant) in enumerate(clusters):
+                whitened = np.dot(batch - mean, whitening)
+                scores[:, i] = constant - 0.5 * np.sum(whitened ** 2, axis=1)
+            return scores
+
+    else:
+        raise ValueError('Unknown method ' + str(method))
+
+    # Scores are only computed for batch_size spikes at a time
+    clusterIDs = np.zeros(features.shape[0], dtype=cluster_ids.dtype)
+    for start in range(0, features.shape[0], batch_size):
+        batch = np.asarray(features[start:start + batch_size], dtype=np.float64)
+        clusterIDs[start:start + batch_size] = cluster_ids[np.argmax(compute_scores(batch), axis=1)]
+
+    return clusterIDs
+
+
+def getParams(waveforms, params, t=200, fet=1, pca=None):
+    '''
+    Returns a dictionary with each requested parameter of getParam,
+    computed in a single pass over the waveforms.
+
+    Parameters
+    -------------------
+
+    waveforms - numpy array
+        nSpikes x nSamples OR nSpikes x nElectrodes x nSamples
+
+    params - list
+        Parameters as listed for getParam
+
+    t, fet - as for getParam
+
+    pca - optional output of fit_pca_on_statistics to use for 'PCA' instead of fitting it on waveforms,
+          for example fitted on waveforms of multiple recordings.
+
+    A single PCA is fitted to waveforms of all channels that are not all zeros or contain NaNs
+    and the same components are used for all channels. Other channels get 0 for all components.
+    '''
+    from scipy import interpolate
+
+    computed = {}
+
+    def get(name, function):
+        if not (name in computed):
+            computed[name] = function()
+        return computed[name]
+
+    def time_of_index(idx):
+        m = interpolate.interp1d([0, waveforms.shape[-1]-1], [0, 1/1000.])
+        return m(idx)
+
+    out = {}
+    for param in params:
+        if param == 'Amp':
+            out[param] = get('max', lambda: np.max(waveforms, axis=-1)) - get('min', lambda: np.min(waveforms, axis=-1))
+        elif param == 'P':
+            out[param] = get('max', lambda: np.max(waveforms, axis=-1))
+        elif param == 'T':
+            out[param] = get('min', lambda: np.min(waveforms, axis=-1))
+        elif param == 'Vt':
+            times = np.arange(0,1000,20)
+            f = interpolate.interp1d(times, range(50), 'nearest')
+            out[param] = waveforms[..., int(f(t))]
+        elif param == 'tP':
+            out[param] = time_of_index(np.argmax(waveforms, axis=-1))
+        elif param == 'tT':
+            out[param] = time_of_index(np.argmin(waveforms, axis=-1))
+        elif param == 'PCA':
+            waves = waveforms if waveforms.ndim == 3 else waveforms[:, None, :]
+            if pca is None:
+                pca = fit_pca_on_statistics(accumulate_pca_statistics(waves), fet)
+            pcs = project_on_pca_model(waves, pca)
+            if waveforms.ndim == 2:
+                out[param] = pcs[:, 0, :].squeeze()
+            else:
+                out[param] = pcs.reshape(waves.shape[0], waves.shape[1] * fet)
+        else:
+            raise ValueError('Unknown param ' + str(param))
+
+    return out
+
+
 def getParam(waveforms=None, param='Amp', t=200, fet=1):
     '''
     Returns the requested parameter from a spike train as a numpy array
@@ -231,57 +661,151 @@ def getParam(waveforms=None, param='Amp', t=200, fet=1):
             'Vt' height at time t
             'tP' - time of peak (in seconds)
             'tT' - time of trough (in seconds)
-            'PCA' - first n fet principal components (defaults to 1)
+            'PCA' - first n fet principal components (defaults to 1),
+                    for nSpikes x nElectrodes x nSamples input as consecutive columns for each electrode.
+                    Components are computed from waveforms of all electrodes together.
             
     t - int
         The time used for Vt
         
     fet - int
         The number of principal components (used with param 'PCA')
+
+    Use getParams to compute multiple parameters at once.
     '''
-    from scipy import interpolate
-    from sklearn.decomposition import PCA
-            
-    if param == 'Amp':
-        return np.ptp(waveforms, axis=-1)
-    elif param == 'P':
-        return np.max(waveforms, axis=-1)
-    elif param == 'T':
-        return np.min(waveforms, axis=-1)
-    elif param == 'Vt':
-        times = np.arange(0,1000,20)
-        f = interpolate.interp1d(times, range(50), 'nearest')
-        if waveforms.ndim == 2:
-            return waveforms[:, int(f(t))]
-        elif waveforms.ndim == 3:
-            return waveforms[:, :, int(f(t))]
-    elif param == 'tP':
-        idx = np.argmax(waveforms, axis=-1)
-        m = interpolate.interp1d([0, waveforms.shape[-1]-1], [0, 1/1000.])
-        return m(idx)
-    elif param == 'tT':
-        idx = np.argmin(waveforms, axis=-1)
-        m = interpolate.interp1d([0, waveforms.shape[-1]-1], [0, 1/1000.])
-        return m(idx)
-    elif param == 'PCA':
-        pca = PCA(n_components=fet)
-        if waveforms.ndim == 2:
-            return pca.fit(waveforms).transform(waveforms).squeeze()
-        elif waveforms.ndim == 3:
-            out = np.zeros((waveforms.shape[0], waveforms.shape[1] * fet))
-            st = np.arange(0, waveforms.shape[1] * fet, fet)
-            en = np.arange(fet, fet + (waveforms.shape[1] * fet), fet)
-            rng = np.vstack((st, en))
-            for i in range(waveforms.shape[1]):
-                if ~np.any(np.isnan(waveforms[:,i,:])):
-                    A = np.squeeze(pca.fit(waveforms[:,i,:].squeeze()).transform(waveforms[:,i,:].squeeze()))
-                    if A.ndim < 2:
-                        out[:,rng[0,i]:rng[1,i]] = np.atleast_2d(A).T
-                    else:
-                        out[:,rng[0,i]:rng[1,i]] = A
-            return out
-
-def klustakwik(waveforms, d, filename_root, max_possible_clusters=31, cpu_core_nr=None):
+    return getParams(waveforms, [param], t=t, fet=fet)[param]
+
+
+def get_klustakwik_feature_key(waveforms, features2use, idx_keep=None):
+    """
+    Returns a hash string identifying the waveforms and features2use,
+    to check if features stored in NWB file can be used instead of computing them again.
+
+    waveforms - numpy array nSpikes x nElectrodes x nSamples or list of such arrays of multiple recordings.
+                The key of a list is the same as of the arrays concatenated.
+    idx_keep - optional boolean array or list of arrays for each element of waveforms
+               to only use the selected spikes, selected one recording at a time.
+    """
+    if isinstance(waveforms, np.ndarray):
+        waveforms = [waveforms]
+        idx_keep = None if idx_keep is None else [idx_keep]
+    if idx_keep is None:
+        idx_keep = [None] * len(waveforms)
+    n_spikes = sum([recording_waveforms.shape[0] if recording_idx_keep is None
+                    else int(np.count_nonzero(recording_idx_keep))
+                    for recording_waveforms, recording_idx_keep in zip(waveforms, idx_keep)])
+    feature_hash = hashlib.sha1()
+    feature_hash.update(json.dumps({'features': list(features2use), 'version': KLUSTAKWIK_FEATURE_VERSION,
+                                    'shape': [n_spikes] + list(waveforms[0].shape[1:]),
+                                    'dtype': waveforms[0].dtype.str}).encode('utf-8'))
+    for recording_waveforms, recording_idx_keep in zip(waveforms, idx_keep):
+        if not (recording_idx_keep is None):
+            recording_waveforms = recording_waveforms[recording_idx_keep]
+        feature_hash.update(np.ascontiguousarray(recording_waveforms).view(np.uint8).reshape(-1))
+
+    return feature_hash.hexdigest()
+
+
+def get_number_of_pcs(features2use):
+    """
+    Returns the number of principal components required for features2use, such as 2 for ['PC1', 'PC2', 'Amp'].
+    """
+    reg = re.compile(".*(PC).*")
+    pcs = [m.group(0) for l in features2use for m in [reg.search(l)] if m]
+
+    return max([int(pc[2]) for pc in pcs]) if pcs else 0
+
+
+def compute_klustakwik_features(waveforms, features2use, pca=None):
+    """
+    Returns the array of features (nSpikes x nFeatures) written to .fet file by klustakwik.
+
+    waveforms - numpy array nSpikes x nElectrodes x nSamples
+    features2use - list - elements of legal values listed in klustakwik, e.g. ['PC1', 'PC2', 'Amp']
+    pca - optional output of fit_pca_on_statistics with get_number_of_pcs(features2use) components
+          to compute principal components with, see getParams.
+    """
+    reg = re.compile(".*(PC).*")  # check for number of principal comps
+    pcs = [m.group(0) for l in features2use for m in [reg.search(l)] if m]
+    params = [value for value in features2use if 'PC' not in value]
+    num_pcs = None
+    if pcs:
+        max_pc = []
+        for pc in pcs:
+            max_pc.append(int(pc[2]))
+        num_pcs = np.max(max_pc)  # get max number of prin comps
+        params.append('PCA')
+    values = getParams(waveforms, params, fet=num_pcs if num_pcs else 1, pca=pca)
+    princomp = None
+    if pcs:
+        # Rearrange the output from PCA calc to match the
+        # number of requested principal components
+        inds2keep = []
+        for m in max_pc:
+            inds2keep.append(np.arange((m-1)*4, (m)*4))
+        inds2keep = np.hstack(inds2keep)
+        princomp = np.take(values['PCA'], inds2keep, axis=1)
+    out = []
+    for value in features2use:
+        if 'PC' not in value:
+            out.append(values[value])
+    if princomp is not None:
+        out.append(princomp)
+
+    return np.hstack(out)
+
+
+def compute_klustakwik_features_over_recordings(waveforms, features2use, idx_keep=None):
+    """
+    Returns the array of features (nSpikes x nFeatures) of spikes of multiple recordings,
+    the same as compute_klustakwik_features of waveforms concatenated, but without concatenating waveforms.
+
+    Principal components are fitted on statistics accumulated one recording at a time
+    and features of each recording are written into the output array in order.
+
+    waveforms - list of numpy arrays nSpikes x nElectrodes x nSamples of each recording
+    features2use - list - as for compute_klustakwik_features
+    idx_keep - optional list of boolean arrays for each element of waveforms to only use the selected spikes
+    """
+    if idx_keep is None:
+        idx_keep = [None] * len(waveforms)
+
+    def selected(n_recording):
+        if idx_keep[n_recording] is None:
+            return waveforms[n_recording]
+        else:
+            return waveforms[n_recording][idx_keep[n_recording]]
+
+    n_pcs = get_number_of_pcs(features2use)
+    pca = None
+    if n_pcs > 0:
+        statistics = None
+        for n_recording in range(len(waveforms)):
+            recording_waveforms = selected(n_recording)
+            if recording_waveforms.shape[0] > 0:
+                statistics = accumulate_pca_statistics(recording_waveforms, statistics=statistics)
+        if not (statistics is None):
+            pca = fit_pca_on_statistics(statistics, n_pcs)
+    features = None
+    n_spikes = sum([recording_waveforms.shape[0] if recording_idx_keep is None
+                    else int(np.count_nonzero(recording_idx_keep))
+                    for recording_waveforms, recording_idx_keep in zip(waveforms, idx_keep)])
+    position = 0
+    for n_recording in range(len(waveforms)):
+        recording_waveforms = selected(n_recording)
+        if recording_waveforms.shape[0] == 0:
+            continue
+        recording_features = compute_klustakwik_features(recording_waveforms, features2use, pca=pca)
+        if features is None:
+            features = np.zeros((n_spikes, recording_features.shape[1]), dtype=recording_features.dtype)
+        features[position:position + recording_features.shape[0]] = recording_features
+        position += recording_features.shape[0]
+
+    return np.zeros((0, 0)) if features is None else features
+
+
+def klustakwik(waveforms, d, filename_root, max_possible_clusters=31, cpu_core_nr=None, feature_arrays=None,
+               max_spikes_to_fit=None, assignment_method='mahalanobis', random_seed=0, kk_path=None):
     """ 
     Calls two methods below (kluster and getPC) to run klustakwik on
     a given tetrode with nFet number of features (for the PCA)
@@ -293,89 +817,107 @@ def klustakwik(waveforms, d, filename_root, max_possible_clusters=31, cpu_core_n
             clustering. Each key is the identity of a tetrode (i.e. 1, 2 etc)
              and the values are the features used to do the clustering for that tetrode (i.e.
             'PC1', 'PC2', 'Amp' (amplitude) etc
+        feature_arrays : dict
+            Optional feature arrays from compute_klustakwik_features for keys in d.
+            Features are computed for any keys of d that are missing.
+        max_spikes_to_fit : int
+            If provided and there are more spikes, KlustaKwik is only applied to a random subsample
+            of max_spikes_to_fit spikes (selected with random_seed) and the remaining spikes are
+            assigned to the clusters with Kluster.assign_remaining_spikes using assignment_method
+            ('mahalanobis' or 'nearest', see assign_spikes_to_clusters).
+        kk_path : str
+            Path to KlustaKwik executable, by default klustakwik_path in package configuration.
+
+    Returns a dictionary with the feature arrays used for each key in d.
     """
     legal_values = ['PC1', 'PC2', 'PC3', 'PC4', 'Amp',
                     'Vt', 'P', 'T', 'tP', 'tT', 'En', 'Ar']
-    reg = re.compile(".*(PC).*")  # check for number of principal comps
     # check for any input errors in whole dictionary first
     for i_tetrode in d.keys():
         for v in d[i_tetrode]:
             if v not in legal_values:
                 raise ValueError('Could not find %s in %s' % (v, legal_values))
-    # iterate through features and see what the max principal component is
+    feature_arrays = {} if feature_arrays is None else dict(feature_arrays)
     for i_tetrode in d.keys():
-        pcs = [m.group(0) for l in d[i_tetrode] for m in [reg.search(l)] if m]
-        waves = waveforms
-        princomp = None
-        if pcs:
-            max_pc = []
-            for pc in pcs:
-                max_pc.append(int(pc[2]))
-            num_pcs = np.max(max_pc)  # get max number of prin comps
-            princomp = getParam(waves, param='PCA', fet=num_pcs)
-            # Rearrange the output from PCA calc to match the 
-            # number of requested principal components
-            inds2keep = []
-            for m in max_pc:
-                inds2keep.append(np.arange((m-1)*4, (m)*4))
-            inds2keep = np.hstack(inds2keep)
-            princomp = np.take(princomp, inds2keep, axis=1)
-        out = []
-        for value in d[i_tetrode]:
-            if 'PC' not in value:
-                out.append(getParam(waves, param=value))
-        if princomp is not None:
-            out.append(princomp)
-        out = np.hstack(out)
-        
-        c = Kluster(filename_root, i_tetrode, out)
+        if feature_arrays.get(i_tetrode) is None:
+            feature_arrays[i_tetrode] = compute_klustakwik_features(waveforms, d[i_tetrode])
+        out = feature_arrays[i_tetrode]
+        fit_idx = None
+        if not (max_spikes_to_fit is None) and out.shape[0] > max_spikes_to_fit:
+            fit_idx = subsample_spike_indices(out.shape[0], max_spikes_to_fit, random_seed=random_seed)
+
+        c = Kluster(filename_root, i_tetrode, out if fit_idx is None else out[fit_idx])
         c.make_fet()
         mask = c.get_mask()
         c.make_fmask(mask)
         c.kluster(max_possible_clusters=max_possible_clusters, 
-                  cpu_core_nr=cpu_core_nr)
+                  cpu_core_nr=cpu_core_nr, kk_path=kk_path)
+        if not (fit_idx is None):
+            c.assign_remaining_spikes(out, fit_idx, method=assignment_method)
+
+    return feature_arrays
 
 def applyKlustaKwik_on_spike_data_tet(spike_data_tet, max_possible_clusters=31, 
-                                      cpu_core_nr=None):
+                                      cpu_core_nr=None, return_features=False, max_spikes_to_fit=None,
+                                      kk_path=None):
     '''
     Returns the input dictionary with added field 'clusterIDs'
     Input dictionary required fields:
-        'waveforms' - nspikes x waveformLength x n_channels - spike waveforms for one tetrode
+        'waveforms' - nspikes x n_channels x waveformLength - spike waveforms for one tetrode
         'idx_keep' - logical indexing array of length nspikes to specify which spikes to use
+    Optional field:
+        'features' - features of spikes in idx_keep from compute_klustakwik_features with KLUSTAKWIK_FEATURES,
+                     for example loaded from NWB file. If not provided, features are computed.
+                     If 'features' are provided, 'waveforms' can be omitted, as for spikes of
+                     multiple recordings combined with Processing.combine_spike_datas_tet.
     Returns a vector clusterIDs of length equal to sum(idx_keep)
+    If return_features is True, also returns the features used or None if KlustaKwik was not applied.
+    If max_spikes_to_fit is provided, KlustaKwik is applied to a random subsample of that many spikes
+    and remaining spikes are assigned to the clusters found, see klustakwik.
+    If kk_path is provided, it is used as the path to KlustaKwik executable instead of package configuration.
 
         Added by Sander Tanni 04/06/2018
     '''
-    if spike_data_tet['waveforms'].shape[0] == 0:
-        return np.array([], dtype=np.int16)
-    if spike_data_tet['waveforms'].shape[0] < 4:
-        return np.ones(spike_data_tet['waveforms'].shape[0], dtype=np.int16)
-
-    # Create spike waveform array and filter using idx_keep
-    waves = spike_data_tet['waveforms'][spike_data_tet['idx_keep'],:,:]
-    if waves.shape[0] == 0:
-        return np.array([], dtype=np.int16)
-    if waves.shape[0] < 4:
-        return np.ones(waves.shape[0], dtype=np.int16)
+    clusterIDs, features = applyKlustaKwik_and_get_features(spike_data_tet, max_possible_clusters, cpu_core_nr,
+                                                            max_spikes_to_fit=max_spikes_to_fit, kk_path=kk_path)
+    if return_features:
+        return clusterIDs, features
+    else:
+        return clusterIDs
+
+def applyKlustaKwik_and_get_features(spike_data_tet, max_possible_clusters=31, cpu_core_nr=None,
+                                     max_spikes_to_fit=None, kk_path=None):
+    if 'waveforms' in spike_data_tet:
+        if spike_data_tet['waveforms'].shape[0] == 0:
+            return np.array([], dtype=np.int16), None
+        if spike_data_tet['waveforms'].shape[0] < 4:
+            return np.ones(spike_data_tet['waveforms'].shape[0], dtype=np.int16), None
+        # Create spike waveform array and filter using idx_keep
+        waves = spike_data_tet['waveforms'][spike_data_tet['idx_keep'],:,:]
+        n_spikes = waves.shape[0]
+    else:
+        # Only features are available for spikes of combined recordings
+        waves = None
+        n_spikes = spike_data_tet['features'].shape[0]
+    if n_spikes == 0:
+        return np.array([], dtype=np.int16), None
+    if n_spikes < 4:
+        return np.ones(n_spikes, dtype=np.int16), None
 
     # Create temporary processing folder
     KlustaKwikProcessingFolder = tempfile.mkdtemp('KlustaKwikProcessing')
     # Prepare input to KlustaKwik
-    features2use = ['PC1', 'PC2', 'PC3', 'Amp', 'Vt']
-    d = {0: features2use}
-    klustakwik(waves, d, os.path.join(KlustaKwikProcessingFolder, 'KlustaKwikTemp'), 
-               max_possible_clusters=max_possible_clusters, 
-               cpu_core_nr=cpu_core_nr)
+    d = {0: KLUSTAKWIK_FEATURES}
+    feature_arrays = klustakwik(waves, d, os.path.join(KlustaKwikProcessingFolder, 'KlustaKwikTemp'), 
+                                max_possible_clusters=max_possible_clusters, 
+                                cpu_core_nr=cpu_core_nr,
+                                feature_arrays={0: spike_data_tet.get('features', None)},
+                                max_spikes_to_fit=max_spikes_to_fit, kk_path=kk_path)
     # Read in cluster IDs
     cluFileName = os.path.join(KlustaKwikProcessingFolder, 'KlustaKwikTemp.clu.0')
-    with open(cluFileName, 'rb') as file:
-        lines = file.readlines()
+    clusterIDs = read_clu_file(cluFileName)
     # Delete KlustaKwik temporary processing folder
     shutil.rmtree(KlustaKwikProcessingFolder)
-    # Parse lines into an array and return it
-    clusterIDs = []
-    for line in lines:
-        clusterIDs.append(int(line.rstrip()))
-    clusterIDs = clusterIDs[1:] # Drop the first value which is number of spikes
+    clusterIDs = clusterIDs[1:] # Drop the first value which is number of clusters
 
-    return np.array(clusterIDs, dtype=np.int16)
+    return clusterIDs.astype(np.int16), feature_arrays[0]
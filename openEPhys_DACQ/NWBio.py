@@ -10,8 +10,18 @@ from copy import copy
 import argparse
 import importlib
 from tqdm import tqdm
+from contextlib import contextmanager
+from time import time
+import json
+import shutil
+import subprocess
+from multiprocessing import Pool
+from queue import Queue
 
 
+# Name of the dataset where dictionary elements are stored in compact form, see save_compact_dict_contents
+COMPACT_DICT_DATASET_NAME = '_NWBJSON'
+
 def OpenEphys_SamplingRate():
     return 30000
 
@@ -36,121 +46,305 @@ def get_filename(path):
         return path
 
 
-def delete_path_in_file(filename, path):
-    with h5py.File(filename, 'r+') as h5file:
+_h5file_open_count = [0]
+
+
+def open_h5file(filename, mode='r'):
+    """Returns h5py.File opened with mode and increments the count of :py:func:`get_h5file_open_count`.
+
+    All files in this module are opened with this function.
+
+    :param str filename: path to NWB file
+    :param str mode: h5py.File mode
+    :return: h5file
+    :rtype: h5py.File
+    """
+    h5file = h5py.File(filename, mode)
+    _h5file_open_count[0] += 1
+
+    return h5file
+
+
+def get_h5file_open_count():
+    """Returns the number of times files have been opened with :py:func:`open_h5file` in this process.
+
+    :return: open_count
+    :rtype: int
+    """
+    return _h5file_open_count[0]
+
+
+class NWBFileSession(object):
+    """Keeps a single open h5py.File for each NWB file and caches metadata read from the files.
+
+    Functions in this module with `session` argument use the open files and cached metadata
+    of the session instead of opening the file for each query. Functions that would otherwise
+    open the same file multiple times use a temporary session if `session` is not provided.
+
+    Use as a context manager or call :py:meth:`NWBFileSession.close` when done::
+
+        with NWBio.NWBFileSession() as session:
+            tetrode_nrs = NWBio.get_tetrode_nrs_if_spikes_available(filename, session=session)
+            data = NWBio.load_spikes(filename, tetrode_nrs=tetrode_nrs, session=session)
+
+    Cached metadata of a file is cleared when the file is modified through the session.
+    Modifications made to the file without the session are not reflected in cached metadata.
+
+    `open_count` attribute is the number of times files have been opened by the session.
+    """
+
+    def __init__(self):
+        self._h5files = {}
+        self._cache = {}
+        self.open_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def h5file(self, filename, mode='r'):
+        """Returns open h5py.File for filename, opening the file if it is not already open.
+
+        :param str filename: path to NWB file
+        :param str mode: 'r' for reading or 'r+' for reading and writing.
+            If file is open for reading only, it is reopened if 'r+' is requested.
+            As HDF5 does not allow opening the file for writing while it is open for reading,
+            this closes the read-only h5py.File and IOError is raised instead if any datasets or groups
+            obtained from it are still open, as these would be invalidated.
+        :return: h5file
+        :rtype: h5py.File
+        """
+        key = os.path.abspath(filename)
+        h5file = self._h5files.get(key, None)
+        if not (h5file is None) and (mode == 'r' or h5file.mode == mode):
+            return h5file
+        if not (h5file is None):
+            n_open_objects = h5py.h5f.get_obj_count(h5file.id, h5py.h5f.OBJ_ALL & ~h5py.h5f.OBJ_FILE)
+            if n_open_objects > 0:
+                raise IOError('Can not reopen {} for writing while datasets or groups of the file '
+                              'opened for reading are in use (open objects: {}).'.format(filename, n_open_objects))
+            h5file.close()
+        h5file = open_h5file(filename, mode)
+        self.open_count += 1
+        self._h5files[key] = h5file
+
+        return h5file
+
+    def cached(self, filename, key, method):
+        """Returns the output of method(h5file) for filename, only calling method at first request of the key.
+
+        :param str filename: path to NWB file
+        :param key: hashable identifier of the cached value
+        :param method: function that returns the value given open h5py.File
+        :return: value
+        """
+        cache = self._cache.setdefault(os.path.abspath(filename), {})
+        if not (key in cache):
+            cache[key] = method(self.h5file(filename))
+
+        return copy(cache[key])
+
+    def clear_cache(self, filename=None):
+        """Clears cached metadata for filename or for all files if filename is None.
+
+        :param str filename: path to NWB file
+        """
+        if filename is None:
+            self._cache = {}
+        else:
+            self._cache.pop(os.path.abspath(filename), None)
+
+    def close(self, filename=None):
+        """Closes filename or all files if filename is None and clears the cached metadata.
+
+        :param str filename: path to NWB file
+        """
+        keys = list(self._h5files.keys()) if filename is None else [os.path.abspath(filename)]
+        for key in keys:
+            h5file = self._h5files.pop(key, None)
+            if not (h5file is None):
+                h5file.close()
+            self._cache.pop(key, None)
+
+
+@contextmanager
+def session_or_temporary(session=None):
+    """Yields session or a new :py:class:`NWBFileSession` that is closed on exit, if session is None.
+
+    :param NWBFileSession session:
+    """
+    if session is None:
+        with NWBFileSession() as session:
+            yield session
+    else:
+        yield session
+
+
+@contextmanager
+def h5file_of_session(filename, mode='r', session=None):
+    """Yields h5py.File of the session or a new h5py.File that is closed on exit, if session is None.
+
+    Cached metadata of the session is cleared on exit if mode is not 'r'.
+
+    :param str filename: path to NWB file
+    :param str mode: h5py.File mode
+    :param NWBFileSession session:
+    """
+    if session is None:
+        with open_h5file(filename, mode) as h5file:
+            yield h5file
+    else:
+        try:
+            yield session.h5file(filename, mode)
+        finally:
+            if mode != 'r':
+                session.clear_cache(filename)
+
+
+def cached_h5file_query(filename, key, method, session=None):
+    """Returns the output of method(h5file), cached in the session if provided.
+
+    :param str filename: path to NWB file
+    :param key: hashable identifier of the value in session cache
+    :param method: function that returns the value given open h5py.File
+    :param NWBFileSession session:
+    """
+    if session is None:
+        with open_h5file(filename, 'r') as h5file:
+            return method(h5file)
+    else:
+        return session.cached(filename, key, method)
+
+
+def delete_path_in_file(filename, path, session=None):
+    with h5file_of_session(filename, 'r+', session) as h5file:
         del h5file[path]
 
 
-def get_recordingKey(filename):
-    with h5py.File(filename, 'r') as h5file:
-        return list(h5file['acquisition']['timeseries'].keys())[0]
+def get_recordingKey_in_h5file(h5file):
+    return list(h5file['acquisition']['timeseries'].keys())[0]
 
 
-def get_all_processorKeys(filename):
-    with h5py.File(filename, 'r') as h5file:
-        return list(h5file['acquisition']['timeseries'][get_recordingKey(filename)]['continuous'].keys())
+def get_all_processorKeys_in_h5file(h5file):
+    return list(h5file['acquisition']['timeseries'][get_recordingKey_in_h5file(h5file)]['continuous'].keys())
 
 
-def get_processorKey(filename):
-    return get_all_processorKeys(filename)[0]
+def get_recordingKey(filename, session=None):
+    return cached_h5file_query(filename, 'recordingKey', get_recordingKey_in_h5file, session)
 
 
-def get_all_processor_paths(filename):
-    return ['/acquisition/timeseries/' + get_recordingKey(filename)
-            + '/continuous/' + processorKey
-            for processorKey in get_all_processorKeys(filename)]
+def get_all_processorKeys(filename, session=None):
+    return cached_h5file_query(filename, 'processorKeys', get_all_processorKeys_in_h5file, session)
 
 
-def get_processor_path(filename):
-    return '/acquisition/timeseries/' + get_recordingKey(filename) \
-           + '/continuous/' + get_processorKey(filename)
+def get_processorKey(filename, session=None):
+    return get_all_processorKeys(filename, session=session)[0]
 
 
-def check_if_open_ephys_nwb_file(filename):
+def get_all_processor_paths(filename, session=None):
+    return cached_h5file_query(filename, 'processor_paths',
+                               lambda h5file: ['/acquisition/timeseries/' + get_recordingKey_in_h5file(h5file)
+                                               + '/continuous/' + processorKey
+                                               for processorKey in get_all_processorKeys_in_h5file(h5file)],
+                               session)
+
+
+def get_processor_path(filename, session=None):
+    return get_all_processor_paths(filename, session=session)[0]
+
+
+def check_if_open_ephys_nwb_file(filename, session=None):
     """
     Returns True if processor path can be identified
     in the file and False otherwise.
     """
     try:
-        processor_path = get_processor_path(filename)
-        with h5py.File(filename, 'r') as h5file:
-            return processor_path in h5file
+        with session_or_temporary(session) as session:
+            return check_if_path_exists(filename, get_processor_path(filename, session=session), session=session)
     except:
         return False
 
 
-def get_downsampled_data_paths(filename):
+def get_downsampled_data_paths(filename, session=None):
     """
     Returns paths to downsampled data in NWB file.
 
     :param filename: path to NWB file
     :type filename: str
+    :param NWBFileSession session: optional session to use
     :return: paths
     :rtype: dict
     """
-    processor_path = get_processor_path(filename)
+    processor_path = get_processor_path(filename, session=session)
     return {'tetrode_data': processor_path + '/downsampled_tetrode_data/',
             'aux_data': processor_path + '/downsampled_AUX_data/',
             'timestamps': processor_path + '/downsampled_timestamps/',
             'info': processor_path + '/downsampling_info/'}
 
 
-def check_if_downsampled_data_available(filename):
+def check_if_downsampled_data_available(filename, session=None):
     """
     Checks if downsampled data is available in the NWB file.
 
     :param filename: path to NWB file
     :type filename: str
+    :param NWBFileSession session: optional session to use
     :return: available
     :rtype: bool
     """
-    paths = get_downsampled_data_paths(filename)
-    with h5py.File(filename, 'r') as h5file:
+    with session_or_temporary(session) as session:
+        paths = get_downsampled_data_paths(filename, session=session)
         # START Workaround for older downsampled datasets
-        if '/acquisition/timeseries/recording1/continuous/processor102_100/tetrode_lowpass' in h5file:
+        if check_if_path_exists(filename, '/acquisition/timeseries/recording1/continuous/processor102_100/tetrode_lowpass',
+                                session=session):
             return True
         # END Workaround for older downsampled datasets
         for path in [paths[key] for key in paths]:
-            if not (path in h5file):
+            if not check_if_path_exists(filename, path, session=session):
                 return False
-        if h5file[paths['tetrode_data']].shape[0] == 0:
+        n_samples = {key: get_dataset_shape_and_dtype(filename, paths[key], session=session)[0][0]
+                     for key in ('tetrode_data', 'timestamps', 'aux_data')}
+        if n_samples['tetrode_data'] == 0:
             return False
-        if h5file[paths['tetrode_data']].shape[0] \
-                != h5file[paths['timestamps']].shape[0] \
-                != h5file[paths['aux_data']].shape[0]:
+        if n_samples['tetrode_data'] != n_samples['timestamps'] != n_samples['aux_data']:
             return False
 
     return True
 
 
-def get_raw_data_paths(filename):
+def get_raw_data_paths(filename, session=None):
     """
     Returns paths to downsampled data in NWB file.
 
     :param filename: path to NWB file
     :type filename: str
+    :param NWBFileSession session: optional session to use
     :return: paths
     :rtype: dict
     """
-    processor_path = get_processor_path(filename)
+    processor_path = get_processor_path(filename, session=session)
     return {'continuous': processor_path + '/data',
             'timestamps': processor_path + '/timestamps'}
 
 
-def check_if_raw_data_available(filename):
+def check_if_raw_data_available(filename, session=None):
     """
     Returns paths to raw data in NWB file.
 
     :param filename:
     :type filename: str
+    :param NWBFileSession session: optional session to use
     :return: paths
     :rtype: dict
     """
-    paths = get_raw_data_paths(filename)
-    if all([check_if_path_exists(filename, paths[key]) for key in paths]):
-        return True
-    else:
-        return False
+    with session_or_temporary(session) as session:
+        paths = get_raw_data_paths(filename, session=session)
+        if all([check_if_path_exists(filename, paths[key], session=session) for key in paths]):
+            return True
+        else:
+            return False
 
 
 def save_downsampling_info_to_disk(filename, info):
@@ -161,7 +355,7 @@ def save_downsampling_info_to_disk(filename, info):
             'downsampled_sampling_rate': np.int64(info['downsampled_sampling_rate']),
             'downsampled_channels': np.array(info['downsampled_channels'], dtype=np.int64)}
     # Write data to disk
-    with h5py.File(filename, 'r+') as h5file:
+    with open_h5file(filename, 'r+') as h5file:
         recursively_save_dict_contents_to_group(h5file, paths['info'], info)
 
 
@@ -170,48 +364,429 @@ def save_downsampled_data_to_disk(filename, tetrode_data, timestamps, aux_data,
     paths = get_downsampled_data_paths(filename)
     # Write data to disk
     save_downsampling_info_to_disk(filename, info)
-    with h5py.File(filename, 'r+') as h5file:
+    with open_h5file(filename, 'r+') as h5file:
         h5file[paths['tetrode_data']] = tetrode_data
         h5file[paths['timestamps']] = timestamps
         h5file[paths['aux_data']] = aux_data
 
 
-def delete_raw_data(filename, only_if_downsampled_data_available=True):
-    if only_if_downsampled_data_available:
-        if not check_if_downsampled_data_available(filename):
-            print('Warning', 'Downsampled data not available in NWB file. Raw data deletion aborted.')
-            return None
-    if not check_if_raw_data_available(filename):
-        print('Warning', 'Raw data not available to be deleted in: ' + filename)
-    else:
-        raw_data_paths = get_raw_data_paths(filename)
-        with h5py.File(filename,'r+') as h5file:
-            for path in [raw_data_paths[key] for key in raw_data_paths]:
-                del h5file[path]
+def delete_raw_data(filename, only_if_downsampled_data_available=True, session=None):
+    with session_or_temporary(session) as session:
+        if only_if_downsampled_data_available:
+            if not check_if_downsampled_data_available(filename, session=session):
+                print('Warning', 'Downsampled data not available in NWB file. Raw data deletion aborted.')
+                return None
+        if not check_if_raw_data_available(filename, session=session):
+            print('Warning', 'Raw data not available to be deleted in: ' + filename)
+        else:
+            raw_data_paths = get_raw_data_paths(filename, session=session)
+            with h5file_of_session(filename, 'r+', session) as h5file:
+                for path in [raw_data_paths[key] for key in raw_data_paths]:
+                    del h5file[path]
 
 
 def repack_NWB_file(filename, replace_original=True, check_validity_with_downsampled_data=True):
-    # Create a repacked copy of the file
-    os.system('h5repack ' + filename + ' ' + (filename + '.repacked'))
-    # Check that the new file is not corrupted
-    if check_validity_with_downsampled_data:
-        if not check_if_downsampled_data_available(filename):
-            raise Exception('Downsampled data cannot be found in repacked file. Original file not replaced.')
+    """
+    Creates a repacked copy of the NWB file with h5repack to reclaim unused space
+    and replaces the original file with it, if requested.
+
+    The copy is created at filename + '.repacked' and removed if h5repack or validity check fails.
+    The original file is replaced with os.replace, which is atomic if both are on the same file system.
+
+    :param str filename: path to NWB file
+    :param bool replace_original: if True (default), original file is replaced with the repacked copy
+    :param bool check_validity_with_downsampled_data: if True (default), repacked copy is checked
+        to contain downsampled data before replacing the original
+    """
+    repacked_filename = filename + '.repacked'
+    try:
+        # Create a repacked copy of the file
+        subprocess.check_call(['h5repack', filename, repacked_filename])
+        # Check that the new file is not corrupted
+        if check_validity_with_downsampled_data:
+            if not check_if_downsampled_data_available(repacked_filename):
+                raise Exception('Downsampled data cannot be found in repacked file. Original file not replaced.')
+    except BaseException:
+        if os.path.isfile(repacked_filename):
+            os.remove(repacked_filename)
+        raise
     # Replace original file with repacked file
     if replace_original:
-        os.system('mv ' + (filename + '.repacked') + ' ' + filename)
+        os.replace(repacked_filename, filename)
+
+
+class NWBRepackJournal(object):
+    """
+    On-disk journal of NWB files repacked by :py:func:`repack_all_nwb_files_in_directory_tree`.
+
+    Each state change of a file is appended to the journal as a line of JSON and flushed to disk,
+    so that the journal is valid up to the last completed state change if the process is interrupted.
+    A file is considered done if its last state is 'done' and its size and modification time
+    have not changed since.
+    """
+
+    def __init__(self, journal_filename):
+        """
+        :param str journal_filename: path to journal file, created if it does not exist
+        """
+        self.journal_filename = journal_filename
+        self._entries = {}
+        if os.path.isfile(journal_filename):
+            with open(journal_filename, 'r') as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Ignore a line left incomplete by an interrupted write
+                        continue
+                    self._entries[entry['filename']] = entry
+
+    @staticmethod
+    def file_state(filename):
+        return {'size': os.path.getsize(filename), 'mtime': os.path.getmtime(filename)}
+
+    def status(self, filename):
+        """
+        Returns the last recorded status of the file or None if not in journal.
+        """
+        entry = self._entries.get(os.path.abspath(filename), None)
+        return None if entry is None else entry['status']
+
+    def is_done(self, filename):
+        entry = self._entries.get(os.path.abspath(filename), None)
+        if entry is None or entry['status'] != 'done':
+            return False
 
+        return NWBRepackJournal.file_state(filename) == {'size': entry['size'], 'mtime': entry['mtime']}
 
-def repack_all_nwb_files_in_directory_tree(folder_path, replace_original=True,
-                                           check_validity_with_downsampled_data=True):
-    # Commence directory walk
+    def record(self, filename, status, message=None):
+        """
+        Appends the status and current size and modification time of the file to the journal.
+
+        :param str filename: path to NWB file
+        :param str status: 'started', 'done' or 'failed'
+        :param str message: optional message, e.g. error description
+        """
+        entry = {'filename': os.path.abspath(filename), 'status': status, 'time': time(), 'message': message}
+        entry.update(NWBRepackJournal.file_state(filename))
+        self._entries[entry['filename']] = entry
+        with open(self.journal_filename, 'a') as journal_file:
+            journal_file.write(json.dumps(entry) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+
+def repack_NWB_file_job(filename, replace_original=True, check_validity_with_downsampled_data=True,
+                        delete_raw=False, only_if_downsampled_data_available=True):
+    """
+    Deletes raw data from NWB file if requested and repacks it with :py:func:`repack_NWB_file`.
+
+    Both steps can be repeated on a file where this function was interrupted.
+    """
+    if delete_raw:
+        delete_raw_data(filename, only_if_downsampled_data_available=only_if_downsampled_data_available)
+    repack_NWB_file(filename, replace_original=replace_original,
+                    check_validity_with_downsampled_data=check_validity_with_downsampled_data)
+
+
+def list_nwb_files_in_directory_tree(folder_path, nwb_filename='experiment_1.nwb'):
+    filenames = []
     for dir_name, subdirList, fileList in os.walk(folder_path):
         for fname in fileList:
-            fpath = os.path.join(dir_name, fname)
-            if fname == 'experiment_1.nwb':
-                print('Repacking file {}'.format(fpath))
-                repack_NWB_file(fpath, replace_original=replace_original,
-                                check_validity_with_downsampled_data=check_validity_with_downsampled_data)
+            if fname == nwb_filename:
+                filenames.append(os.path.join(dir_name, fname))
+
+    return sorted(filenames)
+
+
+def repack_all_nwb_files_in_directory_tree(folder_path, replace_original=True,
+                                           check_validity_with_downsampled_data=True,
+                                           delete_raw=False, only_if_downsampled_data_available=True,
+                                           n_processes=1, io_budget=None, min_free_space=0,
+                                           journal_filename=None):
+    """
+    Repacks all NWB files in directory tree with :py:func:`repack_NWB_file_job`,
+    using n_processes parallel processes within disk I/O and free space budgets.
+
+    Progress is recorded in :py:class:`NWBRepackJournal` at journal_filename,
+    so that files completed in an interrupted run are skipped when the function is called again.
+    Files that were not completed are repacked again, as the original files are only replaced
+    after the repacked copy has been completed.
+
+    :param str folder_path: root of the directory tree
+    :param bool replace_original: see :py:func:`repack_NWB_file`
+    :param bool check_validity_with_downsampled_data: see :py:func:`repack_NWB_file`
+    :param bool delete_raw: if True, raw data is deleted from each file before repacking.
+        Default is False.
+    :param bool only_if_downsampled_data_available: see :py:func:`delete_raw_data`
+    :param int n_processes: maximum number of files processed at the same time
+    :param int io_budget: maximum total size in bytes of files processed at the same time.
+        A file larger than io_budget is processed when no other files are being processed.
+        If None (default), only n_processes limits parallel processing.
+    :param int min_free_space: bytes of free disk space to keep available in addition to the space
+        reserved for repacked copies of files being processed. Files that do not fit are skipped.
+    :param str journal_filename: path to journal file. Default is .nwb_repack_journal in folder_path.
+    :return: filenames of files that failed or were skipped
+    :rtype: list
+    """
+    if journal_filename is None:
+        journal_filename = os.path.join(folder_path, '.nwb_repack_journal')
+    journal = NWBRepackJournal(journal_filename)
+    pending = []
+    for filename in list_nwb_files_in_directory_tree(folder_path):
+        if journal.is_done(filename):
+            print('Skipping file already repacked {}'.format(filename))
+        else:
+            if journal.status(filename) == 'started':
+                print('Resuming interrupted repacking of file {}'.format(filename))
+            pending.append(filename)
+    job_kwargs = {'replace_original': replace_original,
+                  'check_validity_with_downsampled_data': check_validity_with_downsampled_data,
+                  'delete_raw': delete_raw,
+                  'only_if_downsampled_data_available': only_if_downsampled_data_available}
+    completed = Queue()
+    running = {}
+    unsuccessful = []
+    pool = Pool(n_processes)
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            # Start as many pending files as fit into budgets
+            for filename in list(pending):
+                if len(running) >= n_processes:
+                    break
+                size = os.path.getsize(filename)
+                if not (io_budget is None) and len(running) > 0 and sum(running.values()) + size > io_budget:
+                    continue
+                free_space = shutil.disk_usage(os.path.dirname(filename)).free - sum(running.values())
+                if free_space - size < min_free_space:
+                    if len(running) == 0:
+                        print('Warning', 'Not enough free space to repack file {}'.format(filename))
+                        pending.remove(filename)
+                        unsuccessful.append(filename)
+                    continue
+                print('Repacking file {}'.format(filename))
+                journal.record(filename, 'started')
+                pending.remove(filename)
+                running[filename] = size
+                pool.apply_async(repack_NWB_file_job, (filename,), job_kwargs,
+                                 callback=lambda _, filename=filename: completed.put((filename, None)),
+                                 error_callback=lambda error, filename=filename: completed.put((filename, error)))
+            if len(running) == 0:
+                continue
+            # Wait for any of the running files to finish
+            filename, error = completed.get()
+            del running[filename]
+            if error is None:
+                journal.record(filename, 'done')
+            else:
+                print('Warning', 'Repacking failed for file {}: {}'.format(filename, error))
+                journal.record(filename, 'failed', message=str(error))
+                unsuccessful.append(filename)
+    except BaseException:
+        # Repacked copies left incomplete are overwritten when repacking is resumed
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+    return unsuccessful
+
+
+def get_relayout_dataset_paths(filename, session=None):
+    """
+    Returns paths to continuous data datasets available in NWB file, that are rewritten by
+    :py:func:`relayout_NWB_file`: raw data and timestamps, downsampled tetrode data and timestamps.
+
+    :param str filename: path to NWB file
+    :param NWBFileSession session: optional session to use
+    :return: paths
+    :rtype: list
+    """
+    with session_or_temporary(session) as session:
+        raw_data_paths = get_raw_data_paths(filename, session=session)
+        downsampled_data_paths = get_downsampled_data_paths(filename, session=session)
+        paths = [raw_data_paths['continuous'], raw_data_paths['timestamps'],
+                 downsampled_data_paths['tetrode_data'].rstrip('/'), downsampled_data_paths['timestamps'].rstrip('/')]
+        return [path for path in paths if check_if_path_exists(filename, path, session=session)]
+
+
+def get_compression_kwargs(compression):
+    """
+    Returns h5py.Group.create_dataset keyword arguments for compression option.
+
+    :param compression: None for no compression, 'lzf' or 'gzip' (shuffle filter and gzip level 1)
+    :return: kwargs
+    :rtype: dict
+    """
+    if compression is None:
+        return {}
+    elif compression == 'lzf':
+        return {'compression': 'lzf'}
+    elif compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': 1, 'shuffle': True}
+    else:
+        raise ValueError('Unknown compression option ' + str(compression))
+
+
+def get_relayout_chunk_shape(shape, chunk_samples, channels_per_chunk):
+    """
+    Returns chunk shape of (time x channel group) for dataset shape, or None if dataset is empty.
+    """
+    if 0 in shape:
+        return None
+    chunk_shape = (min(chunk_samples, shape[0]),)
+    if len(shape) > 1:
+        chunk_shape += (min(channels_per_chunk, shape[1]),) + tuple(shape[2:])
+
+    return chunk_shape
+
+
+def copy_dataset_in_blocks(dataset, dst_group, name, chunk_shape, compression_kwargs, block_size=2 ** 26):
+    """
+    Copies h5py.Dataset to dst_group with new chunk shape and compression,
+    reading and writing blocks of rows aligned to chunk boundaries.
+
+    :param h5py.Dataset dataset: source dataset
+    :param h5py.Group dst_group: group to create the new dataset in
+    :param str name: name of the new dataset in dst_group
+    :param tuple chunk_shape: chunk shape of the new dataset, or None for contiguous layout
+    :param dict compression_kwargs: output from :py:func:`get_compression_kwargs`
+    :param int block_size: approximate size of blocks in bytes
+    """
+    if chunk_shape is None:
+        dst_dataset = dst_group.create_dataset(name, shape=dataset.shape, dtype=dataset.dtype)
+    else:
+        dst_dataset = dst_group.create_dataset(name, shape=dataset.shape, dtype=dataset.dtype,
+                                               chunks=chunk_shape, **compression_kwargs)
+    for key, value in dataset.attrs.items():
+        dst_dataset.attrs[key] = value
+    if chunk_shape is None:
+        return
+    row_size = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+    rows_per_block = max(1, block_size // (row_size * chunk_shape[0])) * chunk_shape[0]
+    for first_row in range(0, dataset.shape[0], rows_per_block):
+        last_row = min(first_row + rows_per_block, dataset.shape[0])
+        dst_dataset[first_row:last_row] = dataset[first_row:last_row]
+
+
+def copy_group_with_relayout(src_group, dst_group, relayout_kwargs, block_size=2 ** 26):
+    """
+    Recursively copies the contents and attributes of src_group to dst_group.
+    Datasets with names (full paths) in relayout_kwargs are copied with :py:func:`copy_dataset_in_blocks`
+    with the chunk_shape and compression_kwargs in relayout_kwargs[name]. Other datasets are copied as they are.
+
+    :param h5py.Group src_group:
+    :param h5py.Group dst_group:
+    :param dict relayout_kwargs:
+    :param int block_size: approximate size of blocks in bytes
+    """
+    for key, value in src_group.attrs.items():
+        dst_group.attrs[key] = value
+    for key in src_group:
+        link = src_group.get(key, getlink=True)
+        if isinstance(link, (h5py.SoftLink, h5py.ExternalLink)):
+            dst_group[key] = link
+            continue
+        item = src_group[key]
+        if isinstance(item, h5py.Group):
+            copy_group_with_relayout(item, dst_group.create_group(key), relayout_kwargs, block_size=block_size)
+        elif item.name in relayout_kwargs:
+            copy_dataset_in_blocks(item, dst_group, key, block_size=block_size, **relayout_kwargs[item.name])
+        else:
+            src_group.copy(item, dst_group, name=key)
+
+
+def relayout_NWB_file(filename, output_filename=None, chunk_samples=16384, channels_per_chunk=4,
+                      compression=None, block_size=2 ** 26, verbose=True):
+    """
+    Rewrites NWB file with continuous data datasets (see :py:func:`get_relayout_dataset_paths`)
+    in chunks of chunk_samples x channels_per_chunk, in a single streaming pass.
+
+    With channels_per_chunk=4, reading the data of a single tetrode only touches the chunks
+    of that tetrode, while reading a time window touches only the chunks overlapping it.
+    As the file is rewritten, unused space in the original file is also reclaimed as with :py:func:`repack_NWB_file`.
+
+    :param str filename: path to NWB file
+    :param str output_filename: path to output file. If None (default), original file is replaced
+        with a copy created at filename + '.relayout', which is removed if copying fails.
+    :param int chunk_samples: number of samples (rows) in each chunk
+    :param int channels_per_chunk: number of channels (columns) in each chunk of 2 dimensional datasets
+    :param compression: compression option for :py:func:`get_compression_kwargs`
+    :param int block_size: approximate size of blocks of rows read and written at a time, in bytes
+    :param bool verbose: if True (default), prints the new layout of each dataset
+    """
+    replace_original = output_filename is None
+    if replace_original:
+        output_filename = filename + '.relayout'
+    compression_kwargs = get_compression_kwargs(compression)
+    with open_h5file(filename, 'r') as src_h5file:
+        relayout_kwargs = {}
+        for path in get_relayout_dataset_paths(filename):
+            dataset = src_h5file[path]
+            chunk_shape = get_relayout_chunk_shape(dataset.shape, chunk_samples, channels_per_chunk)
+            relayout_kwargs[dataset.name] = {'chunk_shape': chunk_shape, 'compression_kwargs': compression_kwargs}
+            if verbose:
+                print('Relayout {} of shape {} from chunks {} to {} with compression {}'.format(
+                    dataset.name, dataset.shape, dataset.chunks, chunk_shape, compression))
+        try:
+            with open_h5file(output_filename, 'w') as dst_h5file:
+                copy_group_with_relayout(src_h5file, dst_h5file, relayout_kwargs, block_size=block_size)
+        except BaseException:
+            if replace_original and os.path.isfile(output_filename):
+                os.remove(output_filename)
+            raise
+    if replace_original:
+        os.replace(output_filename, filename)
+
+
+def measure_read_throughput(filename, path, access_pattern, n_reads=10, channels_per_group=4,
+                            tetrode_slice_samples=30000 * 60, time_slice_samples=30000, seed=0):
+    """
+    Returns the read throughput of a dataset in MB/s for an access pattern with random reads:
+        'tetrode' - tetrode_slice_samples of channels_per_group adjacent channels
+        'time' - time_slice_samples of all channels
+
+    The same reads are made with the same seed, to compare files with different layouts.
+    Note that the results include the effect of any file system caching of the file.
+
+    :param str filename: path to NWB file
+    :param str path: path to dataset in NWB file
+    :param str access_pattern: 'tetrode' or 'time'
+    :param int n_reads: number of random reads
+    :param int channels_per_group: number of channels in a tetrode
+    :param int tetrode_slice_samples: number of samples in each tetrode read
+    :param int time_slice_samples: number of samples in each time read
+    :param int seed: seed for random positions of reads
+    :return: throughput
+    :rtype: float
+    """
+    random_state = np.random.RandomState(seed)
+    with open_h5file(filename, 'r') as h5file:
+        dataset = h5file[path]
+        n_samples = dataset.shape[0]
+        n_channels = dataset.shape[1] if len(dataset.shape) > 1 else 1
+        n_bytes = 0
+        start_time = time()
+        for _ in range(n_reads):
+            if access_pattern == 'tetrode':
+                n_read_samples = min(tetrode_slice_samples, n_samples)
+                first_sample = random_state.randint(0, n_samples - n_read_samples + 1)
+                first_channel = random_state.randint(0, max(1, n_channels // channels_per_group)) * channels_per_group
+                if len(dataset.shape) > 1:
+                    data = dataset[first_sample:first_sample + n_read_samples,
+                                   first_channel:first_channel + channels_per_group]
+                else:
+                    data = dataset[first_sample:first_sample + n_read_samples]
+            elif access_pattern == 'time':
+                n_read_samples = min(time_slice_samples, n_samples)
+                first_sample = random_state.randint(0, n_samples - n_read_samples + 1)
+                data = dataset[first_sample:first_sample + n_read_samples]
+            else:
+                raise ValueError('Unknown access_pattern ' + str(access_pattern))
+            n_bytes += data.nbytes
+        duration = time() - start_time
+
+    return n_bytes / 10 ** 6 / duration
 
 
 def list_AUX_channels(filename, n_tetrodes):
@@ -225,7 +800,7 @@ def list_AUX_channels(filename, n_tetrodes):
 
 def load_continuous(filename):
     # Load data file
-    h5file = h5py.File(filename, 'r')
+    h5file = open_h5file(filename, 'r')
     # Load timestamps and continuous data
     recordingKey = get_recordingKey(filename)
     processorKey = get_processorKey(filename)
@@ -248,25 +823,51 @@ def load_raw_data_timestamps_as_array(filename):
     return timestamps
 
 
+def load_raw_data_timestamps_at_indices(filename, indices, chunk_duration=10.0, session=None):
+    """
+    Returns raw data timestamps at sample indices, in the order of indices, as float64 array.
+    Timestamps are read in chunks of chunk_duration seconds and only chunks containing
+    any of the indices are read, instead of loading all timestamps into memory.
+
+    filename - str - full path to NWB file
+    indices  - numpy.ndarray - sample indices of raw continuous data
+    session  - NWBFileSession - optional session to use
+    """
+    indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+    output = np.zeros(indices.size, dtype=np.float64)
+    if indices.size == 0:
+        return output
+    order = np.argsort(indices, kind='stable')
+    sorted_indices = indices[order]
+    chunk_size = int(round(chunk_duration * OpenEphys_SamplingRate()))
+    paths = get_raw_data_paths(filename, session=session)
+    with h5file_of_session(filename, 'r', session) as h5file:
+        timestamps = h5file[paths['timestamps']]
+        first_chunk_start = sorted_indices[0] - sorted_indices[0] % chunk_size
+        for chunk_start in range(first_chunk_start, sorted_indices[-1] + 1, chunk_size):
+            first, last = np.searchsorted(sorted_indices, [chunk_start, chunk_start + chunk_size], side='left')
+            if last > first:
+                chunk = np.array(timestamps[chunk_start:chunk_start + chunk_size]).reshape(-1)
+                output[order[first:last]] = chunk[sorted_indices[first:last] - chunk_start]
+
+    return output
+
+
 def load_data_columns_as_array(filename, data_path, first_column, last_column):
     """
     Loads a contiguous columns of dataset efficiently from HDF5 dataset.
     """
-    with h5py.File(filename, 'r') as h5file:
+    with open_h5file(filename, 'r') as h5file:
         data = h5file[data_path]
         data = h5file[data_path][:, first_column:last_column]
 
     return data
 
 
-def load_data_as_array(filename, data_path, columns):
+def check_columns_argument(columns):
     """
-    Fast way of reading a single column or a set of columns.
-    
-    filename - str - full path to file
-    columns  - list - column numbers to include (starting from 0).
-               Single column can be given as a single list element or int.
-               Columns in the list must be in sorted (ascending) order.
+    Returns columns argument as a list of int values in sorted (ascending) order.
+    Raises ValueError if columns is not a sorted list of int values or an int.
     """
     # Make columns variable into a list if int given
     if isinstance(columns, int):
@@ -281,10 +882,17 @@ def load_data_as_array(filename, data_path, columns):
     # Check that column number are sorted
     if sorted(columns) != columns:
         raise ValueError('columns was not in sorted (ascending) order.')
-    # Check that data is available, otherwise return None
-    if not check_if_path_exists(filename, data_path):
-        raise ValueError('File ' + filename + '\n'
-                         + 'Does not contain path ' + data_path)
+
+    return columns
+
+
+def get_contiguous_column_ranges(columns):
+    """
+    Returns a list of (first_column, last_column) tuples for contiguous groups in columns,
+    where last_column is not inclusive, as in python slicing.
+
+    columns - list - column numbers in sorted (ascending) order.
+    """
     # Find contiguous column groups
     current_column = columns[0]
     column_groups = [current_column]
@@ -299,18 +907,51 @@ def load_data_as_array(filename, data_path, columns):
     for first_channel in sorted(set(column_groups)):
         last_channel = first_channel + column_groups.count(first_channel)
         column_ranges.append((first_channel, last_channel))
-    # Get contiguous column segments for each group
-    column_group_data = []
-    for column_range in column_ranges:
-        column_group_data.append(
-            load_data_columns_as_array(filename, data_path, *column_range))
-    # Concatenate column groups
-    data = np.concatenate(column_group_data, axis=1)
+
+    return column_ranges
+
+
+def load_column_ranges_from_dataset(dataset, column_ranges, first_row=None, last_row=None):
+    """
+    Returns an array of contiguous column ranges concatenated along second axis.
+
+    dataset       - h5py.Dataset - two dimensional dataset in an open h5py.File
+    column_ranges - list - (first_column, last_column) tuples as returned by get_contiguous_column_ranges
+    first_row     - int - first row to load. Default is first row of dataset.
+    last_row      - int - last row to load (not inclusive). Default is last row of dataset.
+    """
+    column_group_data = [dataset[first_row:last_row, first_column:last_column]
+                         for first_column, last_column in column_ranges]
+    if len(column_group_data) == 1:
+        return column_group_data[0]
+    else:
+        return np.concatenate(column_group_data, axis=1)
+
+
+def load_data_as_array(filename, data_path, columns, session=None):
+    """
+    Fast way of reading a single column or a set of columns.
+    
+    filename - str - full path to file
+    columns  - list - column numbers to include (starting from 0).
+               Single column can be given as a single list element or int.
+               Columns in the list must be in sorted (ascending) order.
+    session  - NWBFileSession - optional session to use
+    """
+    columns = check_columns_argument(columns)
+    with session_or_temporary(session) as session:
+        # Check that data is available, otherwise return None
+        if not check_if_path_exists(filename, data_path, session=session):
+            raise ValueError('File ' + filename + '\n'
+                             + 'Does not contain path ' + data_path)
+        # Get contiguous column segments for each group and concatenate them
+        column_ranges = get_contiguous_column_ranges(columns)
+        data = load_column_ranges_from_dataset(session.h5file(filename)[data_path], column_ranges)
 
     return data
 
 
-def load_continuous_as_array(filename, channels):
+def load_continuous_as_array(filename, channels, session=None):
     """
     Fast way of reading a single channel or a set of channels.
     
@@ -318,28 +959,176 @@ def load_continuous_as_array(filename, channels):
     channels - list - channel numbers to include (starting from 0).
                Single channel can be given as a single list element or int.
                Channels in the list must be in sorted (ascending) order.
-    """
-    # Generate path to raw continuous data
-    root_path = '/acquisition/timeseries/' + get_recordingKey(filename) \
-                + '/continuous/' + get_processorKey(filename)
-    data_path = root_path + '/data'
-    timestamps_path = root_path + '/timestamps'
-    # Check that data is available, otherwise return None
-    if not check_if_path_exists(filename, data_path):
-        return None
-    if not check_if_path_exists(filename, timestamps_path):
-        return None
-    # Load continuous data
-    continuous = load_data_as_array(filename, data_path, channels)
-    # Load timestamps for data
-    with h5py.File(filename, 'r') as h5file:
-        timestamps = np.array(h5file[timestamps_path])
+    session  - NWBFileSession - optional session to use
+    """
+    with session_or_temporary(session) as session:
+        # Generate path to raw continuous data
+        paths = get_raw_data_paths(filename, session=session)
+        data_path = paths['continuous']
+        timestamps_path = paths['timestamps']
+        # Check that data is available, otherwise return None
+        if not check_if_path_exists(filename, data_path, session=session):
+            return None
+        if not check_if_path_exists(filename, timestamps_path, session=session):
+            return None
+        # Load continuous data
+        continuous = load_data_as_array(filename, data_path, channels, session=session)
+        # Load timestamps for data
+        timestamps = np.array(session.h5file(filename)[timestamps_path])
     # Arrange output into a dictionary
     data = {'continuous': continuous, 'timestamps': timestamps}
 
     return data
 
 
+def iterate_continuous_as_array_chunks(filename, channels, chunk_duration=10.0,
+                                       first_sample=0, last_sample=None, session=None):
+    """
+    Generator yielding consecutive chunks of raw continuous data for a set of channels.
+
+    Only a single chunk is in memory at any time and the NWB file is kept open
+    for the whole pass, until the generator is exhausted or closed.
+
+    filename       - str - full path to file
+    channels       - list - channel numbers to include (starting from 0).
+                     Single channel can be given as a single list element or int.
+                     Channels in the list must be in sorted (ascending) order.
+    chunk_duration - float - duration of each chunk in seconds (default is 10).
+                     The final chunk may be shorter.
+    first_sample   - int - first sample to start reading from (default is 0)
+    last_sample    - int - sample to stop reading at (not inclusive). Default is end of data.
+    session        - NWBFileSession - optional session to use
+
+    Yields dict with elements:
+        'continuous'   - numpy.ndarray - shape (n_samples, n_channels), not converted to microvolts
+        'timestamps'   - numpy.ndarray - shape (n_samples,)
+        'first_sample' - int - position of first sample of the chunk in the full dataset
+
+    If raw data is not available in the file, nothing is yielded.
+    """
+    channels = check_columns_argument(channels)
+    column_ranges = get_contiguous_column_ranges(channels)
+    chunk_size = int(round(chunk_duration * OpenEphys_SamplingRate()))
+    if chunk_size < 1:
+        raise ValueError('chunk_duration must cover at least one sample.')
+    paths = get_raw_data_paths(filename, session=session)
+    with h5file_of_session(filename, 'r', session) as h5file:
+        if not (paths['continuous'] in h5file and paths['timestamps'] in h5file):
+            return
+        continuous = h5file[paths['continuous']]
+        timestamps = h5file[paths['timestamps']]
+        n_samples = continuous.shape[0] if last_sample is None else min(last_sample, continuous.shape[0])
+        for chunk_start in range(first_sample, n_samples, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, n_samples)
+            yield {'continuous': load_column_ranges_from_dataset(continuous, column_ranges,
+                                                                 chunk_start, chunk_end),
+                   'timestamps': np.array(timestamps[chunk_start:chunk_end]).reshape(-1),
+                   'first_sample': chunk_start}
+
+
+def compute_binary_export_reference(data, columns, reference_columns, referencing_method, channels):
+    """
+    Returns reference array of shape (n_samples, len(columns)) to subtract from data[:, columns],
+    computed as in Processing.ContinuousDataPreloader.referenced_continuous.
+
+    data               - numpy.ndarray - shape (n_samples, n_channels)
+    columns            - list - columns in data of exported channels
+    reference_columns  - list - columns in data of reference channels
+    referencing_method - str - 'all_channels' or 'other_channels'
+    channels           - list - channel numbers of columns in data
+    """
+    reference_data = data[:, reference_columns]
+    if referencing_method == 'all_channels':
+        reference_array = np.mean(reference_data, axis=1).astype(np.int16)
+        return np.repeat(reference_array[:, None], len(columns), axis=1)
+    elif referencing_method == 'other_channels':
+        reference_sum = np.sum(reference_data, axis=1)
+        reference_tetrodes = np.array([channels_tetrode(channels[column]) for column in reference_columns])
+        tetrode_references = {}
+        for tetrode_nr in set(channels_tetrode(channels[column]) for column in columns):
+            other_sum = reference_sum - np.sum(reference_data[:, reference_tetrodes == tetrode_nr], axis=1)
+            tetrode_references[tetrode_nr] = np.int16(other_sum.astype(np.float64)
+                                                      / np.float64(len(reference_columns)))
+        return np.stack([tetrode_references[channels_tetrode(channels[column])] for column in columns], axis=1)
+    else:
+        raise ValueError('Unknown referencing_method ' + str(referencing_method))
+
+
+def export_continuous_to_binary_file(filename, output_filename, channels, referencing_method=None,
+                                     reference_channels=None, zero_bad_channels=True, append=False,
+                                     chunk_duration=10.0, session=None):
+    """
+    Writes raw continuous data of channels into a flat binary file of int16 values in (samples x channels) order,
+    as used by KiloSort and other spike sorters and viewers. Data is read from the NWB file in chunks,
+    such that only a single chunk of data is in memory at any time.
+
+    filename           - str - full path to NWB file
+    output_filename    - str - full path to output binary file, e.g. with .dat extension
+    channels           - list - channel numbers (starting from 0) in the order of columns in the output file.
+                         Channels do not need to be in sorted order.
+    referencing_method - None (default), 'all_channels' or 'other_channels' - referencing applied to the data,
+                         as with Processing.ContinuousDataPreloader.
+                         'all_channels' subtracts the mean of reference_channels (common average referencing).
+                         'other_channels' subtracts the sum of reference_channels that are not on the same tetrode
+                         as the channel, divided by the number of reference_channels.
+    reference_channels - list - channels used for referencing. Default is channels.
+    zero_bad_channels  - bool - if True (default), bad channels listed in the NWB file are set to 0
+                         before referencing and in the output.
+    append             - bool - if True, data is appended to existing output_filename. Default is False.
+    chunk_duration     - float - duration of data in seconds processed at a time (default is 10).
+    session            - NWBFileSession - optional session to use
+
+    Returns tuple (n_samples, n_channels) of data written to output_filename.
+    Use :py:func:`load_binary_file_as_memmap` to access the output file.
+    """
+    channels = list(channels)
+    reference_channels = channels if reference_channels is None else list(reference_channels)
+    file_channels = sorted(set(channels) | (set() if referencing_method is None else set(reference_channels)))
+    columns = [file_channels.index(channel) for channel in channels]
+    reference_columns = [file_channels.index(channel) for channel in reference_channels]
+    n_samples = 0
+    with session_or_temporary(session) as session:
+        if zero_bad_channels:
+            badChan = listBadChannels(filename, session=session)
+            bad_columns = [file_channels.index(channel) for channel in file_channels if channel in badChan]
+            bad_output_columns = [i for i, channel in enumerate(channels) if channel in badChan]
+        with open(output_filename, 'ab' if append else 'wb') as output_file:
+            for chunk in iterate_continuous_as_array_chunks(filename, file_channels, chunk_duration=chunk_duration,
+                                                            session=session):
+                data = chunk['continuous'].astype(np.int16)
+                if zero_bad_channels:
+                    data[:, bad_columns] = 0
+                output = data[:, columns]
+                if not (referencing_method is None):
+                    output = output - compute_binary_export_reference(data, columns, reference_columns,
+                                                                      referencing_method, file_channels)
+                    if zero_bad_channels:
+                        output[:, bad_output_columns] = 0
+                np.ascontiguousarray(output, dtype=np.int16).tofile(output_file)
+                n_samples += output.shape[0]
+
+    return n_samples, len(channels)
+
+
+def load_binary_file_as_memmap(filename, n_channels, dtype=np.int16, mode='r'):
+    """
+    Returns a numpy.memmap of shape (n_samples, n_channels) of a flat binary file
+    written by :py:func:`export_continuous_to_binary_file`, without loading the data into memory.
+
+    filename   - str - full path to binary file
+    n_channels - int - number of channels in the file
+    dtype      - numpy dtype of values in the file (default is numpy.int16)
+    mode       - str - numpy.memmap mode (default is 'r' for read-only)
+    """
+    n_values = os.path.getsize(filename) // np.dtype(dtype).itemsize
+    if n_values % n_channels != 0:
+        raise ValueError('Size of file ' + filename + ' does not match ' + str(n_channels) + ' channels.')
+    if n_values == 0:
+        return np.zeros((0, n_channels), dtype=dtype)
+
+    return np.memmap(filename, dtype=dtype, mode=mode, shape=(n_values // n_channels, n_channels))
+
+
 def remove_surrounding_binary_markers(text):
     if text.startswith("b'"):
         text = text[2:]
@@ -354,7 +1143,7 @@ def get_downsampling_info_old(filename):
                 + '/continuous/' + get_processorKey(filename)
     data_path = root_path + '/downsampling_info'
     # Load info from file
-    with h5py.File(filename, 'r') as h5file:
+    with open_h5file(filename, 'r') as h5file:
         data = h5file[data_path]
         data = [str(i) for i in data]
     # Remove b'x' markers from strings if present. Python 3 change.
@@ -373,15 +1162,13 @@ def get_downsampling_info_old(filename):
     return info_dict
 
 
-def get_downsampling_info(filename):
-    root_path = '/acquisition/timeseries/' + get_recordingKey(filename) \
-                + '/continuous/' + get_processorKey(filename)
-    data_path = root_path + '/downsampling_info/'
-    with h5py.File(filename, 'r') as h5file:
-        return recursively_load_dict_contents_from_group(h5file, data_path)
+def get_downsampling_info(filename, session=None):
+    with session_or_temporary(session) as session:
+        data_path = get_downsampled_data_paths(filename, session=session)['info']
+        return recursively_load_dict_contents_from_group(session.h5file(filename), data_path)
 
 
-def load_downsampled_tetrode_data_as_array(filename, tetrode_nrs):
+def load_downsampled_tetrode_data_as_array(filename, tetrode_nrs, session=None):
     """
     Returns a dict with downsampled continuous data for requested tetrodes
     
@@ -390,19 +1177,24 @@ def load_downsampled_tetrode_data_as_array(filename, tetrode_nrs):
                                 Single tetrode can be given as a single list element or int.
                                 Tetrode numbers in the list must be in sorted (ascending) order.
                                 If data is not available for a given tetrode number, error is raised.
+    session                     - NWBFileSession - optional session to use
     """
+    with session_or_temporary(session) as session:
+        return _load_downsampled_tetrode_data_as_array(filename, tetrode_nrs, session)
+
+
+def _load_downsampled_tetrode_data_as_array(filename, tetrode_nrs, session):
     # Generate path to raw continuous data
-    root_path = '/acquisition/timeseries/' + get_recordingKey(filename) \
-                + '/continuous/' + get_processorKey(filename)
+    root_path = get_processor_path(filename, session=session)
     data_path = root_path + '/downsampled_tetrode_data'
     timestamps_path = root_path + '/downsampled_timestamps'
     # Check that data is available, otherwise return None
-    if not check_if_path_exists(filename, data_path):
+    if not check_if_path_exists(filename, data_path, session=session):
         return None
-    if not check_if_path_exists(filename, timestamps_path):
+    if not check_if_path_exists(filename, timestamps_path, session=session):
         return None
     # Get info on downsampled data
-    info = get_downsampling_info(filename)
+    info = get_downsampling_info(filename, session=session)
     sampling_rate = int(info['downsampled_sampling_rate'])
     downsampled_channels = list(info['downsampled_channels'])
     # Map tetrode_nrs elements to columns in downsampled_tetrode_data
@@ -421,10 +1213,9 @@ def load_downsampled_tetrode_data_as_array(filename, tetrode_nrs):
         raise Exception('The following tetrodes were not represented in downsampled data\n' \
                         + ','.join(list(map(str, tetrode_nrs_remaining))))
     # Load continuous data
-    continuous = load_data_as_array(filename, data_path, columns)
+    continuous = load_data_as_array(filename, data_path, columns, session=session)
     # Load timestamps for data
-    with h5py.File(filename, 'r') as h5file:
-        timestamps = np.array(h5file[timestamps_path])
+    timestamps = np.array(session.h5file(filename)[timestamps_path])
     # Arrange output into a dictionary
     data = {'continuous': continuous, 'timestamps': timestamps,
             'tetrode_nrs': tetrode_nrs, 'channels': channels_used,
@@ -443,13 +1234,15 @@ def empty_spike_data():
     return {'waveforms': waveforms, 'timestamps': timestamps}
 
 
-def get_tetrode_nrs_if_spikes_available(filename, spike_name='spikes'):
+def get_tetrode_nrs_if_spikes_available(filename, spike_name='spikes', only_with_spikes=False, session=None):
     """
     Returns a list of tetrode numbers if spikes available in NWB file.
+
+    If only_with_spikes is True, tetrodes with no spikes are excluded, based on :py:func:`count_spikes`.
     """
-    spikes_path = '/acquisition/timeseries/' + get_recordingKey(filename) + '/' + spike_name + '/'
+    spikes_path = '/acquisition/timeseries/' + get_recordingKey(filename, session=session) + '/' + spike_name + '/'
     # Get tetrode keys if available
-    with h5py.File(filename, 'r') as h5file:
+    with h5file_of_session(filename, 'r', session) as h5file:
         if not (spikes_path in h5file):
             # Return empty list if spikes data not available
             return []
@@ -463,16 +1256,124 @@ def get_tetrode_nrs_if_spikes_available(filename, spike_name='spikes'):
         tetrode_nrs.append(int(tetrode_key[9:]) - 1)
     # Sort tetrode numbers in ascending order
     tetrode_nrs.sort()
+    # Exclude tetrodes with no spikes if requested
+    if only_with_spikes:
+        count = count_spikes(filename, tetrode_nrs, spike_name=spike_name, session=session)
+        tetrode_nrs = [tetrode_nr for tetrode_nr, n_spikes in zip(tetrode_nrs, count) if n_spikes > 0]
 
     return tetrode_nrs
 
 
-def construct_paths_to_tetrode_spike_data(filename, tetrode_nrs, spike_name='spikes'):
-    spikes_path = '/acquisition/timeseries/' + get_recordingKey(filename) + '/' + spike_name + '/'
+def construct_paths_to_tetrode_spike_data(filename, tetrode_nrs, spike_name='spikes', session=None):
+    spikes_path = '/acquisition/timeseries/' + get_recordingKey(filename, session=session) + '/' + spike_name + '/'
     return [(spikes_path + 'electrode' + str(tetrode_nr + 1) + '/') for tetrode_nr in tetrode_nrs]
 
 
-def count_spikes(filename, tetrode_nrs, spike_name='spikes', use_idx_keep=False):
+def compute_spike_index(timestamps, bin_duration=1.0):
+    """
+    Returns the spike index of a tetrode as stored by :py:func:`save_spikes`.
+
+    bin_offsets[k] is the position of the first spike with timestamp >= first_timestamp + k * bin_duration,
+    with the last element equal to the number of spikes. bin_offsets is empty if timestamps are not sorted.
+
+    :param numpy.ndarray timestamps: spike timestamps
+    :param float bin_duration: duration of time bins in seconds
+    :return: bin_offsets, attributes (count, first_timestamp, last_timestamp, bin_duration)
+    :rtype: numpy.ndarray, dict
+    """
+    timestamps = np.atleast_1d(np.float64(timestamps))
+    attributes = {'count': np.int64(timestamps.size), 'bin_duration': np.float64(bin_duration)}
+    if timestamps.size == 0:
+        attributes['first_timestamp'] = np.float64(np.nan)
+        attributes['last_timestamp'] = np.float64(np.nan)
+        return np.zeros(1, dtype=np.int64), attributes
+    attributes['first_timestamp'] = np.float64(np.min(timestamps))
+    attributes['last_timestamp'] = np.float64(np.max(timestamps))
+    if np.any(np.diff(timestamps) < 0):
+        return np.zeros(0, dtype=np.int64), attributes
+    n_bins = int((attributes['last_timestamp'] - attributes['first_timestamp']) // bin_duration) + 1
+    bin_edges = attributes['first_timestamp'] + np.arange(n_bins + 1) * bin_duration
+    bin_offsets = np.searchsorted(timestamps, bin_edges, side='left').astype(np.int64)
+    bin_offsets[-1] = timestamps.size
+
+    return bin_offsets, attributes
+
+
+def save_spike_index(h5file, tetrode_path, timestamps, bin_duration=1.0):
+    """
+    Writes spike index from :py:func:`compute_spike_index` to tetrode_path + 'spike_index' dataset
+    with bin_offsets as data and other values as attributes.
+    """
+    bin_offsets, attributes = compute_spike_index(timestamps, bin_duration=bin_duration)
+    path = tetrode_path + 'spike_index'
+    if path in h5file:
+        del h5file[path]
+    h5file[path] = bin_offsets
+    for key, value in attributes.items():
+        h5file[path].attrs[key] = value
+
+
+def load_spike_index(h5file, tetrode_path, load_bin_offsets=True):
+    """
+    Returns spike index written by :py:func:`save_spike_index` as a dictionary or None if not available.
+    """
+    path = tetrode_path + 'spike_index'
+    if not (path in h5file):
+        return None
+    spike_index = {key: value for key, value in h5file[path].attrs.items()}
+    if load_bin_offsets:
+        spike_index['bin_offsets'] = h5file[path][()]
+
+    return spike_index
+
+
+def get_spike_rows_in_time_window(h5file, tetrode_path, time_window):
+    """
+    Returns the rows of spikes with time_window[0] <= timestamp < time_window[1] in tetrode spike data.
+
+    The rows are found using the spike index, if available, only reading timestamps in time bins
+    overlapping the time window. Otherwise all timestamps are read.
+
+    :return: rows - slice if spikes are sorted by timestamps, boolean mask otherwise
+    """
+    start_time, end_time = time_window
+    timestamps_dataset = h5file[tetrode_path + 'timestamps/']
+    spike_index = load_spike_index(h5file, tetrode_path)
+    if not (spike_index is None) and spike_index['bin_offsets'].size > 0:
+        bin_offsets = spike_index['bin_offsets']
+        if spike_index['count'] == 0:
+            return slice(0, 0)
+        n_bins = bin_offsets.size - 1
+        # Bins are extended by one on both sides to allow for rounding errors at bin edges
+        first_bin = int(np.clip((start_time - spike_index['first_timestamp']) // spike_index['bin_duration'] - 1,
+                                0, n_bins - 1))
+        last_bin = int(np.clip((end_time - spike_index['first_timestamp']) // spike_index['bin_duration'] + 1,
+                               0, n_bins - 1))
+        first_row = bin_offsets[first_bin]
+        last_row = bin_offsets[last_bin + 1]
+        timestamps = read_spike_rows(timestamps_dataset, slice(first_row, last_row))
+    else:
+        first_row = 0
+        timestamps = read_spike_rows(timestamps_dataset, slice(None))
+        if np.any(np.diff(timestamps) < 0):
+            return (timestamps >= start_time) & (timestamps < end_time)
+
+    return slice(first_row + np.searchsorted(timestamps, start_time, side='left'),
+                 first_row + np.searchsorted(timestamps, end_time, side='left'))
+
+
+def read_spike_rows(dataset, rows):
+    """
+    Returns rows of dataset as numpy array, given as slice or boolean mask from :py:func:`get_spike_rows_in_time_window`
+    """
+    if isinstance(rows, slice) and len(dataset.shape) > 0:
+        return dataset[rows]
+    else:
+        # Boolean mask or scalar dataset, as created for a single spike by save_spikes
+        return np.atleast_1d(dataset[()])[rows]
+
+
+def count_spikes(filename, tetrode_nrs, spike_name='spikes', use_idx_keep=False, session=None):
     """
     :param filename: full path to NWB file
     :type filename: str
@@ -480,25 +1381,35 @@ def count_spikes(filename, tetrode_nrs, spike_name='spikes', use_idx_keep=False)
     :type tetrode_nrs: list
     :param spike_name: type of spikes to look for (field in NWB file)
     :type spike_name: str
-    :param use_idx_keep: If False (default) all spikes are counted, otherwise only filtered spikes are counted
+    :param use_idx_keep: If False (default) all spikes are counted using spike index if available,
+        otherwise only filtered spikes are counted
     :type use_idx_keep: bool
+    :param session: optional session to use
+    :type session: NWBFileSession
     :return: total number of spikes on each tetrode
     :rtype: list
     """
-    tetrode_paths = construct_paths_to_tetrode_spike_data(filename, tetrode_nrs, spike_name=spike_name)
     count = []
-    with h5py.File(filename, 'r') as h5file:
+    with session_or_temporary(session) as session:
+        tetrode_paths = construct_paths_to_tetrode_spike_data(filename, tetrode_nrs, spike_name=spike_name,
+                                                              session=session)
+        h5file = session.h5file(filename)
         for tetrode_path in tetrode_paths:
             if use_idx_keep:
                 count.append(sum(np.array(h5file[tetrode_path + 'idx_keep'][()]).squeeze()))
+                continue
+            spike_index = load_spike_index(h5file, tetrode_path, load_bin_offsets=False)
+            if spike_index is None:
+                count.append(h5file[tetrode_path + 'timestamps/'].size)
             else:
-                count.append(h5file[tetrode_path + 'timestamps/'].shape[0])
+                count.append(int(spike_index['count']))
 
     return count
 
 
 def load_spikes(filename, spike_name='spikes', tetrode_nrs=None, use_idx_keep=False,
-                use_badChan=False, no_waveforms=False, clustering_name=None, verbose=True):
+                use_badChan=False, no_waveforms=False, clustering_name=None, verbose=True, time_window=None,
+                concatenate=False, session=None):
     """
     Inputs:
         filename - pointer to NWB file to load
@@ -509,6 +1420,11 @@ def load_spikes(filename, spike_name='spikes', tetrode_nrs=None, use_idx_keep=Fa
         clustering_name [str] - if specified, clusterID will be loaded from:
                               electrode[nr]/clustering/clustering_name
         verbose [bool]        - prints out loading progress bar if True (default)
+        time_window [tuple]   - if specified as (start, end), only spikes with start <= timestamp < end
+                                are loaded, using spike index to only read the spikes in the window.
+        concatenate [bool]    - if True, output is a single dictionary of all tetrodes,
+                                see :py:func:`concatenate_tetrode_spike_data`. Default is False.
+        session [NWBFileSession] - optional session to use
     Output:
         List of dictionaries for each tetrode in correct order where:
         List is empty, if no spike data detected
@@ -519,88 +1435,169 @@ def load_spikes(filename, spike_name='spikes', tetrode_nrs=None, use_idx_keep=Fa
             that are to be used for further processing (based on filtering for artifacts etc)
         'clusterIDs' is the cluster identities of spikes in 'waveforms'['idx_keep',:,:]
     """
-    # If not provided, get tetrode_nrs
-    if tetrode_nrs is None:
-        tetrode_nrs = get_tetrode_nrs_if_spikes_available(filename, spike_name=spike_name)
-    tetrode_paths = construct_paths_to_tetrode_spike_data(filename, tetrode_nrs, spike_name=spike_name)
-    with h5py.File(filename, 'r') as h5file:
-        # Put waveforms and timestamps into a list of dictionaries in correct order
-        data = []
+    with session_or_temporary(session) as session:
+        # If not provided, get tetrode_nrs
+        if tetrode_nrs is None:
+            tetrode_nrs = get_tetrode_nrs_if_spikes_available(filename, spike_name=spike_name, session=session)
+        # Resolve paths and bad channels for all tetrodes before loading
+        tetrode_paths = construct_paths_to_tetrode_spike_data(filename, tetrode_nrs, spike_name=spike_name,
+                                                              session=session)
+        bad_channels = listBadChannels(filename, session=session) if use_badChan and not no_waveforms else []
+        # Read all tetrodes through the same file handle
+        tet_datas = []
         if verbose:
             print('Loading tetrodes from {}'.format(filename))
+        h5file = session.h5file(filename)
         iterable = zip(tetrode_nrs, tetrode_paths)
         for nr_tetrode, tetrode_path in (tqdm(iterable, total=len(tetrode_nrs)) if verbose else iterable):
-            # Load waveforms and timestamps
-            if no_waveforms:
-                waveforms = empty_spike_data()['waveforms']
-            else:
-                waveforms = h5file[tetrode_path + 'data/'][()]
-            timestamps = h5file[tetrode_path + 'timestamps/'][()]
-            if not isinstance(timestamps, np.ndarray):
-                timestamps = np.array([timestamps])
-            if waveforms.shape[0] == 0:
-                # If no waveforms are available, enter one waveform of zeros at timepoint zero
-                waveforms = empty_spike_data()['waveforms']
-                timestamps = empty_spike_data()['timestamps']
-            # Arrange waveforms, timestamps and nr_tetrode into a dictionary
-            tet_data = {'waveforms': waveforms,
-                        'timestamps': timestamps,
-                        'nr_tetrode': nr_tetrode}
-            # Include idx_keep if available
-            idx_keep_path = tetrode_path + 'idx_keep'
-            if idx_keep_path in h5file:
-                tet_data['idx_keep'] = np.array(h5file[idx_keep_path][()])
-                if use_idx_keep:
-                    # If requested, filter wavefoms and timestamps based on idx_keep
-                    if np.sum(tet_data['idx_keep']) == 0:
-                        tet_data['waveforms'] = empty_spike_data()['waveforms']
-                        tet_data['timestamps'] = empty_spike_data()['timestamps']
-                    else:
-                        if not no_waveforms:
-                            tet_data['waveforms'] = tet_data['waveforms'][tet_data['idx_keep'], :, :]
-                        tet_data['timestamps'] = tet_data['timestamps'][tet_data['idx_keep']]
-            # Include clusterIDs if available
-            if clustering_name is None:
-                clusterIDs_path = tetrode_path + 'clusterIDs'
-            else:
-                clusterIDs_path = tetrode_path + '/clustering/' + clustering_name
-            if clusterIDs_path in h5file:
-                tet_data['clusterIDs'] = np.int16(h5file[clusterIDs_path][()]).squeeze()
+            tet_data = read_tetrode_spike_data(h5file, tetrode_path, no_waveforms=no_waveforms,
+                                               clustering_name=clustering_name, time_window=time_window)
+            tet_data['nr_tetrode'] = nr_tetrode
             # Set spikes to zeros for channels in badChan list if requested
-            if use_badChan and not no_waveforms:
-                badChan = listBadChannels(filename)
-                if len(badChan) > 0:
-                    for nchan in tetrode_channels(nr_tetrode):
-                        if nchan in badChan:
-                            tet_data['waveforms'][:, np.mod(nchan, 4), :] = 0
-            data.append(tet_data)
-        
-        return data
-
-def save_spikes(filename, tetrode_nr, data, timestamps, spike_name='spikes', overwrite=False):
-    """
-    Stores spike data in NWB file in the same format as with OpenEphysGUI.
+            bad_columns = [np.mod(nchan, 4) for nchan in tetrode_channels(nr_tetrode) if nchan in bad_channels]
+            if len(bad_columns) > 0:
+                tet_data['waveforms'][:, bad_columns, :] = 0
+            tet_datas.append(tet_data)
+
+    if concatenate:
+        return concatenate_tetrode_spike_data(tet_datas, use_idx_keep=use_idx_keep)
+    else:
+        return [format_tetrode_spike_data(tet_data, use_idx_keep=use_idx_keep) for tet_data in tet_datas]
+
+
+def read_tetrode_spike_data(h5file, tetrode_path, no_waveforms=False, clustering_name=None, time_window=None):
+    """
+    Returns a dictionary with all spike data of a tetrode in open NWB file, as stored in the file.
+
+    'waveforms' is None if no_waveforms is True.
+    'idx_keep' and 'clusterIDs' are included if available.
+    See :py:func:`load_spikes` for description of the arguments.
+    """
+    if time_window is None:
+        rows = slice(None)
+    else:
+        rows = get_spike_rows_in_time_window(h5file, tetrode_path, time_window)
+    tet_data = {'waveforms': None if no_waveforms else read_spike_rows(h5file[tetrode_path + 'data/'], rows),
+                'timestamps': read_spike_rows(h5file[tetrode_path + 'timestamps/'], rows)}
+    # Include idx_keep if available
+    idx_keep_path = tetrode_path + 'idx_keep'
+    if idx_keep_path in h5file:
+        idx_keep = np.array(h5file[idx_keep_path][()])
+        tet_data['idx_keep'] = idx_keep[rows]
+    # Include clusterIDs if available
+    if clustering_name is None:
+        clusterIDs_path = tetrode_path + 'clusterIDs'
+    else:
+        clusterIDs_path = tetrode_path + '/clustering/' + clustering_name
+    if clusterIDs_path in h5file:
+        clusterIDs = np.int16(h5file[clusterIDs_path][()]).squeeze()
+        if not (time_window is None):
+            # clusterIDs are either for all spikes or for spikes in idx_keep
+            n_spikes = h5file[tetrode_path + 'timestamps/'].size
+            if clusterIDs.size == n_spikes or not (idx_keep_path in h5file):
+                clusterIDs = clusterIDs[rows]
+            else:
+                in_time_window = np.zeros(n_spikes, dtype=bool)
+                in_time_window[rows] = True
+                clusterIDs = clusterIDs[in_time_window[idx_keep]]
+        tet_data['clusterIDs'] = clusterIDs
+
+    return tet_data
+
+
+def format_tetrode_spike_data(tet_data, use_idx_keep=False):
+    """
+    Returns output of :py:func:`read_tetrode_spike_data` in the format of elements of :py:func:`load_spikes` output.
+
+    Tetrodes without spikes are given a waveform of zeros at timepoint zero
+    and waveforms are replaced with such waveform if no_waveforms was True.
+    """
+    no_waveforms = tet_data['waveforms'] is None
+    tet_data = copy(tet_data)
+    if no_waveforms:
+        tet_data['waveforms'] = empty_spike_data()['waveforms']
+    if tet_data['waveforms'].shape[0] == 0:
+        # If no waveforms are available, enter one waveform of zeros at timepoint zero
+        tet_data['waveforms'] = empty_spike_data()['waveforms']
+        tet_data['timestamps'] = empty_spike_data()['timestamps']
+    if use_idx_keep and 'idx_keep' in tet_data:
+        # If requested, filter wavefoms and timestamps based on idx_keep
+        if np.sum(tet_data['idx_keep']) == 0:
+            tet_data['waveforms'] = empty_spike_data()['waveforms']
+            tet_data['timestamps'] = empty_spike_data()['timestamps']
+        else:
+            if not no_waveforms:
+                tet_data['waveforms'] = tet_data['waveforms'][tet_data['idx_keep'], :, :]
+            tet_data['timestamps'] = tet_data['timestamps'][tet_data['idx_keep']]
+
+    return tet_data
+
+
+def concatenate_tetrode_spike_data(tet_datas, use_idx_keep=False):
+    """
+    Returns outputs of :py:func:`read_tetrode_spike_data` for multiple tetrodes concatenated
+    into a single dictionary with elements:
+        'tetrode_nrs' - numpy.ndarray of tetrode numbers
+        'offsets' - numpy.ndarray of length len(tetrode_nrs) + 1, where spikes of tetrode_nrs[i]
+            are at offsets[i]:offsets[i + 1] in 'waveforms', 'timestamps' and 'idx_keep'
+        'waveforms' - numpy.ndarray (spikes x channels x samples), unless no_waveforms was True
+        'timestamps' - numpy.ndarray of spike timestamps
+        'idx_keep' - only if available for all tetrodes
+        'clusterIDs' and 'clusterIDs_offsets' - only if available for all tetrodes,
+            with offsets for each tetrode as for other elements
+
+    Unlike in :py:func:`load_spikes` list output, tetrodes without spikes have no elements.
+    If use_idx_keep is True, spikes are filtered based on idx_keep where available.
+    """
+    keys = ['timestamps']
+    if len(tet_datas) > 0 and not (tet_datas[0]['waveforms'] is None):
+        keys.append('waveforms')
+    if len(tet_datas) > 0 and all(['idx_keep' in tet_data for tet_data in tet_datas]):
+        keys.append('idx_keep')
+    parts = {key: [] for key in keys}
+    for tet_data in tet_datas:
+        idx_keep = tet_data['idx_keep'] if use_idx_keep and 'idx_keep' in tet_data else None
+        for key in keys:
+            parts[key].append(tet_data[key] if idx_keep is None else tet_data[key][idx_keep])
+    data = {'tetrode_nrs': np.array([tet_data['nr_tetrode'] for tet_data in tet_datas], dtype=np.int64),
+            'offsets': np.cumsum([0] + [part.shape[0] for part in parts['timestamps']]).astype(np.int64)}
+    for key in keys:
+        if len(parts[key]) > 0:
+            data[key] = np.concatenate(parts[key], axis=0)
+        else:
+            data[key] = empty_spike_data()[key][:0]
+    if len(tet_datas) > 0 and all(['clusterIDs' in tet_data for tet_data in tet_datas]):
+        clusterIDs = [np.atleast_1d(tet_data['clusterIDs']) for tet_data in tet_datas]
+        data['clusterIDs'] = np.concatenate(clusterIDs)
+        data['clusterIDs_offsets'] = np.cumsum([0] + [x.size for x in clusterIDs]).astype(np.int64)
+
+    return data
+
+
+def save_spikes(filename, tetrode_nr, data, timestamps, spike_name='spikes', overwrite=False, session=None):
+    """
+    Stores spike data in NWB file in the same format as with OpenEphysGUI,
+    with spike index from :py:func:`save_spike_index`.
     tetrode_nr=0 for first tetrode.
     """
     if data.dtype != np.int16:
         raise ValueError('Waveforms are not int16.')
     if timestamps.dtype != np.float64:
         raise ValueError('Timestamps are not float64.')
-    recordingKey = get_recordingKey(filename)
-    path = '/acquisition/timeseries/' + get_recordingKey(filename) + '/' + spike_name + '/' + \
+    path = '/acquisition/timeseries/' + get_recordingKey(filename, session=session) + '/' + spike_name + '/' + \
            'electrode' + str(tetrode_nr + 1) + '/'
-    if check_if_path_exists(filename, path):
-        if overwrite:
-            # If overwrite is true, path is first cleared
-            with h5py.File(filename, 'r+') as h5file:
+    with h5file_of_session(filename, 'r+', session) as h5file:
+        if path in h5file:
+            if overwrite:
+                # If overwrite is true, path is first cleared
                 del h5file[path]
-        else:
-            raise Exception('Spikes already in file and overwrite not requested.\n' \
-                            + 'File: ' + filename + '\n' \
-                            + 'path: ' + path)
-    with h5py.File(filename, 'r+') as h5file:
+            else:
+                raise Exception('Spikes already in file and overwrite not requested.\n' \
+                                + 'File: ' + filename + '\n' \
+                                + 'path: ' + path)
         h5file[path + 'data'] = data
         h5file[path + 'timestamps'] = np.float64(timestamps).squeeze()
+        save_spike_index(h5file, path, timestamps)
 
 def processing_method_and_spike_name_combinations():
     """
@@ -617,14 +1614,14 @@ def get_spike_name_for_processing_method(processing_method):
 
     return spike_name
 
-def load_events(filename):
+def load_events(filename, session=None):
     # Outputs a dictionary timestamps and eventIDs for TTL signals received
     # timestamps are in seconds, aligned to timestamps of continuous recording
     # eventIDs indicate TTL channel number (starting from 1) and are positive for rising signals
 
     # Load data file
-    recordingKey = get_recordingKey(filename)
-    with h5py.File(filename, 'r') as h5file:
+    recordingKey = get_recordingKey(filename, session=session)
+    with h5file_of_session(filename, 'r', session) as h5file:
         # Load timestamps and TLL signal info
         timestamps = h5file['acquisition']['timeseries'][recordingKey]['events']['ttl1']['timestamps'][()]
         eventID = h5file['acquisition']['timeseries'][recordingKey]['events']['ttl1']['data'][()]
@@ -632,15 +1629,15 @@ def load_events(filename):
 
     return data
 
-def load_GlobalClock_timestamps(filename, GlobalClock_TTL_channel=1):
+def load_GlobalClock_timestamps(filename, GlobalClock_TTL_channel=1, session=None):
     """
     Returns timestamps of GlobalClock TTL pulses.
     """
-    data = load_events(filename)
+    data = load_events(filename, session=session)
     return data['timestamps'][data['eventID'] == GlobalClock_TTL_channel]
 
 
-def load_network_events(filename):
+def load_network_events(filename, session=None):
     """returns network_events_data
 
     Extracts the list of network messages from NWB file 
@@ -653,12 +1650,14 @@ def load_network_events(filename):
 
     :param filename: full path to NWB file
     :type filename: str
+    :param session: optional session to use
+    :type session: NWBFileSession
     :return: network_events_data
     :rtype: dict
     """
     # Load data file
-    recordingKey = get_recordingKey(filename)
-    with h5py.File(filename, 'r') as h5file:
+    recordingKey = get_recordingKey(filename, session=session)
+    with h5file_of_session(filename, 'r', session) as h5file:
         # Load timestamps and messages
         timestamps = h5file['acquisition']['timeseries'][recordingKey]['events']['text1']['timestamps'][()]
         messages = h5file['acquisition']['timeseries'][recordingKey]['events']['text1']['data'][()]
@@ -670,12 +1669,19 @@ def load_network_events(filename):
     return data
 
 
-def check_if_path_exists(filename, path):
-    with h5py.File(filename, 'r') as h5file:
-        return path in h5file
+def check_if_path_exists(filename, path, session=None):
+    return cached_h5file_query(filename, ('path_exists', path), lambda h5file: path in h5file, session=session)
+
+
+def get_dataset_shape_and_dtype(filename, path, session=None):
+    """
+    Returns the shape and dtype of dataset at path without loading the data.
+    """
+    return cached_h5file_query(filename, ('dataset_shape_and_dtype', path),
+                               lambda h5file: (h5file[path].shape, h5file[path].dtype), session=session)
 
 
-def save_list_of_dicts_to_group(h5file, path, dlist, overwrite=False, list_suffix='_NWBLIST'):
+def save_list_of_dicts_to_group(h5file, path, dlist, overwrite=False, list_suffix='_NWBLIST', compact=False):
     # Check that all elements are dictionaries
     for dic in dlist:
         if not isinstance(dic, dict):
@@ -683,10 +1689,185 @@ def save_list_of_dicts_to_group(h5file, path, dlist, overwrite=False, list_suffi
     # Write elements to file
     for i, dic in enumerate(dlist):
         recursively_save_dict_contents_to_group(h5file, (path + str(i) + '/'), dic,
-                                                overwrite=overwrite, list_suffix=list_suffix)
+                                                overwrite=overwrite, list_suffix=list_suffix, compact=compact)
 
 
-def recursively_save_dict_contents_to_group(h5file, path, dic, overwrite=False, list_suffix='_NWBLIST', verbose=False):
+def is_compact_dict_content(item):
+    """
+    Returns True if item can be stored with :py:func:`save_compact_dict_contents`,
+    that is if item does not contain numpy arrays with more than 0 dimensions.
+    """
+    if isinstance(item, np.ndarray):
+        return item.ndim == 0
+    elif isinstance(item, dict):
+        return all(is_compact_dict_content(value) for value in item.values())
+    elif isinstance(item, list):
+        return all(is_compact_dict_content(value) for value in item)
+    else:
+        return True
+
+
+def convert_to_compact_dict_content(item):
+    """
+    Returns item with elements converted to the types that the same elements would have
+    when saved and loaded with :py:func:`recursively_save_dict_contents_to_group` without compact option.
+
+    None is converted to empty dictionary, as None is saved as an empty group without compact option,
+    so that None values load as empty dictionary in both forms.
+    """
+    if item is None:
+        return {}
+    elif isinstance(item, dict):
+        return {str(key): convert_to_compact_dict_content(value) for key, value in item.items()}
+    elif isinstance(item, list):
+        return [convert_to_compact_dict_content(value) for value in item]
+    elif isinstance(item, (bool, np.bool_)):
+        return np.array(bool(item))
+    elif isinstance(item, (int, float)):
+        return np.array(item)[()]
+    elif isinstance(item, np.ndarray) and item.ndim == 0:
+        return convert_to_compact_dict_content(item[()])
+    elif isinstance(item, bytes):
+        return convert_bytes_to_string(item)
+    elif isinstance(item, str):
+        return str(item)
+    else:
+        return item
+
+
+def load_compact_dict_contents(h5file, path):
+    """
+    Returns dictionary stored with :py:func:`save_compact_dict_contents` in group at path,
+    or empty dictionary if group has no compact contents.
+    """
+    if not (path + COMPACT_DICT_DATASET_NAME in h5file):
+        return {}
+    return from_json_compatible(json.loads(convert_bytes_to_string(h5file[path + COMPACT_DICT_DATASET_NAME][()])))
+
+
+def save_compact_dict_contents(h5file, path, dic, overwrite=False, list_suffix='_NWBLIST'):
+    """
+    Stores dictionary elements in a single JSON-encoded string dataset in group at path.
+    Elements are merged with those already stored in compact form in the group.
+
+    h5file - h5py.File
+    path   - str       - path to group in h5file. Must end with '/'
+    dic    - dict      - elements must fulfill :py:func:`is_compact_dict_content`
+    overwrite - bool   - if True, elements already existing in the group are replaced.
+                         Default is False, if elements already exist in NWB file, error is raised.
+    """
+    contents = load_compact_dict_contents(h5file, path)
+    existing_paths = [existing_path for key in dic for existing_path in (path + key, path + key + list_suffix)
+                      if existing_path in h5file]
+    if len(existing_paths) > 0 and not overwrite:
+        raise ValueError('Cannot save to ' + existing_paths[0] + ' as it already exists')
+    try:
+        merge_compact_dict_contents(contents, convert_to_compact_dict_content(dic), path, overwrite)
+        encoded_contents = json.dumps(to_json_compatible(contents))
+    except TypeError as e:
+        raise ValueError('Cannot save elements of ' + path + ' in compact form: ' + str(e))
+    # Existing elements are only removed once the new contents have been encoded successfully
+    for existing_path in existing_paths:
+        del h5file[existing_path]
+    if path + COMPACT_DICT_DATASET_NAME in h5file:
+        del h5file[path + COMPACT_DICT_DATASET_NAME]
+    h5file.create_dataset(path + COMPACT_DICT_DATASET_NAME, data=encoded_contents, dtype=h5py.string_dtype())
+
+
+def merge_compact_dict_contents(contents, dic, path, overwrite=False):
+    """
+    Updates contents with elements of dic, merging nested dictionaries as is done with groups
+    by :py:func:`recursively_save_dict_contents_to_group`.
+
+    Raises ValueError if an element other than a dictionary already exists and overwrite is False.
+    """
+    for key, item in dic.items():
+        if key in contents and isinstance(contents[key], dict) and isinstance(item, dict) and len(item) > 0:
+            merge_compact_dict_contents(contents[key], item, path + key + '/', overwrite=overwrite)
+        elif key in contents and not overwrite:
+            raise ValueError('Cannot save to ' + path + key + ' as it already exists')
+        else:
+            contents[key] = item
+
+
+def nest_dict_in_group_with_compact_contents(h5file, path, dic):
+    """
+    Returns path of the group and dic nested in dictionaries, such that saving the output
+    with :py:func:`recursively_save_dict_contents_to_group` merges dic with the element
+    at path inside compact contents of a parent group.
+    If path does not point into compact contents of a group, path and dic are returned unchanged.
+    """
+    group_path, nested_dic = path, dic
+    while group_path != '/' and not (group_path in h5file):
+        group_path, key = group_path[:-1].rsplit('/', 1)
+        group_path, nested_dic = group_path + '/', {key: nested_dic}
+    if group_path != path and list(nested_dic.keys())[0] in load_compact_dict_contents(h5file, group_path):
+        return group_path, nested_dic
+    else:
+        return path, dic
+
+
+def remove_from_compact_dict_contents(h5file, path, keys, overwrite=False):
+    """
+    Removes elements with keys from compact contents of group at path, if overwrite is True.
+    Otherwise raises ValueError if any of the keys are in compact contents.
+    """
+    contents = load_compact_dict_contents(h5file, path)
+    if not any(key in contents for key in keys):
+        return
+    if not overwrite:
+        raise ValueError('Cannot save to ' + path + ' as elements ' + str(list(keys)) + ' already exist')
+    for key in keys:
+        contents.pop(key, None)
+    del h5file[path + COMPACT_DICT_DATASET_NAME]
+    h5file.create_dataset(path + COMPACT_DICT_DATASET_NAME, data=json.dumps(to_json_compatible(contents)),
+                          dtype=h5py.string_dtype())
+
+
+def find_in_compact_dict_contents(h5file, path):
+    """
+    Returns value stored in compact contents of a parent group of path and True,
+    or None and False if path does not point into compact contents of any group.
+    """
+    keys = [key for key in path.split('/') if len(key) > 0]
+    for n_group_keys in range(len(keys) - 1, -1, -1):
+        group_path = '/' + ''.join(key + '/' for key in keys[:n_group_keys])
+        if not (group_path in h5file):
+            continue
+        if not isinstance(h5file[group_path], h5py.Group):
+            return None, False
+        value = load_compact_dict_contents(h5file, group_path)
+        for key in keys[n_group_keys:]:
+            if not (isinstance(value, dict) and key in value):
+                return None, False
+            value = value[key]
+        return value, True
+
+    return None, False
+
+
+def check_if_dict_contents_path_exists(h5file, path):
+    """
+    Returns True if path exists in h5file as group or dataset or inside compact contents of a group.
+    """
+    return path in h5file or find_in_compact_dict_contents(h5file, path)[1]
+
+
+def ignore_compact_dict_contents(value, ignore):
+    """
+    Returns value with dictionaries at keys matching any element of ignore replaced with None.
+    """
+    if isinstance(value, dict):
+        return {key: None if key in ignore and isinstance(item, dict)
+                else ignore_compact_dict_contents(item, ignore) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [ignore_compact_dict_contents(item, ignore) for item in value]
+    else:
+        return value
+
+
+def recursively_save_dict_contents_to_group(h5file, path, dic, overwrite=False, list_suffix='_NWBLIST', verbose=False,
+                                            compact=False):
     """
     h5file - h5py.File
     path   - str       - path to group in h5file. Must end with '/'
@@ -695,10 +1876,16 @@ def recursively_save_dict_contents_to_group(h5file, path, dic, overwrite=False,
     list_suffix - str  - suffix used to highlight paths created from lists of dictionaries.
                          Must be consistent when saving and loading data.
     verbose - bool     - If True (default is False), h5file path used is printed for each recursion
+    compact - bool     - If True (default is False), all elements of the dictionary that do not contain
+                         numpy arrays with more than 0 dimensions are stored in a single JSON-encoded
+                         dataset in the group, instead of a separate dataset or group for each element.
+                         See :py:func:`save_compact_dict_contents`.
 
     Only works with: numpy arrays, numpy int64 or float64, strings, bytes, lists of strings and dictionaries these are contained in.
     Also works with lists dictionaries as part of the hierachy.
-    Long lists of dictionaries are discouraged, as individual groups are created for each element.
+    Long lists of dictionaries are discouraged, as individual groups are created for each element,
+    unless compact is True, in which case lists and dictionaries without arrays are stored as a single dataset.
+    With compact option, lists of numbers and None values are also supported.
     """
     if verbose:
         print(path)
@@ -706,6 +1893,15 @@ def recursively_save_dict_contents_to_group(h5file, path, dic, overwrite=False,
         if path in h5file:
             del h5file[path]
         h5file.create_group(path)
+    if compact:
+        # Dictionaries are merged into existing groups, as without compact option
+        compact_items = {key: item for key, item in dic.items() if is_compact_dict_content(item)
+                         and not (isinstance(item, dict) and isinstance(h5file.get(path + key), h5py.Group))}
+        dic = {key: item for key, item in dic.items() if not (key in compact_items)}
+        if len(compact_items) > 0:
+            save_compact_dict_contents(h5file, path, compact_items, overwrite=overwrite, list_suffix=list_suffix)
+        if len(dic) > 0 and path in h5file:
+            remove_from_compact_dict_contents(h5file, path, dic.keys(), overwrite=overwrite)
     for key, item in dic.items():
         if isinstance(item, (int, float)):
             item = np.array(item)
@@ -717,7 +1913,7 @@ def recursively_save_dict_contents_to_group(h5file, path, dic, overwrite=False,
         elif isinstance(item, dict):
             recursively_save_dict_contents_to_group(h5file, path + key + '/', item,
                                                     overwrite=overwrite, list_suffix=list_suffix,
-                                                    verbose=verbose)
+                                                    verbose=verbose, compact=compact)
         elif isinstance(item, list):
             if all(isinstance(i, str) for i in item):
                 if overwrite:
@@ -730,7 +1926,7 @@ def recursively_save_dict_contents_to_group(h5file, path, dic, overwrite=False,
                     if path + key + list_suffix in h5file:
                         del h5file[path + key + list_suffix]
                 save_list_of_dicts_to_group(h5file, path + key + list_suffix + '/', item, 
-                                            overwrite=overwrite, list_suffix=list_suffix)
+                                            overwrite=overwrite, list_suffix=list_suffix, compact=compact)
         elif item is None:
             h5file.create_group(path + key)
         else:
@@ -755,6 +1951,48 @@ def convert_bytes_to_string(b):
         return b
 
 
+def to_json_compatible(value):
+    """
+    Returns value converted to a structure that can be encoded with json and converted back
+    to the original value with :py:func:`from_json_compatible`, preserving numpy arrays and scalars.
+
+    Works with the data structures returned by :py:func:`recursively_load_dict_contents_from_group`:
+    dictionaries, lists, strings, numbers, booleans, None and numpy arrays and scalars
+    of numeric or boolean dtype.
+
+    :raises TypeError: if value contains elements that are not supported
+    """
+    if isinstance(value, dict):
+        return {str(key): to_json_compatible(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [to_json_compatible(item) for item in value]
+    elif isinstance(value, (np.ndarray, np.generic)):
+        array = np.asarray(value)
+        if not (array.dtype.kind in 'biuf'):
+            raise TypeError('Cannot convert numpy dtype {} to json compatible'.format(array.dtype))
+        return {'__numpy__': array.tolist(), 'dtype': array.dtype.str, 'shape': list(array.shape),
+                'scalar': isinstance(value, np.generic)}
+    elif value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    else:
+        raise TypeError('Cannot convert {} to json compatible'.format(type(value)))
+
+
+def from_json_compatible(value):
+    """
+    Returns the original value of output from :py:func:`to_json_compatible`
+    """
+    if isinstance(value, dict):
+        if '__numpy__' in value:
+            array = np.array(value['__numpy__'], dtype=np.dtype(value['dtype'])).reshape(value['shape'])
+            return array[()] if value['scalar'] else array
+        return {key: from_json_compatible(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [from_json_compatible(item) for item in value]
+    else:
+        return value
+
+
 def load_list_of_dicts_from_group(h5file, path, list_suffix='_NWBLIST', ignore=()):
     # Load all elements on this path
     items = []
@@ -774,6 +2012,9 @@ def recursively_load_dict_contents_from_group(h5file, path, list_suffix='_NWBLIS
     """
     Returns value at path if it has no further items
 
+    Elements saved in compact form with :py:func:`save_compact_dict_contents` are included
+    and path can also point to an element inside compact contents of a group.
+
     h5file - h5py.File
     path   - str       - path to group in h5file. Must end with '/'
     list_suffix - str  - suffix used to highlight paths created from lists of dictionaries.
@@ -783,6 +2024,12 @@ def recursively_load_dict_contents_from_group(h5file, path, list_suffix='_NWBLIS
     if not path.endswith('/'):
         raise ValueError('Input path must end with "/"')
 
+    if not (path in h5file):
+        value, found = find_in_compact_dict_contents(h5file, path)
+        if not found:
+            raise KeyError('Path ' + path + ' not found in ' + h5file.filename)
+        return ignore_compact_dict_contents(value, ignore)
+
     if path.split('/')[-2] in ignore or path.split('/')[-2][:-len(list_suffix)] in ignore:
         ans = None
 
@@ -791,10 +2038,13 @@ def recursively_load_dict_contents_from_group(h5file, path, list_suffix='_NWBLIS
                                             ignore=ignore)
     elif hasattr(h5file[path], 'items'):
 
-        ans = {}
+        ans = ignore_compact_dict_contents(load_compact_dict_contents(h5file, path), ignore)
         for key, item in h5file[path].items():
 
-            if key.endswith(list_suffix):
+            if key == COMPACT_DICT_DATASET_NAME:
+                continue
+
+            elif key.endswith(list_suffix):
                 ans[str(key)[:-len(list_suffix)]] = load_list_of_dicts_from_group(
                     h5file, path + key + '/', list_suffix=list_suffix,
                     ignore=ignore
@@ -819,23 +2069,28 @@ def recursively_load_dict_contents_from_group(h5file, path, list_suffix='_NWBLIS
     return ans
 
 
-def save_settings(filename, Settings, path='/'):
+def save_settings(filename, Settings, path='/', compact=True):
     """
     Writes into an existing file if path is not yet used.
     Creates a new file if filename does not exist.
     Only works with: numpy arrays, numpy int64 or float64, strings, bytes, lists of strings and dictionaries these are contained in.
     To save specific subsetting, e.g. TaskSettings, use:
         Settings=TaskSetttings, path='/TaskSettings/'
+
+    By default (compact=True) elements without numpy arrays are stored in a single dataset in each group,
+    see :py:func:`recursively_save_dict_contents_to_group`. Both formats are read with :py:func:`load_settings`.
     """
     full_path = '/general/data_collection/Settings' + path
     if os.path.isfile(filename):
         write_method = 'r+'
     else:
         write_method = 'w'
-    with h5py.File(filename, write_method) as h5file:
-        recursively_save_dict_contents_to_group(h5file, full_path, Settings)
+    with open_h5file(filename, write_method) as h5file:
+        full_path, Settings = nest_dict_in_group_with_compact_contents(h5file, full_path, Settings)
+        recursively_save_dict_contents_to_group(h5file, full_path, Settings, compact=compact)
+
 
-def load_settings(filename, path='/', ignore=()):
+def load_settings(filename, path='/', ignore=(), session=None):
     """
     By default loads all settings from path
         '/general/data_collection/Settings/'
@@ -843,25 +2098,27 @@ def load_settings(filename, path='/', ignore=()):
         path='/General/animal/'
 
     ignore - tuple - any paths including any element of ignore are returned as None
+    session - NWBFileSession - optional session to use
     """
     full_path = '/general/data_collection/Settings' + path
-    with h5py.File(filename, 'r') as h5file:
+    with h5file_of_session(filename, 'r', session) as h5file:
         data = recursively_load_dict_contents_from_group(h5file, full_path, ignore=ignore)
 
     return data
 
 
-def check_if_settings_available(filename, path='/'):
+def check_if_settings_available(filename, path='/', session=None):
     """
     Returns whether settings information exists in NWB file
     Specify path='/General/badChan/' to check for specific settings
     """
     full_path = '/general/data_collection/Settings' + path
-    with h5py.File(filename, 'r') as h5file:
-        return full_path in h5file
+    return cached_h5file_query(filename, ('settings_path_exists', full_path),
+                               lambda h5file: check_if_dict_contents_path_exists(h5file, full_path),
+                               session=session)
 
 
-def save_analysis(filename, data, overwrite=False, complete_overwrite=False, verbose=False):
+def save_analysis(filename, data, overwrite=False, complete_overwrite=False, verbose=False, compact=True):
     """Stores analysis results from nested dictionary to /analysis path in NWB file.
 
     See :py:func:`NWBio.recursively_save_dict_contents_to_group` for details on supported data structures.
@@ -874,11 +2131,14 @@ def save_analysis(filename, data, overwrite=False, complete_overwrite=False, ver
     :param bool complete_overwrite: if True, all previous analysis data is discarded before writing.
                                     Default is False.
     :param bool verbose: if True (default is False), the path in file for each element is printed.
+    :param bool compact: if True (default), elements without numpy arrays are stored in a single dataset
+                         in each group instead of a dataset or group for each element.
     """
-    with h5py.File(filename, 'r+') as h5file:
+    with open_h5file(filename, 'r+') as h5file:
         if complete_overwrite:
             del h5file['/analysis']
-        recursively_save_dict_contents_to_group(h5file, '/analysis/', data, overwrite=overwrite, verbose=verbose)
+        recursively_save_dict_contents_to_group(h5file, '/analysis/', data, overwrite=overwrite, verbose=verbose,
+                                                compact=compact)
 
 
 def load_analysis(filename, ignore=()):
@@ -889,13 +2149,21 @@ def load_analysis(filename, ignore=()):
         In the output dictionary any elements downstream of a key matching any element of ignore
         is not loaded and dictionary tree is terminated at that point with value None.
     """
-    with h5py.File(filename, 'r') as h5file:
+    with open_h5file(filename, 'r') as h5file:
         return recursively_load_dict_contents_from_group(h5file, '/analysis/', ignore=ignore)
 
 
-def listBadChannels(filename):
-    if check_if_settings_available(filename,'/General/badChan/'):
-        badChanString = load_settings(filename,'/General/badChan/')
+def listBadChannels(filename, session=None):
+    """
+    Returns the list of bad channels (starting from 0) specified in General settings of the NWB file.
+    """
+    return cached_h5file_query(filename, 'badChan', parse_bad_channels_in_h5file, session=session)
+
+
+def parse_bad_channels_in_h5file(h5file):
+    full_path = '/general/data_collection/Settings/General/badChan/'
+    if check_if_dict_contents_path_exists(h5file, full_path):
+        badChanString = recursively_load_dict_contents_from_group(h5file, full_path)
         # Separate input string into a list using ',' as deliminaters
         if badChanString.find(',') > -1: # If more than one channel specified
             # Find all values tetrode and channel values listed
@@ -930,7 +2198,7 @@ def save_tracking_data(filename, TrackingData, ProcessedPos=False, overwrite=Fal
     else:
         write_method = 'w'
     recordingKey = get_recordingKey(filename)
-    with h5py.File(filename, write_method) as h5file:
+    with open_h5file(filename, write_method) as h5file:
         full_path = '/acquisition/timeseries/' + recordingKey + '/tracking/'
         if not ProcessedPos:
             recursively_save_dict_contents_to_group(h5file, full_path, TrackingData)
@@ -944,24 +2212,24 @@ def save_tracking_data(filename, TrackingData, ProcessedPos=False, overwrite=Fal
 
 
 def get_recording_cameraIDs(filename):
-    path = '/general/data_collection/Settings/CameraSettings/CameraSpecific'
-    with h5py.File(filename, 'r') as h5file:
-        if path in h5file:
-            return list(h5file[path].keys())
+    path = '/general/data_collection/Settings/CameraSettings/CameraSpecific/'
+    with open_h5file(filename, 'r') as h5file:
+        if check_if_dict_contents_path_exists(h5file, path):
+            return list(recursively_load_dict_contents_from_group(h5file, path).keys())
 
 
 def load_raw_tracking_data(filename, cameraID, specific_path=None):
     path = '/acquisition/timeseries/' + get_recordingKey(filename) + '/tracking/' + cameraID + '/'
     if not (specific_path is None):
         path = path + '/' + specific_path + '/'
-    with h5py.File(filename, 'r') as h5file:
+    with open_h5file(filename, 'r') as h5file:
         if path in h5file:
             return recursively_load_dict_contents_from_group(h5file, path)
 
 def load_processed_tracking_data(filename, subset='ProcessedPos'):
     path = '/acquisition/timeseries/' + get_recordingKey(filename) + '/tracking/'
     path = path + subset
-    with h5py.File(filename, 'r') as h5file:
+    with open_h5file(filename, 'r') as h5file:
         return np.array(h5file[path][()])
 
 def get_processed_tracking_data_timestamp_edges(filename, subset='ProcessedPos'):
@@ -970,7 +2238,7 @@ def get_processed_tracking_data_timestamp_edges(filename, subset='ProcessedPos')
         edges = [data[0, 0], data[-1, 0]]
     else:
         print('Warning! ProcessedPos not available. Using continuous data timestamps')
-        h5file = h5py.File(filename, 'r')
+        h5file = open_h5file(filename, 'r')
         recordingKey = get_recordingKey(filename)
         processorKey = get_processorKey(filename)
         path = '/acquisition/timeseries/' + recordingKey + '/continuous/' + processorKey + '/timestamps'
@@ -996,10 +2264,10 @@ def check_if_binary_pos(filename):
     return check_if_path_exists(filename, path)
 
 
-def save_tetrode_idx_keep(filename, ntet, idx_keep, spike_name='spikes', overwrite=False):
-    path = '/acquisition/timeseries/' + get_recordingKey(filename) + '/' + spike_name + '/' + \
+def save_tetrode_idx_keep(filename, ntet, idx_keep, spike_name='spikes', overwrite=False, session=None):
+    path = '/acquisition/timeseries/' + get_recordingKey(filename, session=session) + '/' + spike_name + '/' + \
            'electrode' + str(ntet + 1) + '/idx_keep'
-    with h5py.File(filename, 'r+') as h5file:
+    with h5file_of_session(filename, 'r+', session) as h5file:
         if path in h5file:
             if overwrite:
                 del h5file[path]
@@ -1007,10 +2275,10 @@ def save_tetrode_idx_keep(filename, ntet, idx_keep, spike_name='spikes', overwri
                 raise ValueError('Tetrode ' + str(ntet + 1) + ' idx_keep already exists in ' + filename)
         h5file[path] = idx_keep
 
-def save_tetrode_clusterIDs(filename, ntet, clusterIDs, spike_name='spikes', overwrite=False):
-    path = '/acquisition/timeseries/' + get_recordingKey(filename) + '/' + spike_name + '/' + \
+def save_tetrode_clusterIDs(filename, ntet, clusterIDs, spike_name='spikes', overwrite=False, session=None):
+    path = '/acquisition/timeseries/' + get_recordingKey(filename, session=session) + '/' + spike_name + '/' + \
            'electrode' + str(ntet + 1) + '/clusterIDs'
-    with h5py.File(filename, 'r+') as h5file:
+    with h5file_of_session(filename, 'r+', session) as h5file:
         if path in h5file:
             if overwrite:
                 del h5file[path]
@@ -1018,6 +2286,31 @@ def save_tetrode_clusterIDs(filename, ntet, clusterIDs, spike_name='spikes', ove
                 raise ValueError('Tetrode ' + str(ntet + 1) + ' clusterIDs already exists in ' + filename)
         h5file[path] = np.int16(clusterIDs).squeeze()
 
+def save_tetrode_features(filename, ntet, features, feature_key, spike_name='spikes', session=None):
+    """
+    Stores features computed from tetrode spike waveforms, replacing any features stored before.
+
+    feature_key - str - identifies the waveforms and parameters the features were computed with,
+                  e.g. as returned by KlustaKwikWrapper.get_klustakwik_feature_key
+    """
+    path = '/acquisition/timeseries/' + get_recordingKey(filename, session=session) + '/' + spike_name + '/' + \
+           'electrode' + str(ntet + 1) + '/features/'
+    with h5file_of_session(filename, 'r+', session) as h5file:
+        if path in h5file:
+            del h5file[path]
+        h5file[path + feature_key] = features
+
+def load_tetrode_features(filename, ntet, feature_key, spike_name='spikes', session=None):
+    """
+    Returns features stored with :py:func:`save_tetrode_features` with matching feature_key,
+    or None if such features are not available.
+    """
+    path = '/acquisition/timeseries/' + get_recordingKey(filename, session=session) + '/' + spike_name + '/' + \
+           'electrode' + str(ntet + 1) + '/features/' + feature_key
+    with h5file_of_session(filename, 'r', session) as h5file:
+        if path in h5file:
+            return np.array(h5file[path])
+
 def fill_empty_dictionary_from_source(selection, src_dict):
     """
     Populates a dictionary with None values with values from a source
@@ -1035,39 +2328,43 @@ def fill_empty_dictionary_from_source(selection, src_dict):
     return dst_dict
 
 
-def get_recording_start_timestamp_offset(filename):
+def get_recording_start_timestamp_offset(filename, session=None):
     """Returns the first timestamp of raw or downsampled continuous data.
 
     :param str filename: path to NWB file
+    :param NWBFileSession session: optional session to use
     :return: first timestamp of continuous data
     :rtype: float
     """
-    if check_if_raw_data_available(filename):
-        path = get_raw_data_paths(filename)['timestamps']
-    elif check_if_downsampled_data_available(filename):
-        path = get_downsampled_data_paths(filename)['timestamps']
-    else:
-        raise Exception('NWB file does not contain raw or downsampled data ' + filename)
-    with h5py.File(filename, 'r') as h5file:
-        return float(h5file[path][0:1])
+    with session_or_temporary(session) as session:
+        if check_if_raw_data_available(filename, session=session):
+            path = get_raw_data_paths(filename, session=session)['timestamps']
+        elif check_if_downsampled_data_available(filename, session=session):
+            path = get_downsampled_data_paths(filename, session=session)['timestamps']
+        else:
+            raise Exception('NWB file does not contain raw or downsampled data ' + filename)
+        h5file = session.h5file(filename)
+        return float(h5file[path][0])
 
 
-def get_recording_full_duration(filename):
+def get_recording_full_duration(filename, session=None):
     """Returns the total duration from first to last timestamp of
     raw or downsampled continuous data.
 
     :param str filename: path to NWB file
+    :param NWBFileSession session: optional session to use
     :return: total duration from first to last timestamp of continuous data
     :rtype: float
     """
-    if check_if_raw_data_available(filename):
-        path = get_raw_data_paths(filename)['timestamps']
-    elif check_if_downsampled_data_available(filename):
-        path = get_downsampled_data_paths(filename)['timestamps']
-    else:
-        raise Exception('NWB file does not contain raw or downsampled data ' + filename)
-    with h5py.File(filename, 'r') as h5file:
-        return float(h5file[path][-1]) - float(h5file[path][0:1])
+    with session_or_temporary(session) as session:
+        if check_if_raw_data_available(filename, session=session):
+            path = get_raw_data_paths(filename, session=session)['timestamps']
+        elif check_if_downsampled_data_available(filename, session=session):
+            path = get_downsampled_data_paths(filename, session=session)['timestamps']
+        else:
+            raise Exception('NWB file does not contain raw or downsampled data ' + filename)
+        h5file = session.h5file(filename)
+        return float(h5file[path][-1]) - float(h5file[path][0])
 
 
 def import_task_specific_log_parser(task_name):
@@ -6,12 +6,14 @@ except:
 # To install matlab engine, go to folder /usr/local/MATLAB/R2017a/extern/engines/python
 # and run terminal command: sudo python setup.py install
 import argparse
-from time import sleep, time
+from time import time
 import os
 import tempfile
 import shutil
 import copy
-from multiprocessing import Process
+from subprocess import Popen, PIPE, STDOUT
+from multiprocessing import Process, Pool
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
@@ -19,7 +21,8 @@ from openEPhys_DACQ.package_configuration import package_config, package_path
 from openEPhys_DACQ import NWBio
 from openEPhys_DACQ.createAxonaData import createAxonaData_for_NWBfile, createAxonaData_for_multiple_NWBfiles
 from openEPhys_DACQ import HelperFunctions as hfunct
-from openEPhys_DACQ.KlustaKwikWrapper import applyKlustaKwik_on_spike_data_tet
+from openEPhys_DACQ.KlustaKwikWrapper import (applyKlustaKwik_on_spike_data_tet, get_klustakwik_feature_key,
+                                               compute_klustakwik_features_over_recordings, KLUSTAKWIK_FEATURES)
 from openEPhys_DACQ.TrackingDataProcessing import (remove_tracking_data_jumps,
                                                    iteratively_combine_multicamera_data_for_recording)
 
@@ -93,31 +96,84 @@ def recompute_tracking_data_for_all_files_in_directory_tree(root_path, verbose=F
 
 
 def lowpass_and_downsample_channel(
-        fpath, chan, original_sampling_rate, target_sampling_rate):
-    data = NWBio.load_continuous_as_array(fpath, chan)['continuous'].squeeze()
-    data = hfunct.lowpass_and_downsample(data, original_sampling_rate, target_sampling_rate)
+        fpath, chan, original_sampling_rate, target_sampling_rate, chunk_duration=10.0):
+    # Stream the channel from file, so that only a chunk of raw data is in memory at a time
+    chunks = (chunk['continuous'][:, 0] for chunk in
+              NWBio.iterate_continuous_as_array_chunks(fpath, [chan], chunk_duration=chunk_duration))
+    data = np.concatenate(list(hfunct.lowpass_and_downsample_chunks(chunks, original_sampling_rate,
+                                                                    target_sampling_rate)))
 
     return data
 
 
+def lowpass_and_downsample_channel_job(args):
+    """
+    Calls lowpass_and_downsample_channel in a worker process of lowpass_and_downsample_channels.
+
+    args - tuple - (column, fpath, chan, original_sampling_rate, target_sampling_rate, chunk_duration)
+
+    Returns column and downsampled data as int16.
+    """
+    column, fpath, chan, original_sampling_rate, target_sampling_rate, chunk_duration = args
+    data = lowpass_and_downsample_channel(fpath, chan, original_sampling_rate, target_sampling_rate,
+                                          chunk_duration=chunk_duration)
+
+    return column, np.int16(data)
+
+
+def get_downsampled_data_shape(fpath, n_channels, original_sampling_rate, target_sampling_rate):
+    n_samples = NWBio.get_dataset_shape_and_dtype(fpath, NWBio.get_raw_data_paths(fpath)['continuous'])[0][0]
+    downsampling_factor = hfunct.get_downsampling_factor(original_sampling_rate, target_sampling_rate)
+
+    return -(-n_samples // downsampling_factor), n_channels
+
+
 def lowpass_and_downsample_channels(
-        fpath, channels, original_sampling_rate, target_sampling_rate):
-    # Load, lowpass filter and downsample each channel in a separate process
-    multiprocessor = hfunct.multiprocess()
-    for chan in channels:
-        hfunct.proceed_when_enough_memory_available(percent=0.50)
-        print(hfunct.time_string() + ' Starting lowpass_and_downsample_channel for chan ' + str(chan))
-        multiprocessor.run(lowpass_and_downsample_channel,
-                           args=(fpath, chan, original_sampling_rate, target_sampling_rate))
-        sleep(4)
-    # Collect processed data from multiprocess class
-    out = multiprocessor.results()
+        fpath, channels, original_sampling_rate, target_sampling_rate, out=None, columns=None,
+        n_processes=None, chunk_duration=10.0):
+    """
+    Returns int16 array (samples x channels) of lowpass filtered and downsampled channels.
+
+    Channels are processed in a pool of n_processes workers, by default as many as fit
+    to CPU cores and available memory. Results are written into the output array by this
+    process as soon as each channel is completed.
+
+    out     - numpy.ndarray - optional output array to write into, e.g. created with get_downsampled_data_shape.
+    columns - list - columns of out to write each of the channels into. Default is range(len(channels)).
+    """
+    channels = list(channels)
+    if columns is None:
+        columns = list(range(len(channels)))
+    if out is None:
+        out = np.zeros(get_downsampled_data_shape(fpath, len(channels), original_sampling_rate,
+                                                  target_sampling_rate), dtype=np.int16)
+    if len(channels) == 0:
+        return out
+    if n_processes is None:
+        # Each worker holds a chunk of raw data as int16 and float64 and its output as float64 and int16
+        chunk_size = int(chunk_duration * original_sampling_rate)
+        memory_per_process = chunk_size * (2 + 8 * 3) + out.shape[0] * (8 + 2 * 2)
+        n_processes = hfunct.get_pool_size(memory_per_process, n_jobs=len(channels))
+    jobs = [(column, fpath, chan, original_sampling_rate, target_sampling_rate, chunk_duration)
+            for column, chan in zip(columns, channels)]
+    print(hfunct.time_string() + ' Starting lowpass_and_downsample_channel for {} channels '
+          'with {} processes'.format(len(channels), n_processes))
+    pool = Pool(n_processes)
+    try:
+        for column, data in pool.imap_unordered(lowpass_and_downsample_channel_job, jobs):
+            out[:, column] = data
+    finally:
+        pool.close()
+        pool.join()
 
     return out
 
 
-def lowpass_and_downsample_channel_on_each_tetrode(
-        fpath, original_sampling_rate, target_sampling_rate, n_tetrodes, badChans):
+def select_channel_on_each_tetrode(n_tetrodes, badChans):
+    """
+    Returns the first channel that is not in badChans for each tetrode that has such a channel,
+    and the corresponding tetrode numbers.
+    """
     processed_chans = []
     processed_tets = []
     for n_tet in range(n_tetrodes):
@@ -129,22 +185,26 @@ def lowpass_and_downsample_channel_on_each_tetrode(
         if len(chan) > 0:
             processed_chans.append(chan[0])
             processed_tets.append(n_tet)
-    processed_data_list = lowpass_and_downsample_channels(
-        fpath, processed_chans, original_sampling_rate, target_sampling_rate)
-    new_data_size = processed_data_list[0].size
-    processed_data_array = np.zeros((new_data_size, n_tetrodes), dtype=np.int16)
-    for n_tet, processed_data in zip(processed_tets, processed_data_list):
-        processed_data_array[:, n_tet] = np.int16(processed_data)
+
+    return processed_chans, processed_tets
+
+
+def lowpass_and_downsample_channel_on_each_tetrode(
+        fpath, original_sampling_rate, target_sampling_rate, n_tetrodes, badChans, n_processes=None):
+    processed_chans, processed_tets = select_channel_on_each_tetrode(n_tetrodes, badChans)
+    processed_data_array = np.zeros(get_downsampled_data_shape(fpath, n_tetrodes, original_sampling_rate,
+                                                               target_sampling_rate), dtype=np.int16)
+    lowpass_and_downsample_channels(fpath, processed_chans, original_sampling_rate, target_sampling_rate,
+                                    out=processed_data_array, columns=processed_tets, n_processes=n_processes)
 
     return processed_data_array, processed_chans
 
 
-def lowpass_and_downsample_AUX_data(fpath, n_tetrodes, original_sampling_rate, target_sampling_rate):
+def lowpass_and_downsample_AUX_data(fpath, n_tetrodes, original_sampling_rate, target_sampling_rate,
+                                    n_processes=None):
     aux_chan_list = NWBio.list_AUX_channels(fpath, n_tetrodes)
-    processed_data_list = lowpass_and_downsample_channels(
-        fpath, aux_chan_list, original_sampling_rate, target_sampling_rate)
-    downsampled_AUX = np.concatenate([x[:, None] for x in processed_data_list], axis=1)
-    downsampled_AUX = downsampled_AUX.astype(np.int16)
+    downsampled_AUX = lowpass_and_downsample_channels(
+        fpath, aux_chan_list, original_sampling_rate, target_sampling_rate, n_processes=n_processes)
 
     return downsampled_AUX
 
@@ -153,16 +213,25 @@ def downsample_raw_timestamps(fpath, downsample_factor):
     return NWBio.load_raw_data_timestamps_as_array(fpath)[::downsample_factor]
 
 
-def create_downsampled_data(fpath, n_tetrodes=32, downsample_factor=10):
+def create_downsampled_data(fpath, n_tetrodes=32, downsample_factor=10, n_processes=None):
     # Get original sampling rate and compute target rate based on downsampling factor
     original_sampling_rate = NWBio.OpenEphys_SamplingRate()
     target_sampling_rate = int(NWBio.OpenEphys_SamplingRate() / downsample_factor)
     # Get list of bad channels
     badChans = NWBio.listBadChannels(fpath)
-    # Get downsampled data
-    downsampled_data, used_chans = lowpass_and_downsample_channel_on_each_tetrode(
-        fpath, original_sampling_rate, target_sampling_rate, n_tetrodes, badChans)
-    downsampled_AUX = lowpass_and_downsample_AUX_data(fpath, n_tetrodes, original_sampling_rate, target_sampling_rate)
+    # Get downsampled data of tetrode and AUX channels in a single pool of workers,
+    # each channel written into a column of a single output array
+    used_chans, processed_tets = select_channel_on_each_tetrode(n_tetrodes, badChans)
+    aux_chan_list = list(NWBio.list_AUX_channels(fpath, n_tetrodes))
+    downsampled = np.zeros(get_downsampled_data_shape(fpath, n_tetrodes + len(aux_chan_list),
+                                                      original_sampling_rate, target_sampling_rate),
+                           dtype=np.int16)
+    lowpass_and_downsample_channels(
+        fpath, used_chans + aux_chan_list, original_sampling_rate, target_sampling_rate, out=downsampled,
+        columns=processed_tets + list(range(n_tetrodes, n_tetrodes + len(aux_chan_list))),
+        n_processes=n_processes)
+    downsampled_data = downsampled[:, :n_tetrodes]
+    downsampled_AUX = downsampled[:, n_tetrodes:]
     downsampled_timestamps = downsample_raw_timestamps(fpath, downsample_factor)
     # Ensure timestamps and downsampled data have same number of samples
     assert downsampled_timestamps.size == downsampled_data.shape[0], \
@@ -188,19 +257,26 @@ class ContinuousDataPreloader(object):
     This class loads into memory and preprocesses continuous data.
     Data for specific channels can then be queried.
         channels - continuous list of channels to prepare, e.g. list(range(0,16,1)) for first 4 tetrodes
+        data     - optional dict with 'continuous' (samples x channels) and 'timestamps' arrays,
+                   e.g. a chunk from NWBio.iterate_continuous_as_array_chunks. If provided,
+                   this data is used instead of loading all of it from the NWB file.
+        badChan  - optional list of bad channels. If not provided, it is loaded from the NWB file.
     """
-    def __init__(self, OpenEphysDataPath, channels):
+    def __init__(self, OpenEphysDataPath, channels, data=None, badChan=None):
         self.chan_nrs = list(channels)
         # Load data
-        print('Loading continuous data from NWB file.')
-        data = NWBio.load_continuous_as_array(OpenEphysDataPath, self.chan_nrs)
+        load_from_file = data is None
+        if load_from_file:
+            print('Loading continuous data from NWB file.')
+            data = NWBio.load_continuous_as_array(OpenEphysDataPath, self.chan_nrs)
         self.timestamps = data['timestamps']
         self.continuous = data['continuous']
         self.continuous = np.transpose(self.continuous)
         # Set bad channels to 0
-        self.badChan = NWBio.listBadChannels(OpenEphysDataPath)
+        self.badChan = NWBio.listBadChannels(OpenEphysDataPath) if badChan is None else badChan
         self.continuous = set_bad_chan_to_0(self.continuous, self.chan_nrs, self.badChan)
-        print('Loading continuous data from NWB file successful.')
+        if load_from_file:
+            print('Loading continuous data from NWB file successful.')
 
     def get_chan_nrs_idx_in_continuous(self, chan_nrs_req):
         """
@@ -247,10 +323,13 @@ class ContinuousDataPreloader(object):
         return data
 
     def filter_signal(self, signal_in, filter_freqs):
-        signal_out = hfunct.butter_bandpass_filter(signal_in, sampling_rate=30000.0, 
-                                                   highpass_frequency=filter_freqs[0], 
-                                                   lowpass_frequency=filter_freqs[1], 
-                                                   filt_order=4)
+        """
+        Filters all rows of signal_in (channels x samples) in a single call.
+        """
+        signal_out = hfunct.butter_bandpass_filter_multichannel(signal_in, sampling_rate=30000.0, 
+                                                                highpass_frequency=filter_freqs[0], 
+                                                                lowpass_frequency=filter_freqs[1], 
+                                                                filt_order=4, axis=1)
         return signal_out
 
     def get_channels(self, chan_nrs_req, referenced=False, filter_freqs=False, no_badChan=False):
@@ -271,8 +350,7 @@ class ContinuousDataPreloader(object):
                     badChan_idx.append(i)
             data = np.delete(data, badChan_idx, axis=0)
         if filter_freqs:
-            for nchan in range(data.shape[0]):
-                data[nchan, :] = self.filter_signal(data[nchan, :], filter_freqs)            
+            data[:, :] = self.filter_signal(data, filter_freqs)
 
         return data
 
@@ -302,13 +380,20 @@ def set_bad_chan_to_0(data, chan_nrs, badChan):
 
     return data
 
-def detect_threshold_crossings_on_tetrode(continuous_tetrode_data, threshold, tooclose, detection_method='negative'):
+def detect_threshold_crossings_on_tetrode(continuous_tetrode_data, threshold, tooclose, detection_method='negative',
+                                          previous_crossing=None, return_last_crossing=False):
     """
     Finds all threshold crossings on a tetrode. Returns an empty array if no threshold crossings detected
         continuous_tetrode_data - 4 x N processed continuous data array for 4 channels at N datapoints
         threshold - threshold value in microvolts
         tooclose - minimum latency allowed between spikes (in datapoints)
         detection_method - 'negative', 'positive' or 'both' - the polarity of threshold crossing detection
+        previous_crossing - index of the last threshold crossing in the preceding chunk of data,
+                            relative to the start of continuous_tetrode_data (i.e. a negative value).
+                            If None (default), the data is treated as the start of the recording.
+        return_last_crossing - if True, the index of the last threshold crossing is also returned,
+                               to be passed on as previous_crossing with the next chunk of data.
+                               This is previous_crossing if no crossings were found in this chunk.
     """
     threshold_int16 = np.int16(np.round(threshold / 0.195))
     # Find threshold crossings for each channel
@@ -324,13 +409,20 @@ def detect_threshold_crossings_on_tetrode(continuous_tetrode_data, threshold, to
     # Sort the spike indices
     if len(spike_indices) > 0: 
         spike_indices = np.sort(spike_indices)
+    last_crossing = spike_indices[-1] if len(spike_indices) > 0 else previous_crossing
     # Remove duplicates based on temporal proximity
     if len(spike_indices) > 0:
-        spike_diff = np.append(np.array([0]),np.diff(spike_indices))
+        if previous_crossing is None:
+            spike_diff = np.append(np.array([0]),np.diff(spike_indices))
+        else:
+            spike_diff = np.diff(spike_indices, prepend=previous_crossing)
         tooclose_idx = spike_diff < tooclose
         spike_indices = np.delete(spike_indices, np.where(tooclose_idx)[0])
 
-    return spike_indices
+    if return_last_crossing:
+        return spike_indices, last_crossing
+    else:
+        return spike_indices
 
 def extract_spikes_from_tetrode(continuous_tetrode_data, spike_indices, waveform_length=[6, 34]):
     """
@@ -338,6 +430,10 @@ def extract_spikes_from_tetrode(continuous_tetrode_data, spike_indices, waveform
         continuous_tetrode_data - 4 x N processed continuous data array for 4 channels at N datapoints
         spike_indices - indices for threshold crossing in the continuous_data
         waveform_length - [before, after] number of datapoints to include in the waveform
+
+    Spikes with windows extending beyond the edges of continuous_tetrode_data are skipped.
+    StreamingTetrodeSpikeExtractor uses this on consecutive chunks of data, only passing
+    spike_indices for which the full window is available.
     """
     # Using spike_indices create an array of indices (windows) to extract waveforms from LFP trace
     # The following values are chosen to match OpenEphysGUI default window
@@ -365,6 +461,142 @@ def extract_spikes_from_tetrode(continuous_tetrode_data, spike_indices, waveform
     
     return waveforms, spike_indices, idx_keep
 
+
+class StreamingTetrodeSpikeExtractor(object):
+    """
+    Detects and extracts spikes on a single tetrode from consecutive chunks of continuous data.
+
+    Band-pass filter state, the last threshold crossing and enough samples at the end of
+    each chunk to complete waveforms of spikes detected near the chunk edge are carried over
+    to the next chunk. The output is identical to filtering the whole recording at once with
+    ContinuousDataPreloader.get_channels and using detect_threshold_crossings_on_tetrode and
+    extract_spikes_from_tetrode on the full array.
+    """
+    def __init__(self, threshold, tooclose, filter_freqs=(300, 6000), detection_method='negative',
+                 waveform_length=(6, 34)):
+        """
+        threshold - threshold value in microvolts
+        tooclose - minimum latency allowed between spikes (in datapoints)
+        filter_freqs - band-pass filtering frequency band limits
+        detection_method - 'negative', 'positive' or 'both' - the polarity of threshold crossing detection
+        waveform_length - [before, after] number of datapoints to include in the waveform
+        """
+        self.threshold = threshold
+        self.tooclose = tooclose
+        self.filter_freqs = filter_freqs
+        self.detection_method = detection_method
+        self.waveform_length = list(waveform_length)
+        self._filter_state = None
+        self._last_crossing = None
+        self._n_samples = 0
+        # Buffer of filtered data preceding and including pending spikes
+        self._buffer = None
+        self._buffer_timestamps = None
+        self._buffer_start = 0
+        # Detected spikes awaiting following samples to complete the waveform
+        self._pending_indices = np.array([], dtype=np.int64)
+        self._waveforms = []
+        self._timestamps = []
+
+    def add_chunk(self, continuous_tetrode_data, timestamps):
+        """
+        continuous_tetrode_data - 4 x N unfiltered (but referenced) continuous data array for the next chunk
+        timestamps - array of N timestamps for the chunk
+        """
+        chunk_start = self._n_samples
+        # Filter chunk continuing from previous filter state
+        filtered, self._filter_state = hfunct.butter_bandpass_filter_chunk(
+            continuous_tetrode_data, zi=self._filter_state, sampling_rate=30000.0,
+            highpass_frequency=self.filter_freqs[0], lowpass_frequency=self.filter_freqs[1],
+            filt_order=4, axis=1
+        )
+        filtered = filtered.astype(continuous_tetrode_data.dtype)
+        # Detect threshold crossings continuing from last crossing in previous chunks
+        previous_crossing = None if self._last_crossing is None else self._last_crossing - chunk_start
+        spike_indices, last_crossing = detect_threshold_crossings_on_tetrode(
+            filtered, self.threshold, self.tooclose, detection_method=self.detection_method,
+            previous_crossing=previous_crossing, return_last_crossing=True
+        )
+        if not (last_crossing is None):
+            self._last_crossing = int(last_crossing) + chunk_start
+        self._pending_indices = np.append(self._pending_indices, spike_indices + chunk_start)
+        # Append chunk to buffer
+        if self._buffer is None:
+            self._buffer = filtered
+            self._buffer_timestamps = np.asarray(timestamps).reshape(-1)
+        else:
+            self._buffer = np.concatenate((self._buffer, filtered), axis=1)
+            self._buffer_timestamps = np.concatenate((self._buffer_timestamps, np.asarray(timestamps).reshape(-1)))
+        self._n_samples += continuous_tetrode_data.shape[1]
+        self._extract_complete_waveforms()
+
+    def _extract_complete_waveforms(self):
+        idx_ready = self._pending_indices + self.waveform_length[1] <= self._n_samples
+        if np.any(idx_ready):
+            waveforms, spike_indices, _ = extract_spikes_from_tetrode(
+                self._buffer, self._pending_indices[idx_ready] - self._buffer_start,
+                waveform_length=self.waveform_length
+            )
+            self._waveforms.append(waveforms)
+            self._timestamps.append(self._buffer_timestamps[spike_indices.reshape(-1)])
+            self._pending_indices = self._pending_indices[np.logical_not(idx_ready)]
+        # Only keep samples that may be needed for waveforms of spikes in following chunks
+        n_keep = min(self._buffer.shape[1], sum(self.waveform_length))
+        self._buffer_start += self._buffer.shape[1] - n_keep
+        self._buffer = self._buffer[:, self._buffer.shape[1] - n_keep:]
+        self._buffer_timestamps = self._buffer_timestamps[self._buffer_timestamps.size - n_keep:]
+
+    def finish(self):
+        """
+        Returns waveforms (nspikes x 4 x waveform_length) and timestamps of all extracted spikes.
+        Spikes too close to the end of the recording to have a full waveform are dropped.
+        """
+        if len(self._waveforms) == 0:
+            waveforms = np.zeros((0, 4, sum(self.waveform_length)), dtype=np.int16)
+            timestamps = np.array([], dtype=np.float64)
+        else:
+            waveforms = np.concatenate(self._waveforms, axis=0)
+            timestamps = np.concatenate(self._timestamps)
+        self._buffer = None
+        self._buffer_timestamps = None
+
+        return waveforms, timestamps
+
+
+def extract_spikes_from_raw_data_in_chunks(OpenEphysDataPath, channels, threshold, tooclose,
+                                           filter_freqs=(300, 6000), referencing_method='other_channels',
+                                           chunk_duration=10.0):
+    """
+    Returns a list of spike_data dictionaries for all tetrodes in channels, with 'waveforms',
+    'timestamps' and 'nr_tetrode' fields, extracted from raw continuous data.
+
+    Data is read and processed in chunks of chunk_duration seconds, using
+    StreamingTetrodeSpikeExtractor for each tetrode, to keep memory use independent of
+    recording duration.
+    """
+    channels = [int(chan) for chan in channels]
+    tetrode_nrs = hfunct.get_tetrode_nrs(channels)
+    badChan = NWBio.listBadChannels(OpenEphysDataPath)
+    extractors = [StreamingTetrodeSpikeExtractor(threshold, tooclose, filter_freqs=filter_freqs,
+                                                 detection_method='negative', waveform_length=[6, 34])
+                  for tetrode_nr in tetrode_nrs]
+    for chunk in NWBio.iterate_continuous_as_array_chunks(OpenEphysDataPath, channels,
+                                                          chunk_duration=chunk_duration):
+        preloaded_chunk = ContinuousDataPreloader(OpenEphysDataPath, channels, data=chunk, badChan=badChan)
+        preloaded_chunk.prepare_referencing(referencing_method)
+        for tetrode_nr, extractor in zip(tetrode_nrs, extractors):
+            extractor.add_chunk(preloaded_chunk.get_channels(hfunct.tetrode_channels(tetrode_nr), referenced=True),
+                                preloaded_chunk.timestamps)
+        preloaded_chunk.close()
+    spike_data = []
+    for tetrode_nr, extractor in zip(tetrode_nrs, extractors):
+        waveforms, timestamps = extractor.finish()
+        spike_data.append({'waveforms': np.int16(waveforms),
+                           'timestamps': np.float64(timestamps),
+                           'nr_tetrode': tetrode_nr})
+
+    return spike_data
+
 def filter_spike_data(spike_data_tet, pos_edges, threshold, noise_cut_off, verbose=True):
     """
     Filters data on all tetrodes according to multiple criteria
@@ -460,29 +692,37 @@ def ensure_data_available_for_all_tetrodes(spike_data, tetrode_nrs):
     if len(tetrodes_missing_in_spike_data) > 0:
         raise Exception('No data for tetrodes: ' + ', '.join(map(str, tetrodes_missing_in_spike_data)))
 
-def combine_spike_datas_tet(spike_datas_tet):
-    # Combine all spike_datas into a single spike_data
-    orig_spike_datas_tet = copy.deepcopy(spike_datas_tet)
-    spike_datas_tet_comb = orig_spike_datas_tet[0]
-    for tmp_spike_data in orig_spike_datas_tet[1:]:
-        spike_datas_tet_comb['waveforms'] = np.append(spike_datas_tet_comb['waveforms'], 
-                                                      tmp_spike_data['waveforms'], axis=0)
-        spike_datas_tet_comb['timestamps'] = np.append(spike_datas_tet_comb['timestamps'], 
-                                                       tmp_spike_data['timestamps'], axis=0)
-        spike_datas_tet_comb['idx_keep'] = np.append(spike_datas_tet_comb['idx_keep'], 
-                                                     tmp_spike_data['idx_keep'], axis=0)
-
-    return spike_datas_tet_comb
-
-def uncombine_spike_datas_tet_clusterIDs(clusterIDs, spike_datas_tet):
-    clusterIDs = copy.copy(clusterIDs)
-    # Extract clusters for each original spike_data
+def get_spike_datas_tet_offsets(spike_datas_tet):
+    """
+    Returns positions of the first spike in idx_keep of each spike_data_tet when combined,
+    followed by total number of spikes in idx_keep.
+    """
+    return np.cumsum([0] + [int(np.count_nonzero(spike_data_tet['idx_keep'])) for spike_data_tet in spike_datas_tet])
+
+def combine_spike_datas_tet(spike_datas_tet, features=None):
+    """
+    Returns a single spike_data_tet for clustering spikes in idx_keep of all spike_datas_tet together
+    with applyKlustaKwik_on_spike_data_tet. Waveforms are not combined. Instead, 'features' are computed
+    one recording at a time with compute_klustakwik_features_over_recordings, unless provided as features.
+    'recording_offsets' are from get_spike_datas_tet_offsets, for uncombine_spike_datas_tet_clusterIDs.
+    """
+    recording_offsets = get_spike_datas_tet_offsets(spike_datas_tet)
+    if features is None:
+        features = compute_klustakwik_features_over_recordings(
+            [spike_data_tet['waveforms'] for spike_data_tet in spike_datas_tet], KLUSTAKWIK_FEATURES,
+            idx_keep=[spike_data_tet['idx_keep'] for spike_data_tet in spike_datas_tet])
+
+    return {'nr_tetrode': spike_datas_tet[0]['nr_tetrode'],
+            'features': features,
+            'idx_keep': np.ones(recording_offsets[-1], dtype=bool),
+            'recording_offsets': recording_offsets}
+
+def uncombine_spike_datas_tet_clusterIDs(clusterIDs, spike_datas_tet, recording_offsets=None):
+    # Extract clusters for each original spike_data by slicing at recording_offsets
+    if recording_offsets is None:
+        recording_offsets = get_spike_datas_tet_offsets(spike_datas_tet)
     for ndata in range(len(spike_datas_tet)):
-        # Get clusterIDs for this dataset
-        nspikes = sum(spike_datas_tet[ndata]['idx_keep'])
-        spike_datas_tet[ndata]['clusterIDs'] = clusterIDs[list(range(nspikes))]
-        # Remove these clusterIDs from the list
-        clusterIDs = np.delete(clusterIDs, list(range(nspikes)), axis=0)
+        spike_datas_tet[ndata]['clusterIDs'] = clusterIDs[recording_offsets[ndata]:recording_offsets[ndata + 1]]
 
     return spike_datas_tet
 
@@ -490,7 +730,8 @@ def applyKlustaKwik_to_combined_recordings(spike_datas_tet, max_clusters=31):
     spike_datas_tet_comb = combine_spike_datas_tet(spike_datas_tet)
     clusterIDs = applyKlustaKwik_on_spike_data_tet(spike_datas_tet_comb, 
                                                    max_possible_clusters=max_clusters)
-    spike_datas_tet = uncombine_spike_datas_tet_clusterIDs(clusterIDs, spike_datas_tet)
+    spike_datas_tet = uncombine_spike_datas_tet_clusterIDs(clusterIDs, spike_datas_tet,
+                                                           spike_datas_tet_comb['recording_offsets'])
 
     return spike_datas_tet
 
@@ -521,43 +762,215 @@ def save_spike_data_to_disk(OpenEphysDataPath, processing_method, tetrode_nr, wa
                                       spike_name=spike_name, overwrite=True)
 
 
+def applyKlustaKwik_on_spike_data_tet_with_timing(spike_data_tet, max_possible_clusters=31, cpu_core_nr=None,
+                                                  max_spikes_to_fit=None):
+    """
+    Returns clusterIDs from applyKlustaKwik_on_spike_data_tet, a dictionary with
+    'start' and 'end' time of processing and 'n_spikes' clustered, and the features used.
+    """
+    start = time()
+    clusterIDs, features = applyKlustaKwik_on_spike_data_tet(spike_data_tet,
+                                                             max_possible_clusters=max_possible_clusters,
+                                                             cpu_core_nr=cpu_core_nr, return_features=True,
+                                                             max_spikes_to_fit=max_spikes_to_fit)
+    timing = {'start': start, 'end': time(), 'n_spikes': int(np.sum(spike_data_tet['idx_keep']))}
+
+    return clusterIDs, timing, features
+
+
+def applyKlustaKwik_to_combined_recordings_with_timing(spike_datas_tet, features=None, **kwargs):
+    """
+    Returns the output of applyKlustaKwik_on_spike_data_tet_with_timing for spike_datas_tet of
+    multiple recordings combined with combine_spike_datas_tet, which computes features of
+    one recording at a time unless provided as features.
+    """
+    spike_data_tet = combine_spike_datas_tet(spike_datas_tet, features=features)
+
+    return applyKlustaKwik_on_spike_data_tet_with_timing(spike_data_tet, **kwargs)
+
+
 class Multiprocess_KlustaKwik(object):
+    """
+    Applies KlustaKwik to tetrodes in separate processes, using hfunct.multiprocess.
+    The number of concurrent processes is limited by its CPU_availability_tracker and
+    new tetrodes are only started when enough memory is available.
+    Each KlustaKwik process is pinned to the CPU core assigned by CPU_availability_tracker,
+    such that concurrent processes do not run on the same core.
+    """
 
-    def __init__(self):
+    def __init__(self, memory_available_percent=0.60, pin_cpu_cores=True):
+        """
+        memory_available_percent - float - (0.0 - 1.0) fraction of total memory that must be
+                                   available before the next tetrode is started.
+        pin_cpu_cores - bool - if True (default), each KlustaKwik process only runs on its assigned core.
+        """
         self.multiprocessor = hfunct.multiprocess()
+        self.memory_available_percent = memory_available_percent
+        self.pin_cpu_cores = pin_cpu_cores
+        self.nr_tetrodes = []
+        self.queued_times = []
+        self._results = None
 
-    def add(self, spike_data_tet, max_clusters=31):
-        self.multiprocessor.run(applyKlustaKwik_on_spike_data_tet, 
-                                args=(spike_data_tet,), 
-                                kwargs={'max_possible_clusters': max_clusters}, 
-                                single_cpu_affinity=False)
+    def add(self, spike_data_tet, max_clusters=31, max_spikes_to_fit=None, features=None):
+        """
+        spike_data_tet - dict - spike data of one tetrode, or a list of spike data of the same tetrode
+                         in multiple recordings to be clustered together with
+                         applyKlustaKwik_to_combined_recordings_with_timing.
+        features - numpy.ndarray - optional features of combined recordings, if spike_data_tet is a list.
+        """
+        self.queued_times.append(time())
+        hfunct.proceed_when_enough_memory_available(percent=self.memory_available_percent)
+        kwargs = {'max_possible_clusters': max_clusters, 'max_spikes_to_fit': max_spikes_to_fit}
+        if isinstance(spike_data_tet, list):
+            self.nr_tetrodes.append(spike_data_tet[0]['nr_tetrode'])
+            kwargs['features'] = features
+            self.multiprocessor.run(applyKlustaKwik_to_combined_recordings_with_timing,
+                                    args=(spike_data_tet,), kwargs=kwargs,
+                                    single_cpu_affinity=self.pin_cpu_cores)
+        else:
+            self.nr_tetrodes.append(spike_data_tet['nr_tetrode'])
+            self.multiprocessor.run(applyKlustaKwik_on_spike_data_tet_with_timing, 
+                                    args=(spike_data_tet,), kwargs=kwargs,
+                                    single_cpu_affinity=self.pin_cpu_cores)
+
+    def _get_results(self):
+        # Results of tetrodes where KlustaKwik failed are None
+        if self._results is None:
+            self._results = list(self.multiprocessor.results())
+            self.finished_time = time()
+        return self._results
+
+    def get_failed(self):
+        """
+        Returns a list of nr_tetrode of tetrodes where KlustaKwik failed, in the order they were added.
+        Blocks until all tetrodes have been processed.
+        """
+        return [nr_tetrode for nr_tetrode, result in zip(self.nr_tetrodes, self._get_results()) if result is None]
 
     def get(self):
-        return self.multiprocessor.results()
+        """
+        Returns a list of clusterIDs for each tetrode in the order they were added,
+        with None for tetrodes where KlustaKwik failed (see get_failed), such that
+        results of other tetrodes are not lost. Blocks until all tetrodes have been processed.
+        """
+        return [None if result is None else result[0] for result in self._get_results()]
 
+    def get_features(self):
+        """
+        Returns a list of features used by KlustaKwik for each tetrode in the order they were added,
+        with None for tetrodes where KlustaKwik was not applied or failed.
+        Blocks until all tetrodes have been processed.
+        """
+        return [None if result is None else result[2] for result in self._get_results()]
 
-def process_combined_recordings_spike_datas(spike_datas, tetrode_nrs, max_clusters):
+    def timing_report(self):
+        """
+        Returns a dictionary with processing times of all tetrodes. Blocks until all tetrodes have been processed.
+
+        'tetrodes'   - list of dicts for each tetrode with 'nr_tetrode', 'n_spikes',
+                       'wait' (seconds from add call to start of processing) and
+                       'duration' (seconds spent on processing). Failed tetrodes are not included.
+        'wall_time'  - seconds from first add call until all tetrodes were processed.
+        'total_time' - sum of processing durations of all tetrodes.
+        'speedup'    - total_time divided by wall_time.
+        """
+        tetrodes = []
+        for nr_tetrode, queued_time, result in zip(self.nr_tetrodes, self.queued_times, self._get_results()):
+            if result is None:
+                continue
+            timing = result[1]
+            tetrodes.append({'nr_tetrode': nr_tetrode,
+                             'n_spikes': timing['n_spikes'],
+                             'wait': timing['start'] - queued_time,
+                             'duration': timing['end'] - timing['start']})
+        wall_time = (self.finished_time - self.queued_times[0]) if len(self.queued_times) > 0 else 0.0
+        total_time = float(sum([tetrode['duration'] for tetrode in tetrodes]))
+
+        return {'tetrodes': tetrodes, 'wall_time': wall_time, 'total_time': total_time,
+                'speedup': total_time / wall_time if wall_time > 0 else 1.0}
+
+
+def print_klustakwik_timing_report(timing_report):
+    print('KlustaKwik timing report:')
+    for tetrode in timing_report['tetrodes']:
+        print('    T{:<3} {:>8} spikes  waited {:8.1f} s  sorted in {:8.1f} s'.format(
+            tetrode['nr_tetrode'] + 1, tetrode['n_spikes'], tetrode['wait'], tetrode['duration']))
+    print('    Sorting took {:.1f} s in total and {:.1f} s of wall time ({:.1f}x speedup)'.format(
+        timing_report['total_time'], timing_report['wall_time'], timing_report['speedup']))
+
+
+def apply_klustakwik_to_spike_datas(spike_datas, tetrode_nrs, max_clusters, feature_cache_filename=None,
+                                    feature_cache_spike_name='spikes', max_spikes_to_fit=None):
+    """
+    Clusters each tetrode using KlustaKwik with Multiprocess_KlustaKwik.
+    This creates 'clusterIDs' field in spike_data dictionaries.
+    If multiple datasets are in spike_datas, each tetrode is clustered across all datasets combined.
+
+    spike_datas - list of lists of spike_data dictionaries for each tetrode in each dataset
+    feature_cache_filename - str - optional NWB file with spikes of each tetrode at feature_cache_spike_name.
+                             Features computed for KlustaKwik are stored there with NWBio.save_tetrode_features
+                             and loaded instead of computing them again, if the waveforms have not changed.
+    max_spikes_to_fit - int - optional maximum number of spikes on a tetrode to apply KlustaKwik to.
+                        Remaining spikes are assigned to the clusters found,
+                        see KlustaKwikWrapper.applyKlustaKwik_on_spike_data_tet.
+
+    Returns spike_datas and timing report from Multiprocess_KlustaKwik.timing_report.
+    Raises Exception listing the tetrodes where KlustaKwik failed, after features of all tetrodes have been stored.
+    """
     mp_KlustaKwik = Multiprocess_KlustaKwik()
+    feature_keys = []
+    hfunct.print_progress(0, len(tetrode_nrs), prefix='Applying KlustaKwik:', suffix=' T: 0/' + str(len(tetrode_nrs)), initiation=True)
     for n_tet in range(len(tetrode_nrs)):
-        hfunct.proceed_when_enough_memory_available(percent=0.60)
         spike_datas_tet = [spike_data[n_tet] for spike_data in spike_datas]
-        spike_datas_tet_comb = combine_spike_datas_tet(spike_datas_tet)
-        mp_KlustaKwik.add(spike_datas_tet_comb, max_clusters=max_clusters)
+        feature_key = None
+        features = None
+        if not (feature_cache_filename is None):
+            feature_key = get_klustakwik_feature_key([data_tet['waveforms'] for data_tet in spike_datas_tet],
+                                                     KLUSTAKWIK_FEATURES,
+                                                     idx_keep=[data_tet['idx_keep'] for data_tet in spike_datas_tet])
+            features = NWBio.load_tetrode_features(feature_cache_filename, tetrode_nrs[n_tet],
+                                                   feature_key, spike_name=feature_cache_spike_name)
+        feature_keys.append(feature_key if features is None else None)
+        if len(spike_datas) == 1:
+            spike_data_tet = dict(spike_datas_tet[0])
+            spike_data_tet['features'] = features
+            mp_KlustaKwik.add(spike_data_tet, max_clusters=max_clusters, max_spikes_to_fit=max_spikes_to_fit)
+        else:
+            # Features of combined recordings are computed in the worker process one recording at a time,
+            # so that waveforms of all recordings are not combined
+            spike_datas_tet = [{'nr_tetrode': data_tet['nr_tetrode'], 'waveforms': data_tet['waveforms'],
+                                'idx_keep': data_tet['idx_keep']} for data_tet in spike_datas_tet]
+            mp_KlustaKwik.add(spike_datas_tet, max_clusters=max_clusters, max_spikes_to_fit=max_spikes_to_fit,
+                              features=features)
         hfunct.print_progress(n_tet + 1, len(tetrode_nrs), prefix='Applying KlustaKwik:', suffix=' T: ' + str(n_tet + 1) + '/' + str(len(tetrode_nrs)))
+    all_clusterIDs = mp_KlustaKwik.get()
+    # Store features that were computed, also if KlustaKwik failed on some tetrodes
+    for n_tet, (feature_key, features) in enumerate(zip(feature_keys, mp_KlustaKwik.get_features())):
+        if not (feature_key is None) and not (features is None):
+            NWBio.save_tetrode_features(feature_cache_filename, tetrode_nrs[n_tet], features, feature_key,
+                                        spike_name=feature_cache_spike_name)
+    failed = mp_KlustaKwik.get_failed()
+    if len(failed) > 0:
+        raise Exception('KlustaKwik failed on tetrodes: ' + ', '.join([str(nr + 1) for nr in failed]))
     for n_tet in range(len(tetrode_nrs)):
-        # Get sorted combined data for one tetrode
-        clusterIDs = mp_KlustaKwik.get()[n_tet]
-        spike_datas_tet = [spike_data[n_tet] for spike_data in spike_datas]
-        spike_datas_tet = uncombine_spike_datas_tet_clusterIDs(clusterIDs, spike_datas_tet)
-        for n_dataset, spike_data_tet in enumerate(spike_datas_tet):
-            spike_datas[n_dataset][n_tet] = spike_data_tet
+        if len(spike_datas) == 1:
+            spike_datas[0][n_tet]['clusterIDs'] = all_clusterIDs[n_tet]
+        else:
+            # Split sorted combined data for one tetrode
+            spike_datas_tet = [spike_data[n_tet] for spike_data in spike_datas]
+            spike_datas_tet = uncombine_spike_datas_tet_clusterIDs(all_clusterIDs[n_tet], spike_datas_tet)
+            for n_dataset, spike_data_tet in enumerate(spike_datas_tet):
+                spike_datas[n_dataset][n_tet] = spike_data_tet
+    timing_report = mp_KlustaKwik.timing_report()
+    print_klustakwik_timing_report(timing_report)
 
-    return spike_datas
+    return spike_datas, timing_report
 
 
 def process_available_spikes_using_klustakwik(OpenEphysDataPaths, channels, 
                                               noise_cut_off=1000, threshold=50, 
-                                              max_clusters=31):
+                                              max_clusters=31, return_timing_report=False,
+                                              max_spikes_to_fit=None):
     tetrode_nrs = hfunct.get_tetrode_nrs(channels)
     # Load spikes
     spike_datas = [list(range(len(tetrode_nrs))) for i in range(len(OpenEphysDataPaths))]
@@ -573,16 +986,11 @@ def process_available_spikes_using_klustakwik(OpenEphysDataPaths, channels,
         for n_tet, spike_data_tet in enumerate(spike_data): 
             spike_datas[n_dataset][n_tet] = spike_data_tet
     # Cluster each tetrode using KlustaKwik. This creates 'clusterIDs' field in spike_data dictionaries.
-    if len(spike_datas) == 1:
-        hfunct.print_progress(0, len(tetrode_nrs), prefix='Applying KlustaKwik:', suffix=' T: 0/' + str(len(tetrode_nrs)), initiation=True)
-        mp_KlustaKwik = Multiprocess_KlustaKwik()
-        for n_tet in range(len(tetrode_nrs)):
-            mp_KlustaKwik.add(spike_datas[0][n_tet], max_clusters=max_clusters)
-            hfunct.print_progress(n_tet + 1, len(tetrode_nrs), prefix='Applying KlustaKwik:', suffix=' T: ' + str(n_tet + 1) + '/' + str(len(tetrode_nrs)))
-        for n_tet in range(len(tetrode_nrs)):
-            spike_datas[0][n_tet]['clusterIDs'] = mp_KlustaKwik.get()[n_tet]
-    elif len(spike_datas) > 1:
-        spike_datas = process_combined_recordings_spike_datas(spike_datas, tetrode_nrs, max_clusters)
+    # Features are stored in the first file to be reused when sorting the same spikes again.
+    spike_datas, timing_report = apply_klustakwik_to_spike_datas(
+        spike_datas, tetrode_nrs, max_clusters, feature_cache_filename=OpenEphysDataPaths[0],
+        feature_cache_spike_name=NWBio.get_spike_name_for_processing_method('klustakwik'),
+        max_spikes_to_fit=max_spikes_to_fit)
     # Overwrite clusterIDs on disk
     for OpenEphysDataPath, spike_data in zip(OpenEphysDataPaths, spike_datas):
         print('Saving processing output to: ' + OpenEphysDataPath)
@@ -591,57 +999,34 @@ def process_available_spikes_using_klustakwik(OpenEphysDataPaths, channels,
                                     idx_keep=spike_data_tet['idx_keep'], 
                                     clusterIDs=spike_data_tet['clusterIDs'])
 
-    return spike_datas
+    if return_timing_report:
+        return spike_datas, timing_report
+    else:
+        return spike_datas
 
 def process_spikes_from_raw_data_using_klustakwik(OpenEphysDataPaths, channels, 
                                                   noise_cut_off=1000, threshold=50, 
-                                                  max_clusters=31):
+                                                  max_clusters=31, chunk_duration=10.0,
+                                                  return_timing_report=False, max_spikes_to_fit=None):
     tetrode_nrs = hfunct.get_tetrode_nrs(channels)
     tooclose = 30
     spike_datas = [list(range(len(tetrode_nrs))) for i in range(len(OpenEphysDataPaths))]
-    # Preload continuous data
-    preloaded_datas = []
-    for OpenEphysDataPath in OpenEphysDataPaths:
-        print('Loading data for processing: ' + OpenEphysDataPath)
-        preloaded_data = ContinuousDataPreloader(OpenEphysDataPath, channels)
-        preloaded_data.prepare_referencing('other_channels')
-        preloaded_datas.append(preloaded_data)
-    hfunct.print_progress(0, len(tetrode_nrs), prefix='Extract & KlustaKwik:', suffix=' T: 0/' + str(len(tetrode_nrs)), initiation=True)
-    for n_tet, tetrode_nr in enumerate(tetrode_nrs):
-        # Load this tetrode for all datasets
-        spike_datas_tet = []
-        for n_dataset in range(len(OpenEphysDataPaths)):
-            data_tet = preloaded_datas[n_dataset].get_channels(hfunct.tetrode_channels(tetrode_nr), 
-                                                              referenced=True, filter_freqs=[300, 6000])
-            spike_indices = detect_threshold_crossings_on_tetrode(data_tet, threshold, tooclose, 
-                                                                  detection_method='negative')
-            waveforms, spike_indices, _ = extract_spikes_from_tetrode(data_tet, spike_indices, 
-                                                                   waveform_length=[6, 34])
-            # Arrange waveforms, timestamps and tetrode number into a dictionary
-            timestamps = preloaded_datas[n_dataset].timestamps[spike_indices].squeeze()
-            spike_data_tet = {'waveforms': np.int16(waveforms), 
-                              'timestamps': np.float64(timestamps), 
-                              'nr_tetrode': tetrode_nr}
-            # Create idx_keep field for this tetrode
-            pos_edges = NWBio.get_processed_tracking_data_timestamp_edges(OpenEphysDataPaths[n_dataset])
+    # Extract spikes from continuous data in chunks
+    for n_dataset, OpenEphysDataPath in enumerate(OpenEphysDataPaths):
+        print('Extracting spikes from raw data: ' + OpenEphysDataPath)
+        spike_data = extract_spikes_from_raw_data_in_chunks(OpenEphysDataPath, channels, threshold, tooclose,
+                                                            filter_freqs=[300, 6000],
+                                                            referencing_method='other_channels',
+                                                            chunk_duration=chunk_duration)
+        # Create idx_keep field for each tetrode
+        pos_edges = NWBio.get_processed_tracking_data_timestamp_edges(OpenEphysDataPath)
+        for n_tet, spike_data_tet in enumerate(spike_data):
             spike_data_tet['idx_keep'] = filter_spike_data(spike_data_tet, pos_edges, 
                                                            threshold, noise_cut_off, verbose=False)
-            spike_datas_tet.append(spike_data_tet)
-        # Apply KlustaKwik to this tetrode
-        if len(spike_datas_tet) == 1:
-            clusterIDs = applyKlustaKwik_on_spike_data_tet(spike_datas_tet[0], 
-                                                           max_possible_clusters=max_clusters)
-            spike_datas_tet[0]['clusterIDs'] = clusterIDs
-        elif len(spike_datas_tet) > 1:
-            spike_datas_tet = applyKlustaKwik_to_combined_recordings(spike_datas_tet, 
-                                                                     max_clusters=max_clusters)
-        # Put this tetrode from all datasets into spike_datas
-        for n_dataset, spike_data_tet in enumerate(spike_datas_tet):
-                spike_datas[n_dataset][n_tet] = spike_data_tet
-        hfunct.print_progress(n_tet + 1, len(tetrode_nrs), prefix='Extract & KlustaKwik:', suffix=' T: ' + str(n_tet + 1) + '/' + str(len(tetrode_nrs)))
-    # Close pre-loaded datasets
-    for preloaded_data in preloaded_datas:
-        preloaded_data.close()
+            spike_datas[n_dataset][n_tet] = spike_data_tet
+    # Cluster each tetrode using KlustaKwik. This creates 'clusterIDs' field in spike_data dictionaries.
+    spike_datas, timing_report = apply_klustakwik_to_spike_datas(spike_datas, tetrode_nrs, max_clusters,
+                                                                 max_spikes_to_fit=max_spikes_to_fit)
     # Save spike_datas to disk
     for OpenEphysDataPath, spike_data in zip(OpenEphysDataPaths, spike_datas):
         for data_tet in spike_data:
@@ -649,79 +1034,273 @@ def process_spikes_from_raw_data_using_klustakwik(OpenEphysDataPaths, channels,
                                     waveforms=data_tet['waveforms'], timestamps=data_tet['timestamps'], 
                                     idx_keep=data_tet['idx_keep'], clusterIDs=data_tet['clusterIDs'])
 
-    return spike_datas
+    if return_timing_report:
+        return spike_datas, timing_report
+    else:
+        return spike_datas
+
+class MatlabKiloSortBackend(object):
+    """
+    Applies KiloSort to tetrodes one at a time with MATLAB engine,
+    using scripts in Utils/KiloSortScripts.
+
+    Backends used by process_raw_data_with_kilosort implement sort_tetrodes and close methods.
+    """
+    def __init__(self):
+        if not matlab_available:
+            raise Exception('Matlab not available. Can not process using KiloSort.')
+        config = package_config()
+        self.eng = matlab.engine.start_matlab()
+        self.eng.cd(os.path.join(package_path, 'Utils', 'KiloSortScripts'))
+        self.eng.add_kilosort_paths(config['kilosort_path'], config['npy_matlab_path'])
+
+    def sort_tetrodes(self, tasks):
+        """
+        Applies KiloSort to each element of tasks, a list of dictionaries with elements:
+            'binary_filename' - flat int16 binary file (samples x channels) from NWBio.export_continuous_to_binary_file
+            'n_channels'      - number of channels in binary_filename
+            'channel_map'     - list of columns (starting from 0) in binary_filename of channels to sort
+            'output_folder'   - existing folder to write spike_times.npy and spike_clusters.npy into
+            'num_clusters'    - number of clusters to use
+        """
+        for n_task, task in enumerate(tasks):
+            print('Applying KiloSort to tetrode ' + str(n_task + 1) + '/' + str(len(tasks)))
+            self.eng.master_file(float(task['n_channels']), task['output_folder'], float(task['num_clusters']),
+                                 task['binary_filename'],
+                                 matlab.double([float(column + 1) for column in task['channel_map']]),
+                                 nargout=0)
+            self.eng.clear(nargout=0)
+
+    def close(self):
+        self.eng.quit()
+
+
+class ProcessKiloSortBackend(object):
+    """
+    Applies a spike sorter to tetrodes by running it as a separate process for each tetrode,
+    with up to n_processes tetrodes at a time. This allows using a standalone KiloSort
+    installation or a stand-in sorter in place of MATLAB engine.
+
+    The sorter is started with arguments: binary_filename n_channels channel_map output_folder num_clusters,
+    where channel_map is comma separated list of columns (starting from 0). It must write spike_times.npy and
+    spike_clusters.npy in the format of KiloSort output into output_folder and exit with code 0.
+    See MatlabKiloSortBackend.sort_tetrodes for description of the arguments.
+    """
+    def __init__(self, command, n_processes=1):
+        """
+        command - str or list - path to sorter executable or list of program and its first arguments
+        n_processes - int - number of tetrodes sorted at the same time
+        """
+        self.command = [command] if isinstance(command, str) else list(command)
+        self.n_processes = n_processes
+
+    def sort_tetrode(self, task):
+        sorter_process = Popen(self.command + [task['binary_filename'], str(task['n_channels']),
+                                               ','.join([str(column) for column in task['channel_map']]),
+                                               task['output_folder'], str(task['num_clusters'])],
+                               stdout=PIPE, stderr=STDOUT, universal_newlines=True)
+        output = sorter_process.communicate()[0]
+        if sorter_process.returncode != 0:
+            raise Exception('Sorter failed with exit code ' + str(sorter_process.returncode)
+                            + ' on channels ' + str(task['channel_map']) + '. Output:\n' + output)
+
+    def sort_tetrodes(self, tasks):
+        pool = ThreadPool(max(1, min(self.n_processes, len(tasks))))
+        try:
+            pool.map(self.sort_tetrode, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def close(self):
+        pass
+
+
+def load_KiloSort_output(output_folder):
+    """
+    Returns clusterIDs (starting from 1) and spike sample indices of KiloSort output in output_folder.
+    """
+    clusterIDs = np.int16(np.load(os.path.join(output_folder, 'spike_clusters.npy')).reshape(-1)) + 1
+    spike_indices = np.int64(np.load(os.path.join(output_folder, 'spike_times.npy')).reshape(-1))
+
+    return clusterIDs, spike_indices
+
+
+def extract_spikes_at_indices_in_chunks(continuous_tetrode_data, spike_indices, filter_freqs=(300, 6000),
+                                        waveform_length=(6, 34), chunk_size=300000):
+    """
+    Returns waveforms (nspikes x 4 x waveform_length), spike_indices and idx_keep of spikes at spike_indices,
+    identical to band-pass filtering all of continuous_tetrode_data with ContinuousDataPreloader.get_channels
+    and using extract_spikes_from_tetrode, but filtering chunk_size samples at a time.
+
+    Filter state is carried over between chunks. Each chunk is combined with filtered samples at
+    the end of the previous chunk, so that waveforms overlapping the chunk edge are complete.
+    Data is only filtered up to the last sample needed for the waveforms.
+
+        continuous_tetrode_data - N x 4 referenced continuous data array, e.g. columns of numpy.memmap
+                                  from NWBio.load_binary_file_as_memmap
+        spike_indices - sample indices of spikes in continuous_tetrode_data
+    """
+    waveform_length = list(waveform_length)
+    n_samples = continuous_tetrode_data.shape[0]
+    spike_indices = np.asarray(spike_indices, dtype=np.int64).reshape(-1)
+    idx_keep = np.logical_and(spike_indices - waveform_length[0] >= 0,
+                              spike_indices + waveform_length[1] <= n_samples)
+    spike_indices = spike_indices[idx_keep]
+    order = np.argsort(spike_indices, kind='stable')
+    sorted_indices = spike_indices[order]
+    window_size = sum(waveform_length)
+    waveforms = np.zeros((spike_indices.size, 4, window_size), dtype=np.int16)
+    filter_state = None
+    buffer = np.zeros((4, 0), dtype=np.int16)
+    n_extracted = 0
+    last_sample = sorted_indices[-1] + waveform_length[1] if sorted_indices.size > 0 else 0
+    for chunk_start in range(0, last_sample, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, n_samples)
+        filtered, filter_state = hfunct.butter_bandpass_filter_chunk(
+            np.asarray(continuous_tetrode_data[chunk_start:chunk_end, :]).T, zi=filter_state,
+            sampling_rate=30000.0, highpass_frequency=filter_freqs[0], lowpass_frequency=filter_freqs[1],
+            filt_order=4, axis=1
+        )
+        buffer = np.concatenate((buffer, filtered.astype(np.int16)), axis=1)
+        buffer_start = chunk_end - buffer.shape[1]
+        # Extract waveforms of spikes that end within this chunk
+        n_ready = np.searchsorted(sorted_indices, chunk_end - waveform_length[1], side='right')
+        if n_ready > n_extracted:
+            waveforms[n_extracted:n_ready], _, _ = extract_spikes_from_tetrode(
+                buffer, sorted_indices[n_extracted:n_ready] - buffer_start, waveform_length=waveform_length)
+            n_extracted = n_ready
+        buffer = buffer[:, max(0, buffer.shape[1] - window_size):]
+    # Return spikes in the order of spike_indices
+    output = np.zeros_like(waveforms)
+    output[order] = waveforms
+
+    return output, spike_indices, idx_keep
+
+
+def extract_KiloSort_spikes_job(args):
+    """
+    Extracts waveforms of spikes sorted by KiloSort on one tetrode for each dataset
+    in a worker process of process_raw_data_with_kilosort.
+
+    args - tuple - (n_tet, binary_filename, n_channels, tetrode_columns, datas_first_sample,
+                    datas_n_samples, datas_spike_indices, chunk_size)
+
+    Returns n_tet and a list of outputs of extract_spikes_at_indices_in_chunks for each dataset.
+    """
+    (n_tet, binary_filename, n_channels, tetrode_columns, datas_first_sample,
+     datas_n_samples, datas_spike_indices, chunk_size) = args
+    continuous = NWBio.load_binary_file_as_memmap(binary_filename, n_channels)
+    outputs = []
+    for first_sample, n_samples, spike_indices in zip(datas_first_sample, datas_n_samples, datas_spike_indices):
+        outputs.append(extract_spikes_at_indices_in_chunks(
+            continuous[first_sample:first_sample + n_samples, tetrode_columns], spike_indices,
+            filter_freqs=[300, 6000], waveform_length=[6, 34], chunk_size=chunk_size))
+    del continuous
+
+    return n_tet, outputs
+
 
 def process_raw_data_with_kilosort(OpenEphysDataPaths, channels, noise_cut_off=1000, threshold=5, 
-                                   num_clusters=31):
+                                   num_clusters=31, sorter=None, n_processes=None, chunk_duration=10.0):
+    """
+    Applies KiloSort to each tetrode in channels, across all datasets in OpenEphysDataPaths combined,
+    and saves the spikes and clusterIDs to each NWB file.
+
+    Referenced continuous data of all channels of all datasets is streamed into a single binary file.
+    KiloSort is applied to each tetrode using a channel map of its channels in that file. Waveforms of
+    sorted spikes are then extracted from the same file for all tetrodes in parallel, in a pool of
+    n_processes workers, by default as many as fit to CPU cores and available memory.
+
+    sorter - optional backend, such as ProcessKiloSortBackend. Default is MatlabKiloSortBackend.
+    chunk_duration - float - seconds of data processed at a time when writing and reading data
+    """
     KiloSortBinaryFileName = 'experiment_1.dat'
+    channels = list(channels)
     tetrode_nrs = hfunct.get_tetrode_nrs(channels)
     spike_datas = [list(range(len(tetrode_nrs))) for i in range(len(OpenEphysDataPaths))]
-    # Preload continuous data
-    preloaded_datas = []
-    for OpenEphysDataPath in OpenEphysDataPaths:
-        print('Loading data for processing: ' + OpenEphysDataPath)
-        preloaded_data = ContinuousDataPreloader(OpenEphysDataPath, channels)
-        preloaded_data.prepare_referencing('other_channels')
-        preloaded_datas.append(preloaded_data)
-    # Start matlab engine
-    eng = matlab.engine.start_matlab()
-    eng.cd(os.path.join(package_path, 'Utils', 'KiloSortScripts'))
-    eng.add_kilosort_paths(package_config['kilosort_path'], package_config['npy_matlab_path'])
-    # Work through each tetrode
-    for n_tet, tetrode_nr in enumerate(tetrode_nrs):
-        print('Applying KiloSort to tetrode ' + str(n_tet + 1) + '/' + str(len(tetrode_nrs)))
-        KiloSortProcessingFolder = tempfile.mkdtemp('KiloSortProcessing')
-        # Load this tetrode for all datasets
-        datas_tet_shape = []
-        datas_tet = []
-        for n_dataset in range(len(OpenEphysDataPaths)):
-            data_tet = preloaded_datas[n_dataset].get_channels(hfunct.tetrode_channels(tetrode_nr), referenced=True, 
-                                                               filter_freqs=False, no_badChan=True)
-            datas_tet_shape.append(data_tet.shape)
-            datas_tet.append(data_tet)
-        # Save continuous data as a binary file
-        datas_tet = np.concatenate(datas_tet, axis=1)
-        datas_tet = np.transpose(datas_tet)
-        datas_tet.tofile(os.path.join(KiloSortProcessingFolder, KiloSortBinaryFileName))
-        del datas_tet
-        # Run KiloSort
-        eng.master_file(float(datas_tet_shape[0][0]), KiloSortProcessingFolder, 
-                        float(num_clusters), nargout=0)
-        eng.clear(nargout=0)
-        # Load KiloSort output
-        datas_comb_clusterIDs = np.load(os.path.join(KiloSortProcessingFolder, 'spike_clusters.npy'))[:,0]
-        datas_comb_clusterIDs = np.int16(datas_comb_clusterIDs) + 1
-        datas_comb_spike_indices = np.load(os.path.join(KiloSortProcessingFolder, 'spike_times.npy'))[:,0]
-        datas_comb_spike_indices = np.int64(datas_comb_spike_indices)
+    KiloSortProcessingFolder = tempfile.mkdtemp('KiloSortProcessing')
+    binary_filename = os.path.join(KiloSortProcessingFolder, KiloSortBinaryFileName)
+    chunk_size = int(chunk_duration * 30000)
+    try:
+        # Stream referenced continuous data of all channels for all datasets into a single binary file
+        datas_shape = []
+        badChan = set()
+        for n_dataset, OpenEphysDataPath in enumerate(OpenEphysDataPaths):
+            print('Writing data for KiloSort: ' + OpenEphysDataPath)
+            n_samples, n_channels = NWBio.export_continuous_to_binary_file(
+                OpenEphysDataPath, binary_filename, channels, referencing_method='other_channels',
+                reference_channels=channels, append=(n_dataset > 0), chunk_duration=chunk_duration)
+            datas_shape.append((n_channels, n_samples))
+            badChan.update(NWBio.listBadChannels(OpenEphysDataPath))
+        # Run KiloSort on channels of each tetrode that are not bad in any dataset
+        tasks = []
+        for tetrode_nr in tetrode_nrs:
+            output_folder = os.path.join(KiloSortProcessingFolder, 'tetrode_' + str(tetrode_nr + 1))
+            os.mkdir(output_folder)
+            tasks.append({'binary_filename': binary_filename,
+                          'n_channels': len(channels),
+                          'channel_map': [channels.index(chan) for chan in hfunct.tetrode_channels(tetrode_nr)
+                                          if not (chan in badChan)],
+                          'output_folder': output_folder,
+                          'num_clusters': num_clusters})
+        sorter_created = sorter is None
+        if sorter_created:
+            sorter = MatlabKiloSortBackend()
+        try:
+            sorter.sort_tetrodes(tasks)
+        finally:
+            if sorter_created:
+                sorter.close()
+        # Load KiloSort output and separate clusterIDs and spike indices to different datasets
+        datas_first_sample = list(np.cumsum([0] + [data_shape[1] for data_shape in datas_shape[:-1]]))
+        datas_n_samples = [data_shape[1] for data_shape in datas_shape]
+        tets_datas_clusterIDs = []
+        jobs = []
+        for n_tet, (tetrode_nr, task) in enumerate(zip(tetrode_nrs, tasks)):
+            datas_comb_clusterIDs, datas_comb_spike_indices = load_KiloSort_output(task['output_folder'])
+            datas_clusterIDs, datas_spike_indices = split_KiloSort_output(datas_comb_clusterIDs,
+                                                                          datas_comb_spike_indices, datas_shape)
+            tets_datas_clusterIDs.append(datas_clusterIDs)
+            jobs.append((n_tet, binary_filename, len(channels),
+                         [channels.index(chan) for chan in hfunct.tetrode_channels(tetrode_nr)],
+                         datas_first_sample, datas_n_samples, datas_spike_indices, chunk_size))
+        # Extract waveforms of sorted spikes of all tetrodes in parallel
+        if n_processes is None:
+            # Each worker holds a chunk of data of all channels as int16 and of the tetrode as float64
+            n_spikes = max([sum([spike_indices.size for spike_indices in job[6]]) for job in jobs] + [0])
+            memory_per_process = chunk_size * (len(channels) * 2 + 4 * 8 * 3) + n_spikes * 4 * 40 * 2 * 2
+            n_processes = hfunct.get_pool_size(memory_per_process, n_jobs=len(jobs))
+        print(hfunct.time_string() + ' Extracting KiloSort spikes for {} tetrodes '
+              'with {} processes'.format(len(jobs), n_processes))
+        pool = Pool(n_processes)
+        try:
+            for n_tet, outputs in pool.imap_unordered(extract_KiloSort_spikes_job, jobs):
+                # Create spike_data dictionary for this tetrode for each dataset
+                for n_dataset, (waveforms, spike_indices, idx_keep) in enumerate(outputs):
+                    # Only keep clusterIDs for clusters that were included by extract_spikes_at_indices_in_chunks
+                    clusterIDs = tets_datas_clusterIDs[n_tet][n_dataset][idx_keep]
+                    # Arrange waveforms, timestamps and tetrode number into a dictionary
+                    timestamps = NWBio.load_raw_data_timestamps_at_indices(OpenEphysDataPaths[n_dataset],
+                                                                           spike_indices)
+                    spike_data_tet = {'waveforms': np.int16(waveforms),
+                                      'timestamps': np.float64(timestamps),
+                                      'clusterIDs': np.int16(clusterIDs),
+                                      'nr_tetrode': tetrode_nrs[n_tet]}
+                    # Create idx_keep field for this tetrode
+                    pos_edges = NWBio.get_processed_tracking_data_timestamp_edges(OpenEphysDataPaths[n_dataset])
+                    spike_data_tet['idx_keep'] = filter_spike_data(spike_data_tet, pos_edges,
+                                                                   threshold, noise_cut_off, verbose=False)
+                    # Only keep clusterIDs based on idx_keep to conform to KlustaKwik processing format
+                    spike_data_tet['clusterIDs'] = spike_data_tet['clusterIDs'][spike_data_tet['idx_keep']]
+                    # Position spike_data_tet to the list of spike_data for each dataset
+                    spike_datas[n_dataset][n_tet] = spike_data_tet
+        finally:
+            pool.close()
+            pool.join()
+    finally:
         # Delete KiloSort Processing folder
         shutil.rmtree(KiloSortProcessingFolder)
-        # Separate clusterIDs and spike indices to different datasets
-        datas_clusterIDs, datas_spike_indices = split_KiloSort_output(datas_comb_clusterIDs, datas_comb_spike_indices, datas_tet_shape)
-        # Create spike_data dictionary for this tetrode for each dataset
-        for n_dataset in range(len(OpenEphysDataPaths)):
-            data_tet = preloaded_datas[n_dataset].get_channels(hfunct.tetrode_channels(tetrode_nr), referenced=True, 
-                                                               filter_freqs=[300, 6000], no_badChan=False)
-            waveforms, spike_indices, idx_keep = extract_spikes_from_tetrode(data_tet, datas_spike_indices[n_dataset], 
-                                                                             waveform_length=[6, 34])
-            # Only keep clusterIDs for clusters that were included by extract_spikes_from_tetrode
-            datas_clusterIDs[n_dataset] = (datas_clusterIDs[n_dataset][idx_keep]).squeeze()
-            # Arrange waveforms, timestamps and tetrode number into a dictionary
-            timestamps = preloaded_datas[n_dataset].timestamps[spike_indices].squeeze()
-            spike_data_tet = {'waveforms': np.int16(waveforms), 
-                              'timestamps': np.float64(timestamps), 
-                              'clusterIDs': np.int16(datas_clusterIDs[n_dataset]), 
-                              'nr_tetrode': tetrode_nr}
-            # Create idx_keep field for this tetrode
-            pos_edges = NWBio.get_processed_tracking_data_timestamp_edges(OpenEphysDataPaths[n_dataset])
-            spike_data_tet['idx_keep'] = filter_spike_data(spike_data_tet, pos_edges, 
-                                                           threshold, noise_cut_off, verbose=False)
-            # Only keep clusterIDs based on idx_keep to conform to KlustaKwik processing format
-            spike_data_tet['clusterIDs'] = spike_data_tet['clusterIDs'][spike_data_tet['idx_keep']]
-            # Position spike_data_tet to the list of spike_data for each dataset
-            spike_datas[n_dataset][n_tet] = spike_data_tet
-    # Close pre-loaded datasets
-    for preloaded_data in preloaded_datas:
-        preloaded_data.close()
     # Save spike_datas to disk
     for OpenEphysDataPath, spike_data in zip(OpenEphysDataPaths, spike_datas):
         for data_tet in spike_data:
@@ -735,7 +1314,14 @@ def process_raw_data_with_kilosort(OpenEphysDataPaths, channels, noise_cut_off=1
 def processing(OpenEphysDataPaths, processing_method='klustakwik', channel_map=None, 
                noise_cut_off=1000, threshold=50, make_AxonaData=False, 
                axonaDataArgs=(None, None, None, False), max_clusters=31,
-               force_position_processing=False, pos_data_processing_kwargs={}):
+               force_position_processing=False, pos_data_processing_kwargs={}, max_spikes_to_fit=None,
+               kilosort_sorter=None):
+    """
+    Processes spikes of all tetrodes in channel_map with processing_method and optionally creates AxonaData.
+
+    kilosort_sorter - optional backend for 'kilosort' processing_method, such as ProcessKiloSortBackend.
+                      Default is MatlabKiloSortBackend, which requires MATLAB engine.
+    """
 
     # Ensure correct format for data paths
     if isinstance(OpenEphysDataPaths, str):
@@ -766,18 +1352,21 @@ def processing(OpenEphysDataPaths, processing_method='klustakwik', channel_map=N
             area_spike_datas.append(process_available_spikes_using_klustakwik(OpenEphysDataPaths, channels, 
                                                                               noise_cut_off=noise_cut_off, 
                                                                               threshold=threshold, 
-                                                                              max_clusters=max_clusters))
+                                                                              max_clusters=max_clusters,
+                                                                              max_spikes_to_fit=max_spikes_to_fit))
         elif processing_method == 'klustakwik_raw':
             area_spike_datas.append(process_spikes_from_raw_data_using_klustakwik(OpenEphysDataPaths, channels, 
                                                                                   noise_cut_off=noise_cut_off, 
                                                                                   threshold=threshold, 
-                                                                                  max_clusters=max_clusters))
+                                                                                  max_clusters=max_clusters,
+                                                                                  max_spikes_to_fit=max_spikes_to_fit))
         elif processing_method == 'kilosort':
-            if not matlab_available:
+            if kilosort_sorter is None and not matlab_available:
                 raise Exception('Matlab not available. Can not process using KiloSort.')
             area_spike_datas.append(process_raw_data_with_kilosort(OpenEphysDataPaths, channels, 
                                                                    noise_cut_off=noise_cut_off, threshold=5, 
-                                                                   num_clusters=max_clusters))
+                                                                   num_clusters=max_clusters,
+                                                                   sorter=kilosort_sorter))
     print(hfunct.time_string(), 'DEBUG: Finished Processing in ', time() - DEBUG_Time)
 
     del area_spike_datas
@@ -878,6 +1467,11 @@ def main():
                         help='use KlustaKwik to cluster spike data obtained from raw data')
     parser.add_argument('--kilosort', action='store_true',
                         help='use KiloSort to cluster spike data (this uses raw data only)')
+    parser.add_argument('--kilosort_command', type=str, nargs=1,
+                        help=('path to standalone KiloSort executable to use instead of MATLAB engine,\n'
+                              + 'see ProcessKiloSortBackend for required arguments and output'))
+    parser.add_argument('--kilosort_processes', type=int, nargs=1,
+                        help='number of tetrodes sorted at the same time with kilosort_command. Default is 1.')
     parser.add_argument('--noAxonaData', action='store_true',
                         help='to skip conversion into AxonaData format after processing')
     parser.add_argument('--eegChans', type=int, nargs = '*',
@@ -899,6 +1493,9 @@ def main():
                         help='enter maximum allowed jump in position data values for position data postprocessing')
     parser.add_argument('--max_clusters', type=int, nargs = 1, 
                         help='Specifies the maximum number of cluster to find. Default is 31.')
+    parser.add_argument('--max_spikes_to_fit', type=int, nargs = 1,
+                        help=('Apply KlustaKwik to a random subsample of this many spikes on each tetrode\n'
+                              + 'and assign remaining spikes to the clusters found. Default is all spikes.'))
     parser.add_argument('--show_output', action='store_true', 
                         help='(for AxonaData) to open AxonaData output folder after processing')
     parser.add_argument('--datatree', action='store_true', 
@@ -953,6 +1550,17 @@ def main():
         max_clusters = args.max_clusters[0]
     else:
         max_clusters = 31
+    if args.max_spikes_to_fit:
+        max_spikes_to_fit = args.max_spikes_to_fit[0]
+    else:
+        max_spikes_to_fit = None
+    # Specify KiloSort backend, MATLAB engine is used by default
+    if args.kilosort_command:
+        kilosort_sorter = ProcessKiloSortBackend(args.kilosort_command[0],
+                                                 n_processes=(args.kilosort_processes[0]
+                                                              if args.kilosort_processes else 1))
+    else:
+        kilosort_sorter = None
     # Specify position data processing options
     if args.force_position_processing:
         force_position_processing = True
@@ -991,7 +1599,8 @@ def main():
 
     processing_args = (processing_method, channel_map, noise_cut_off,
                        threshold, make_AxonaData, axonaDataArgs, max_clusters,
-                       force_position_processing, pos_data_processing_kwargs)
+                       force_position_processing, pos_data_processing_kwargs, max_spikes_to_fit,
+                       kilosort_sorter)
 
     # If reprocessing tracking in directory is requested, just do that
     if args.reprocess_tracking_in_directory:
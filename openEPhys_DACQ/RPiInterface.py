@@ -6,17 +6,19 @@ import zmq
 import multiprocessing
 from time import time, sleep
 from openEPhys_DACQ.sshScripts import ssh
-import json
 from threading import Lock, Thread
 import numpy as np
 from scipy.spatial.distance import euclidean
 from openEPhys_DACQ.TrackingDataProcessing import combineCamerasData
-from openEPhys_DACQ.ZMQcomms import paired_messenger, remote_object_controller
+from openEPhys_DACQ.ZMQcomms import (paired_messenger, remote_object_controller, POSITION_MESSAGE_DTYPE,
+                                     encode_position_message, decode_position_messages,
+                                     encode_json_position_message, decode_json_position_message)
 from multiprocessing.dummy import Pool as ThreadPool
 from tempfile import mkdtemp
 from shutil import rmtree
 import os
 from openEPhys_DACQ.HelperFunctions import test_pinging_address, time_string
+from openEPhys_DACQ.SharedMemoryBuffers import PositionHistoryBuffer
 from openEPhys_DACQ.package_configuration import package_path
 
 
@@ -66,6 +68,7 @@ class Camera_RPi_file_manager(object):
     @staticmethod
     def Camera_RPi_files():
         return (os.path.join(package_path, 'ZMQcomms.py'),
+                os.path.join(package_path, 'SharedMemoryBuffers.py'),
                 os.path.join(package_path, 'CameraRPiController.py'))
 
     @staticmethod
@@ -143,7 +146,8 @@ class Camera_RPi_file_manager(object):
 
 class CameraSimulation(object):
 
-    def __init__(self, address, port):
+    def __init__(self, address, port, position_message_format='binary'):
+        self.position_message_format = position_message_format
         self.zmq_publisher = None
         self.init_zmq_publisher(address, port)
         self.position_messaging_thread = Thread(target=self.position_messaging_loop)
@@ -160,8 +164,10 @@ class CameraSimulation(object):
         sleep(0.5)  # Give time to establish sockets for ZeroMQ
 
     def send_linedata(self, linedata):
-        message = json.dumps(linedata)  # Convert data to string format
-        message = message.encode()  # Convert data into bytes format
+        if self.position_message_format == 'json':
+            message = encode_json_position_message(linedata)
+        else:
+            message = encode_position_message(linedata)
         self.zmq_publisher.send(message)  # Send the message using ZeroMQ
 
     def position_messaging_loop(self, interval=0.033):
@@ -227,7 +233,8 @@ class CameraControl(object):
 
         if self.simulation:
             address = '*' if address == 'localhost' else address
-            self.RemoteControl = CameraSimulation(address, OnlineTrackerParams['OnlineTracker_port'])
+            self.RemoteControl = CameraSimulation(address, OnlineTrackerParams['OnlineTracker_port'],
+                                                  OnlineTrackerParams['position_message_format'])
             return True
 
         if hasattr(self, 'RemoteControl'):
@@ -290,7 +297,7 @@ class CameraControl(object):
     @staticmethod
     def dict_OnlineTrackerParams(calibrationTmatrix, tracking_mode, smoothing_box, 
                                  motion_threshold, motion_size, 
-                                 OnlineTracker_port, RPiIP, LED_separation):
+                                 OnlineTracker_port, RPiIP, LED_separation, position_message_format='binary'):
         """
         Returns camera_parameters in a dictionary.
         """
@@ -301,7 +308,8 @@ class CameraControl(object):
                 'motion_size': motion_size,  # int
                 'OnlineTracker_port': str(OnlineTracker_port), # str
                 'RPiIP': str(RPiIP), # str
-                'LED_separation': float(LED_separation)} # LED separation in cm
+                'LED_separation': float(LED_separation), # LED separation in cm
+                'position_message_format': str(position_message_format)} # 'binary' or 'json'
 
     @staticmethod
     def dict_calibration_parameters(ndots_xy, spacing, offset_xy):
@@ -338,7 +346,8 @@ class CameraControl(object):
                     CameraSettings['General']['motion_size'], 
                     CameraSettings['General']['OnlineTracker_port'], 
                     CameraSettings['CameraSpecific'][cameraID]['address'], 
-                    CameraSettings['General']['LED_separation'])
+                    CameraSettings['General']['LED_separation'],
+                    CameraSettings['General'].get('position_message_format', 'binary'))
             OnlineTrackerParams = CameraControl.dict_OnlineTrackerParams(*args)
             kwargs_list.append({'address': CameraSettings['CameraSpecific'][cameraID]['address'],
                                 'port': CameraSettings['General']['ZMQcomms_port'],
@@ -393,13 +402,15 @@ class TrackingControl(object):
 class onlineTrackingData(object):
     # Constantly updates position data for all RPis currently in use.
     # Initialize this class as RPIpos = onlineTrackingData(CameraSettings, arena_size)
-    # Check for latest position with combPos = RPIpos.combPosHistory[-1]
+    # Check for latest position with combPos = RPIpos.combPosHistory.last(1)
 
-    # RPIpos.combPosHistory is multiprocessing.managers.List and can take care of locks across processes
+    # RPIpos.combPosHistory is SharedMemoryBuffers.PositionHistoryBuffer and can be read from other processes.
+    # It keeps position_history_horizon seconds of latest positions.
 
     # Optional arguments during initialization:
     #   HistogramParameters is a list: [margins, binSize, histogram_speed_limit]
-    def __init__(self, CameraSettings, arena_size, HistogramParameters=None):
+    #   position_history_horizon is the duration of position history kept in combPosHistory (in seconds)
+    def __init__(self, CameraSettings, arena_size, HistogramParameters=None, position_history_horizon=3600):
         # Initialise the class with input CameraSettings
         self.combPos_update_interval = 0.05 # in seconds
         self.CameraSettings = CameraSettings
@@ -412,8 +423,16 @@ class onlineTrackingData(object):
                                    'speedLimit': 10}  # centimeters of distance in last second to be included
         self.KeepGettingData = True # Set True for endless while loop of updating latest data
         self.posDatas = [None for i in range(len(self.cameraIDs))]
+        # Timestamps of latest posDatas set by the camera, not available with 'json' position_message_format
+        self.posDataTimestamps = [None for i in range(len(self.cameraIDs))]
+        # Position messages are received in bulk into pre-allocated arrays
+        self.position_message_format = CameraSettings['General'].get('position_message_format', 'binary')
+        self.max_messages_per_update = 100
+        self.posDataBuffers = [np.zeros(self.max_messages_per_update, dtype=POSITION_MESSAGE_DTYPE)
+                               for i in range(len(self.cameraIDs))]
         self.multiprocess_manager = multiprocessing.Manager()
-        self.combPosHistory = self.multiprocess_manager.list([])
+        self.combPosHistory = PositionHistoryBuffer(int(np.ceil(position_history_horizon
+                                                                / self.combPos_update_interval)))
         self.sockSUBs = onlineTrackingData.setupSockets(self.cameraIDs, self.CameraSettings)
         # Initialize Locks to avoid errors
         self.posDatasLock = Lock()
@@ -458,23 +477,51 @@ class onlineTrackingData(object):
 
         return sockSUBs
 
+    @staticmethod
+    def receive_messages(sockSUB, max_messages):
+        """
+        Returns a list of messages received from sockSUB, waiting for first message until socket timeout
+        and then receiving all messages already waiting in the socket, up to max_messages.
+        Returns empty list if no message was received.
+        """
+        try:
+            messages = [sockSUB.recv()]
+        except zmq.ZMQError:
+            return []
+        while len(messages) < max_messages:
+            try:
+                messages.append(sockSUB.recv(zmq.NOBLOCK))
+            except zmq.ZMQError:
+                break
+
+        return messages
+
     def updatePosDatas(self, nRPi):
         # Updates self.posDatas when any new position data is received
         # This loop continues until self.KeepGettingData is set False. This is done by self.close function
         while self.KeepGettingData:
             # Wait for position data update
-            try:
-                message = self.sockSUBs[nRPi].recv()  # Receive message
-                message = message.decode()  # Decode bytes into string
-            except:
-                message = 'no message'
-            if message != 'no message':
-                posData = json.loads(message)  # Convert from string to original format
+            messages = onlineTrackingData.receive_messages(self.sockSUBs[nRPi], self.max_messages_per_update)
+            if len(messages) == 0:
+                continue
+            if self.position_message_format == 'json':
+                for message in messages:
+                    posData = decode_json_position_message(message)  # Convert from bytes to original format
+                    # Ignore messages where all elements are None
+                    if any(posData):
+                        # Update posData for the correct position in the list
+                        with self.posDatasLock:
+                            self.posDatas[nRPi] = posData
+            else:
+                messages = decode_position_messages(messages, out=self.posDataBuffers[nRPi])
+                linedata = messages['linedata']
                 # Ignore messages where all elements are None
-                if any(posData):
-                    # Update posData for the correct position in the list
+                idx_valid = np.where(np.any(np.logical_not(np.isnan(linedata)) & (linedata != 0), axis=1))[0]
+                if idx_valid.size > 0:
+                    # Update posData for the correct position in the list with latest valid message
                     with self.posDatasLock:
-                        self.posDatas[nRPi] = posData
+                        self.posDatas[nRPi] = linedata[idx_valid[-1], :].copy()
+                        self.posDataTimestamps[nRPi] = messages['timestamp'][idx_valid[-1]]
 
     def combineCurrentLineData(self, previousCombPos):
         with self.posDatasLock:
@@ -537,7 +584,7 @@ class onlineTrackingData(object):
             lastCombPos = self.combineCurrentLineData(None)
         if not self.KeepGettingData:
             return
-        self.combPosHistory.append(list(lastCombPos))
+        self.combPosHistory.append(lastCombPos)
         time_of_last_datapoint = time()
         # Update the data at specific interval
         while self.KeepGettingData:
@@ -546,20 +593,17 @@ class onlineTrackingData(object):
 
                 # If enough time has passed since last update, append to combPosHistory list
 
-                lastCombPos = self.combineCurrentLineData(self.combPosHistory[-1])
+                lastCombPos = self.combineCurrentLineData(lastCombPos)
 
-                if not (lastCombPos is None):
-                    self.combPosHistory.append(list(lastCombPos))
-                else:
-                    self.combPosHistory.append(lastCombPos)
+                self.combPosHistory.append(lastCombPos)
 
                 time_of_last_datapoint = time()
                 if len(self.combPosHistory) > one_second_steps:
                     # Compute distance from one second in the past if enough data available
-                    tmp_combPosHistory_segment = np.array(self.combPosHistory[-one_second_steps:])
-                    currPos = tmp_combPosHistory_segment[-1]
-                    pastPos = tmp_combPosHistory_segment[0]
-                    if not (currPos is None) and not (pastPos is None):
+                    _, positions, valid = self.combPosHistory.last(one_second_steps)
+                    currPos = positions[-1]
+                    pastPos = positions[0]
+                    if valid[-1] and valid[0]:
                         self.lastSecondDistance = euclidean(currPos[:2], pastPos[:2])
                         if self.lastSecondDistance > self.position_histogram_dict['parameters']['speedLimit']:
 
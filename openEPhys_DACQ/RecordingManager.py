@@ -1,6 +1,7 @@
 
 import os
 import sys
+import json
 from copy import deepcopy
 import numpy as np
 from PyQt5 import QtCore, QtGui, QtWidgets
@@ -21,6 +22,9 @@ from openEPhys_DACQ.ZMQcomms import SubscribeToOpenEphys, PublishToOpenEphys
 from openEPhys_DACQ.CumulativePosPlot import PosPlot
 
 
+GENERAL_SETTINGS_HISTORY_INDEX_FILENAME = 'general_settings_history_index.json'
+
+
 def find_latest_time_folder(path):
     """Looks up subdirectory names and returns folder with latest date time string as folder name
     """
@@ -109,6 +113,75 @@ def store_camera_data_to_recording_file(camera_settings, fpath):
         t.join()
 
 
+def load_general_settings_history_index(path):
+    """
+    Returns the contents of the general settings history index file in the path,
+    or an empty dictionary if the index file does not exist or can not be read.
+    """
+    index_path = os.path.join(path, GENERAL_SETTINGS_HISTORY_INDEX_FILENAME)
+    if not os.path.isfile(index_path):
+        return {}
+    try:
+        with open(index_path, 'r') as index_file:
+            return json.load(index_file)
+    except (IOError, OSError, ValueError):
+        print('Warning', 'Could not read settings history index ' + index_path)
+        return {}
+
+
+def save_general_settings_history_index(path, index):
+    """
+    Writes the general settings history index to the path, replacing any previous index file atomically.
+    """
+    index_path = os.path.join(path, GENERAL_SETTINGS_HISTORY_INDEX_FILENAME)
+    try:
+        with open(index_path + '.tmp', 'w') as index_file:
+            json.dump(index, index_file)
+        os.replace(index_path + '.tmp', index_path)
+    except (IOError, OSError):
+        print('Warning', 'Could not write settings history index ' + index_path)
+
+
+def load_general_settings_of_files(path, filenames):
+    """
+    Returns a list of General settings of the settings files in the path.
+
+    General settings are read from the index file in the path, if the size and modification
+    time of the settings file match those in the index. Otherwise settings are loaded from the
+    settings file and the index is updated. Files no longer in the path are removed from the index.
+
+    path      - str  - path to folder with settings files
+    filenames - list - full paths to settings files in the path
+    """
+    index = load_general_settings_history_index(path)
+    index_changed = False
+    settings_list = []
+    for filename in filenames:
+        file_stat = os.stat(filename)
+        entry = index.get(os.path.basename(filename), None)
+        if not (entry is None) and entry['size'] == file_stat.st_size and entry['mtime'] == file_stat.st_mtime:
+            settings_list.append(NWBio.from_json_compatible(entry['General']))
+            continue
+        settings = NWBio.load_settings(filename, path='/General/')
+        settings_list.append(settings)
+        try:
+            index[os.path.basename(filename)] = {'size': file_stat.st_size, 'mtime': file_stat.st_mtime,
+                                                 'General': NWBio.to_json_compatible(settings)}
+            index_changed = True
+        except TypeError:
+            # Settings that can not be stored in the index are loaded from the file every time
+            pass
+    basenames = set([os.path.basename(filename) for filename in filenames])
+    for key in list(index.keys()):
+        if not (key in basenames):
+            del index[key]
+            index_changed = True
+    if index_changed:
+        save_general_settings_history_index(path, index)
+
+    return settings_list
+
+
 def list_general_settings_history(path):
     """
     Assumes all files on the path are NWB files with General settings stored
@@ -120,6 +193,9 @@ def list_general_settings_history(path):
 
         All lists are sorted starting from the most recent timestamp in filename.
         None is entered if key is missing in settings file.
+
+    General settings are only loaded from files that are new or changed since the last call,
+    see load_general_settings_of_files.
     """
     dir_items = os.listdir(path)
     filetimes = []
@@ -133,13 +209,11 @@ def list_general_settings_history(path):
     filenames = [x for _, x in sorted(zip(filetimes, filenames))][::-1]
     # Load all general settings to memory and build a list of keys
     settings_keys = []
-    settings_list = []
-    for filename in filenames:
-        settings = NWBio.load_settings(filename, path='/General/')
+    settings_list = load_general_settings_of_files(path, filenames)
+    for settings in settings_list:
         for key in settings.keys():
             if not (key in settings_keys):
                 settings_keys.append(key)
-        settings_list.append(settings)
     # Create lists for all keys
     general_settings_history = {}
     for key in settings_keys:
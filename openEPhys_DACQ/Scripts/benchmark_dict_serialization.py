@@ -0,0 +1,95 @@
+"""
+Measures time to save and load a nested dictionary with NWBio.save_analysis and NWBio.load_analysis
+with one HDF5 dataset or group for each element (compact=False) and with elements stored
+in a single JSON-encoded dataset for each group (compact=True).
+
+The synthetic dictionary has sub-dictionaries of numbers, strings, lists of strings
+and lists of dictionaries, with a total of 10000 keys by default, and one numpy array.
+Loaded dictionaries are checked to be identical for both formats.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+from time import time
+
+import h5py
+import numpy as np
+
+from openEPhys_DACQ import NWBio
+
+
+def create_nested_dict(n_keys=10000, keys_per_dict=100, seed=0):
+    rng = np.random.RandomState(seed)
+    data = {'array': rng.randn(1000)}
+    n_dicts = max(1, n_keys // keys_per_dict)
+    for i in range(n_dicts):
+        sub_dict = {}
+        for j in range(keys_per_dict):
+            key = 'key_{}'.format(j)
+            if j % 4 == 0:
+                sub_dict[key] = int(rng.randint(1000))
+            elif j % 4 == 1:
+                sub_dict[key] = float(rng.randn())
+            elif j % 4 == 2:
+                sub_dict[key] = 'value_{}'.format(rng.randint(1000))
+            else:
+                sub_dict[key] = {'name': 'item_{}'.format(j), 'options': ['a', 'b', 'c']}
+        sub_dict['trials'] = [{'start': float(k), 'end': float(k) + 0.5, 'outcome': 'success'}
+                              for k in range(10)]
+        data['dict_{}'.format(i)] = sub_dict
+
+    return data
+
+
+def count_h5_objects(filename):
+    names = []
+    with h5py.File(filename, 'r') as h5file:
+        h5file.visit(names.append)
+
+    return len(names)
+
+
+def check_equal(a, b):
+    if isinstance(a, dict):
+        return isinstance(b, dict) and set(a.keys()) == set(b.keys()) and all(check_equal(a[key], b[key]) for key in a)
+    elif isinstance(a, list):
+        return isinstance(b, list) and len(a) == len(b) and all(check_equal(x, y) for x, y in zip(a, b))
+    else:
+        return type(a) == type(b) and np.array_equal(a, b)
+
+
+def benchmark(n_keys=10000, keys_per_dict=100):
+    data = create_nested_dict(n_keys=n_keys, keys_per_dict=keys_per_dict)
+    folder_path = tempfile.mkdtemp()
+    loaded = {}
+    try:
+        for compact in (False, True):
+            filename = os.path.join(folder_path, 'compact_{}.nwb'.format(compact))
+            with h5py.File(filename, 'w'):
+                pass
+            t_start = time()
+            NWBio.save_analysis(filename, data, compact=compact)
+            save_time = time() - t_start
+            t_start = time()
+            loaded[compact] = NWBio.load_analysis(filename)
+            load_time = time() - t_start
+            print('compact={!s:<5}: save {:.2f} s, load {:.2f} s, {} HDF5 objects, file size {:.2f} MB'.format(
+                compact, save_time, load_time, count_h5_objects(filename), os.path.getsize(filename) / 10 ** 6))
+    finally:
+        shutil.rmtree(folder_path)
+    print('Loaded dictionaries identical: {}'.format(check_equal(loaded[False], loaded[True])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark saving and loading nested dictionaries with NWBio.')
+    parser.add_argument('--keys', type=int, nargs=1, default=[10000],
+                        help='total number of keys in nested dictionary (default 10000)')
+    parser.add_argument('--keys_per_dict', type=int, nargs=1, default=[100],
+                        help='number of keys in each sub-dictionary (default 100)')
+    args = parser.parse_args()
+    benchmark(n_keys=args.keys[0], keys_per_dict=args.keys_per_dict[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Compares streaming lowpass filtering and downsampling with HelperFunctions.PolyphaseDownsampler
+against scipy.signal.decimate on the full signal, as previously used by HelperFunctions.lowpass_and_downsample.
+
+Amplitude and phase of the outputs are compared on synthetic linear chirps sweeping
+through the pass band and the transition band of the filter, using the analytic signal.
+
+Also measures total wall time of Processing.create_downsampled_data on a synthetic NWB file
+with 128 tetrode channels and AUX channels.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+from time import time
+
+import h5py
+import numpy as np
+from scipy.signal import chirp, decimate, hilbert
+
+from openEPhys_DACQ import HelperFunctions as hfunct
+from openEPhys_DACQ import NWBio
+from openEPhys_DACQ import Processing
+
+
+def streaming_downsample(signal_in, downsampling_factor, chunk_size):
+    downsampler = hfunct.PolyphaseDownsampler(downsampling_factor)
+    outputs = [downsampler.process(signal_in[i:i + chunk_size]) for i in range(0, signal_in.size, chunk_size)]
+    outputs.append(downsampler.flush())
+
+    return np.concatenate(outputs)
+
+
+def compare_on_chirp(sampling_rate, downsampling_factor, duration, chunk_size):
+    """Returns maximum relative amplitude error and maximum phase error in radians.
+    """
+    t = np.arange(int(duration * sampling_rate)) / float(sampling_rate)
+    f_max = 1.5 * sampling_rate / 2.0 / downsampling_factor
+    signal_in = chirp(t, 1.0, t[-1], f_max)
+    reference = hilbert(decimate(signal_in, downsampling_factor, ftype='fir', zero_phase=True))
+    output = hilbert(streaming_downsample(signal_in, downsampling_factor, chunk_size))
+    # Exclude edges, where analytic signal is not defined reliably
+    edge = reference.size // 20
+    reference, output = reference[edge:-edge], output[edge:-edge]
+    amplitude_error = np.max(np.abs(np.abs(output) - np.abs(reference))) / np.max(np.abs(reference))
+    # Phase is only compared where signal is not in the stop band of the filter
+    in_band = np.abs(reference) > 0.1 * np.max(np.abs(reference))
+    phase_error = np.max(np.abs(np.angle(output[in_band] * np.conj(reference[in_band]))))
+
+    return amplitude_error, phase_error
+
+
+def benchmark(sampling_rate=30000, downsampling_factor=30, duration=600.0, chunk_duration=10.0, seed=0):
+    chunk_size = int(chunk_duration * sampling_rate)
+    for factor in sorted({2, 10, downsampling_factor}):
+        amplitude_error, phase_error = compare_on_chirp(sampling_rate, factor, 10.0, chunk_size)
+        print('Chirp with downsampling factor {:>3}: max relative amplitude error {:.3g}, '
+              'max phase error {:.3g} rad'.format(factor, amplitude_error, phase_error))
+    signal_in = np.random.RandomState(seed).randint(-2000, 2000, size=int(duration * sampling_rate))
+    signal_in = signal_in.astype(np.int16)
+    t_start = time()
+    reference = decimate(signal_in, downsampling_factor, ftype='fir', zero_phase=True).astype(np.int16)
+    decimate_time = time() - t_start
+    t_start = time()
+    output = streaming_downsample(signal_in, downsampling_factor, chunk_size).astype(np.int16)
+    streaming_time = time() - t_start
+    print('{} seconds at {} Hz: decimate {:.2f} s, streaming {:.2f} s, max int16 difference {}'.format(
+        duration, sampling_rate, decimate_time, streaming_time, np.max(np.abs(output - reference))))
+
+
+def create_synthetic_nwb_file(filename, n_channels, duration, sampling_rate=30000, block_duration=10.0, seed=0):
+    rng = np.random.RandomState(seed)
+    n_samples = int(duration * sampling_rate)
+    block_size = int(block_duration * sampling_rate)
+    path = '/acquisition/timeseries/recording1/continuous/processor102_100/'
+    with h5py.File(filename, 'w') as h5file:
+        data = h5file.create_dataset(path + 'data', shape=(n_samples, n_channels), dtype=np.int16, chunks=True)
+        for first_sample in range(0, n_samples, block_size):
+            n_block_samples = min(block_size, n_samples - first_sample)
+            data[first_sample:first_sample + n_block_samples, :] = rng.randint(
+                -2000, 2000, size=(n_block_samples, n_channels)).astype(np.int16)
+        h5file[path + 'timestamps'] = np.arange(n_samples, dtype=np.float64) / sampling_rate
+
+
+def benchmark_file(n_tetrodes=32, n_aux_channels=3, duration=60.0, n_processes=None):
+    folder_path = tempfile.mkdtemp()
+    filename = os.path.join(folder_path, 'experiment_1.nwb')
+    try:
+        create_synthetic_nwb_file(filename, n_tetrodes * 4 + n_aux_channels, duration)
+        n_jobs = n_tetrodes + len(NWBio.list_AUX_channels(filename, n_tetrodes))
+        t_start = time()
+        Processing.create_downsampled_data(filename, n_tetrodes=n_tetrodes, n_processes=n_processes)
+        wall_time = time() - t_start
+    finally:
+        shutil.rmtree(folder_path)
+    print('create_downsampled_data for {} channels x {} seconds ({} channels downsampled): '
+          'wall time {:.2f} s, compared to {:.0f} s of fixed sleep(4) between channel jobs before'.format(
+              n_tetrodes * 4 + n_aux_channels, duration, n_jobs, wall_time, 4.0 * n_jobs))
+
+    return wall_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare streaming polyphase downsampling to scipy decimate.')
+    parser.add_argument('--downsampling_factor', type=int, nargs=1, default=[30],
+                        help='downsampling factor (default 30)')
+    parser.add_argument('--duration', type=float, nargs=1, default=[600.0],
+                        help='duration of synthetic signal in seconds (default 600)')
+    parser.add_argument('--chunk_duration', type=float, nargs=1, default=[10.0],
+                        help='duration of each chunk in seconds (default 10)')
+    parser.add_argument('--file_duration', type=float, nargs=1, default=[60.0],
+                        help='duration of synthetic 128 channel NWB file in seconds (default 60), 0 to skip')
+    parser.add_argument('--processes', type=int, nargs=1, default=[None],
+                        help='number of processes for create_downsampled_data (default by cores and memory)')
+    args = parser.parse_args()
+    benchmark(downsampling_factor=args.downsampling_factor[0], duration=args.duration[0],
+              chunk_duration=args.chunk_duration[0])
+    if args.file_duration[0] > 0:
+        benchmark_file(duration=args.file_duration[0], n_processes=args.processes[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Compares filtering a multichannel signal one channel at a time with
+HelperFunctions.butter_bandpass_filter against the batch variant
+HelperFunctions.butter_bandpass_filter_multichannel.
+
+The synthetic signal is generated and filtered in blocks of block_duration seconds,
+so that long durations with many channels can be benchmarked with bounded memory.
+"""
+import argparse
+from time import time
+
+import numpy as np
+
+from openEPhys_DACQ import HelperFunctions as hfunct
+
+
+def filter_per_channel(block):
+    out = np.zeros(block.shape, dtype=np.float64)
+    for n_chan in range(block.shape[1]):
+        out[:, n_chan] = hfunct.butter_bandpass_filter(block[:, n_chan], sampling_rate=30000.0,
+                                                       highpass_frequency=300.0, lowpass_frequency=6000.0,
+                                                       filt_order=4)
+    return out
+
+
+def benchmark(n_channels=128, duration=600.0, block_duration=10.0, sampling_rate=30000, seed=0):
+    rng = np.random.RandomState(seed)
+    block_size = int(block_duration * sampling_rate)
+    n_blocks = int(np.ceil(duration / block_duration))
+    times = {'per_channel': 0.0, 'multichannel_float64': 0.0, 'multichannel_float32_in_place': 0.0}
+    max_difference = {'multichannel_float64': 0.0, 'multichannel_float32_in_place': 0.0}
+    for n_block in range(n_blocks):
+        block = rng.randint(-2000, 2000, size=(block_size, n_channels)).astype(np.int16)
+
+        t_start = time()
+        out_per_channel = filter_per_channel(block)
+        times['per_channel'] += time() - t_start
+
+        t_start = time()
+        out_float64 = hfunct.butter_bandpass_filter_multichannel(block, sampling_rate=float(sampling_rate))
+        times['multichannel_float64'] += time() - t_start
+
+        out_float32 = block.astype(np.float32)
+        t_start = time()
+        hfunct.butter_bandpass_filter_multichannel(out_float32, sampling_rate=float(sampling_rate),
+                                                   float32=True, in_place=True)
+        times['multichannel_float32_in_place'] += time() - t_start
+
+        max_difference['multichannel_float64'] = max(max_difference['multichannel_float64'],
+                                                     np.max(np.abs(out_per_channel - out_float64)))
+        max_difference['multichannel_float32_in_place'] = max(max_difference['multichannel_float32_in_place'],
+                                                              np.max(np.abs(out_per_channel - out_float32)))
+        print('Block {}/{} done.'.format(n_block + 1, n_blocks), end='\r')
+    print('')
+
+    print('Filtered {} channels x {} seconds at {} Hz'.format(n_channels, duration, sampling_rate))
+    for key, value in times.items():
+        print('{:<32} {:8.2f} s  ({:.1f}x)'.format(key, value, times['per_channel'] / value))
+    for key, value in max_difference.items():
+        print('Maximum difference of {} from per_channel output: {:.3g}'.format(key, value))
+
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark per channel and multichannel band-pass filtering.')
+    parser.add_argument('--channels', type=int, nargs=1, default=[128], help='number of channels (default 128)')
+    parser.add_argument('--duration', type=float, nargs=1, default=[600.0],
+                        help='duration of synthetic signal in seconds (default 600)')
+    parser.add_argument('--block_duration', type=float, nargs=1, default=[10.0],
+                        help='duration of each block in seconds (default 10)')
+    args = parser.parse_args()
+    benchmark(n_channels=args.channels[0], duration=args.duration[0], block_duration=args.block_duration[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Compares KlustaKwik applied to all spikes of a tetrode with KlustaKwik applied to a random subsample
+of spikes, followed by assignment of remaining spikes to the clusters found
+(KlustaKwikWrapper.applyKlustaKwik_on_spike_data_tet with max_spikes_to_fit).
+
+Spikes are drawn from a synthetic mixture of units with different waveform amplitudes on each channel.
+Reports subsample size, time spent on KlustaKwik fit and on assignment, and agreement
+(adjusted Rand index) between the full run, the subsampled run and the true units.
+Agreement of assignment alone is also reported by assigning spikes based on true units of the subsample.
+
+Requires KlustaKwik, set with --klustakwik_path or in package configuration. If KlustaKwik is not found,
+only assignment based on true units of subsample is measured, as with --assignment_only.
+"""
+import argparse
+import json
+import os
+from time import time
+
+import numpy as np
+
+from openEPhys_DACQ import KlustaKwikWrapper
+from openEPhys_DACQ.package_configuration import PackageConfiguration
+
+
+def create_synthetic_mixture(n_spikes, n_units=8, n_samples=40, noise=20.0, seed=0):
+    """Returns waveforms (n_spikes x 4 x n_samples) int16 array and unit label of each spike.
+    """
+    rng = np.random.RandomState(seed)
+    t = np.arange(n_samples) / float(n_samples)
+    trough_time = rng.uniform(0.25, 0.35, n_units)
+    trough_width = rng.uniform(0.03, 0.08, n_units)
+    amplitudes = rng.uniform(50, 400, (n_units, 4))
+    labels = rng.randint(n_units, size=n_spikes)
+    shapes = (-np.exp(-((t[None, :] - trough_time[:, None]) / trough_width[:, None]) ** 2)
+              + 0.3 * np.exp(-((t[None, :] - trough_time[:, None] - 0.2) / 0.1) ** 2))
+    templates = amplitudes[:, :, None] * shapes[:, None, :]
+    waveforms = np.zeros((n_spikes, 4, n_samples), dtype=np.int16)
+    for start in range(0, n_spikes, 100000):
+        batch_labels = labels[start:start + 100000]
+        scaling = rng.uniform(0.9, 1.1, (batch_labels.size, 1, 1))
+        waveforms[start:start + 100000] = np.round(templates[batch_labels] * scaling
+                                                   + rng.normal(0, noise, (batch_labels.size, 4, n_samples)))
+
+    return waveforms, labels
+
+
+def adjusted_rand_index(labels_a, labels_b):
+    _, labels_a = np.unique(labels_a, return_inverse=True)
+    _, labels_b = np.unique(labels_b, return_inverse=True)
+    contingency = np.zeros((labels_a.max() + 1, labels_b.max() + 1))
+    np.add.at(contingency, (labels_a, labels_b), 1)
+
+    def pairs(x):
+        return np.sum(x * (x - 1) / 2.0)
+
+    sum_pairs = pairs(contingency)
+    sum_a = pairs(np.sum(contingency, axis=1))
+    sum_b = pairs(np.sum(contingency, axis=0))
+    expected = sum_a * sum_b / pairs(np.array([float(labels_a.size)]))
+    maximum = (sum_a + sum_b) / 2.0
+
+    return (sum_pairs - expected) / (maximum - expected)
+
+
+def time_assignment(features, fit_idx, fit_clusterIDs, method):
+    # KlustaKwik is run with -DropLastNFeatures 1, so the last feature is not used for assignment
+    t_start = time()
+    clusterIDs = KlustaKwikWrapper.assign_spikes_to_clusters(features[:, :-1], features[fit_idx, :-1],
+                                                             fit_clusterIDs, method=method)
+
+    return clusterIDs, time() - t_start
+
+
+def find_klustakwik_path(klustakwik_path=None):
+    """Returns klustakwik_path, or path in package configuration if not provided, or None if file does not exist.
+    Package configuration is not created if it does not exist.
+    """
+    if klustakwik_path is None and os.path.isfile(PackageConfiguration.config_file_path):
+        with open(PackageConfiguration.config_file_path, 'r') as config_file:
+            klustakwik_path = json.loads(config_file.read())['klustakwik_path']
+    if klustakwik_path is None or not os.path.isfile(klustakwik_path):
+        return None
+
+    return klustakwik_path
+
+
+def benchmark(n_spikes=200000, max_spikes_to_fit=20000, n_units=8, method='mahalanobis', skip_full=False,
+              assignment_only=False, klustakwik_path=None):
+    waveforms, labels = create_synthetic_mixture(n_spikes, n_units=n_units)
+    spike_data_tet = {'waveforms': waveforms, 'idx_keep': np.ones(n_spikes, dtype=bool)}
+    features = KlustaKwikWrapper.compute_klustakwik_features(waveforms, KlustaKwikWrapper.KLUSTAKWIK_FEATURES)
+    spike_data_tet['features'] = features
+    fit_idx = KlustaKwikWrapper.subsample_spike_indices(n_spikes, max_spikes_to_fit)
+    print('{} spikes of {} units, subsample of {} spikes, {} assignment'.format(
+        n_spikes, n_units, fit_idx.size, method))
+
+    # Assignment alone, based on true units of subsample
+    assigned, assignment_time = time_assignment(features, fit_idx, labels[fit_idx], method)
+    print('Assignment with true units of subsample: {:.2f} s, adjusted Rand index to true units {:.4f}'.format(
+        assignment_time, adjusted_rand_index(assigned, labels)))
+    if assignment_only:
+        return
+    kk_path = find_klustakwik_path(klustakwik_path)
+    if kk_path is None:
+        print('KlustaKwik not found, agreement of subsampled and full KlustaKwik was not measured.\n'
+              'Set path to KlustaKwik executable with --klustakwik_path or in package configuration.')
+        return
+
+    t_start = time()
+    clusterIDs_subsample = KlustaKwikWrapper.applyKlustaKwik_on_spike_data_tet(spike_data_tet,
+                                                                               max_spikes_to_fit=max_spikes_to_fit,
+                                                                               kk_path=kk_path)
+    subsample_time = time() - t_start
+    _, assignment_time = time_assignment(features, fit_idx, clusterIDs_subsample[fit_idx], method)
+    print('Subsampled KlustaKwik: fit {:.2f} s, assignment {:.2f} s, '
+          'adjusted Rand index to true units {:.4f}'.format(
+              subsample_time - assignment_time, assignment_time, adjusted_rand_index(clusterIDs_subsample, labels)))
+    if skip_full:
+        return
+    t_start = time()
+    clusterIDs_full = KlustaKwikWrapper.applyKlustaKwik_on_spike_data_tet(spike_data_tet, kk_path=kk_path)
+    full_time = time() - t_start
+    print('Full KlustaKwik: {:.2f} s, adjusted Rand index to true units {:.4f}'.format(
+        full_time, adjusted_rand_index(clusterIDs_full, labels)))
+    print('Agreement of subsampled and full KlustaKwik: adjusted Rand index {:.4f}'.format(
+        adjusted_rand_index(clusterIDs_subsample, clusterIDs_full)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare subsampled and full KlustaKwik on synthetic spikes.')
+    parser.add_argument('--spikes', type=int, nargs=1, default=[200000],
+                        help='number of synthetic spikes (default 200000)')
+    parser.add_argument('--subsample', type=int, nargs=1, default=[20000],
+                        help='number of spikes to apply KlustaKwik to (default 20000)')
+    parser.add_argument('--units', type=int, nargs=1, default=[8],
+                        help='number of units in synthetic mixture (default 8)')
+    parser.add_argument('--method', type=str, nargs=1, default=['mahalanobis'],
+                        help='assignment method: mahalanobis (default) or nearest')
+    parser.add_argument('--skip_full', action='store_true',
+                        help='to skip applying KlustaKwik to all spikes')
+    parser.add_argument('--assignment_only', action='store_true',
+                        help='to only measure assignment based on true units of subsample, without KlustaKwik')
+    parser.add_argument('--klustakwik_path', type=str, nargs=1, default=[None],
+                        help='path to KlustaKwik executable (default is klustakwik_path in package configuration)')
+    args = parser.parse_args()
+    benchmark(n_spikes=args.spikes[0], max_spikes_to_fit=args.subsample[0], n_units=args.units[0],
+              method=args.method[0], skip_full=args.skip_full, assignment_only=args.assignment_only,
+              klustakwik_path=args.klustakwik_path[0])
+
+
+if __name__ == '__main__':
+    main()
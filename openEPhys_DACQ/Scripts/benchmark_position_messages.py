@@ -0,0 +1,123 @@
+"""
+Measures messages per second and latency of publishing position samples over ZMQ on the loopback
+interface with binary and JSON position message formats, as sent by CameraRPiController.OnlineTracker
+and received by RPiInterface.onlineTrackingData.
+
+JSON messages carry the send time as an extra element at the end of the list for latency measurement.
+"""
+import argparse
+from multiprocessing import Process
+from time import time, sleep
+
+import numpy as np
+import zmq
+
+from openEPhys_DACQ.ZMQcomms import (POSITION_MESSAGE_DTYPE, encode_position_message, decode_position_messages,
+                                     encode_json_position_message, decode_json_position_message)
+from openEPhys_DACQ.RPiInterface import onlineTrackingData
+
+
+def publisher(port, message_format, n_messages, rate):
+    context = zmq.Context()
+    socket = context.socket(zmq.PUB)
+    socket.setsockopt(zmq.SNDHWM, 0)
+    socket.bind('tcp://127.0.0.1:{}'.format(port))
+    sleep(1.0)  # Give time to establish sockets for ZeroMQ
+    linedata = [123.456, 78.9, 125.1, 80.2, 230, None]
+    start_time = time()
+    for n_message in range(n_messages):
+        if rate > 0:
+            sleep(max(0, start_time + n_message / float(rate) - time()))
+        if message_format == 'json':
+            message = encode_json_position_message(linedata + [time()])
+        else:
+            message = encode_position_message(linedata)
+        socket.send(message)
+    sleep(0.5)
+    socket.close()
+    context.term()
+
+
+def run(message_format, n_messages, rate, port, max_messages_per_update=100):
+    """Returns receive times and send times of all received messages.
+    """
+    context = zmq.Context()
+    sockSUB = context.socket(zmq.SUB)
+    sockSUB.setsockopt(zmq.SUBSCRIBE, ''.encode())
+    sockSUB.setsockopt(zmq.RCVHWM, 0)
+    sockSUB.RCVTIMEO = 100
+    sockSUB.connect('tcp://127.0.0.1:{}'.format(port))
+    P_publisher = Process(target=publisher, args=(port, message_format, n_messages, rate))
+    P_publisher.start()
+    buffer = np.zeros(max_messages_per_update, dtype=POSITION_MESSAGE_DTYPE)
+    send_times = np.zeros(n_messages, dtype=np.float64)
+    receive_times = np.zeros(n_messages, dtype=np.float64)
+    n_received = 0
+    last_message_time = time()
+    while n_received < n_messages and time() - last_message_time < 3.0:
+        messages = onlineTrackingData.receive_messages(sockSUB, max_messages_per_update)
+        if len(messages) == 0:
+            continue
+        last_message_time = time()
+        if message_format == 'json':
+            for message in messages:
+                send_times[n_received] = decode_json_position_message(message)[-1]
+                receive_times[n_received] = last_message_time
+                n_received += 1
+        else:
+            decoded = decode_position_messages(messages, out=buffer)
+            send_times[n_received:n_received + decoded.size] = decoded['timestamp']
+            receive_times[n_received:n_received + decoded.size] = time()
+            n_received += decoded.size
+    P_publisher.join()
+    sockSUB.close()
+    context.term()
+
+    return send_times[:n_received], receive_times[:n_received]
+
+
+def benchmark_encoding(n_messages=100000):
+    linedata = [123.456, 78.9, 125.1, 80.2, 230, None]
+    for message_format in ('binary', 'json'):
+        t_start = time()
+        if message_format == 'json':
+            messages = [encode_json_position_message(linedata) for _ in range(n_messages)]
+        else:
+            messages = [encode_position_message(linedata) for _ in range(n_messages)]
+        encoding_time = time() - t_start
+        t_start = time()
+        if message_format == 'json':
+            _ = np.array([decode_json_position_message(message) for message in messages], dtype=np.float64)
+        else:
+            _ = decode_position_messages(messages)
+        decoding_time = time() - t_start
+        print('{:<8} encoding {:6.2f} us/message, decoding {:6.2f} us/message, {} bytes/message'.format(
+            message_format, encoding_time / n_messages * 10 ** 6, decoding_time / n_messages * 10 ** 6,
+            len(messages[0])))
+
+
+def benchmark(n_messages=100000, rate=30.0, port=5990):
+    benchmark_encoding(n_messages)
+    for message_format in ('binary', 'json'):
+        send_times, receive_times = run(message_format, n_messages, 0, port)
+        print('{:<8} loopback throughput {:10.1f} messages/s ({} of {} received)'.format(
+            message_format, send_times.size / (receive_times[-1] - send_times[0]), send_times.size, n_messages))
+        send_times, receive_times = run(message_format, int(10 * rate), rate, port)
+        latencies = (receive_times - send_times) * 1000
+        print('{:<8} loopback latency at {} Hz: median {:.3f} ms, 99th percentile {:.3f} ms, max {:.3f} ms'.format(
+            message_format, rate, np.median(latencies), np.percentile(latencies, 99), np.max(latencies)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark binary and JSON position messages over ZMQ.')
+    parser.add_argument('--messages', type=int, nargs=1, default=[100000],
+                        help='number of messages for throughput measurement (default 100000)')
+    parser.add_argument('--rate', type=float, nargs=1, default=[30.0],
+                        help='messages per second for latency measurement (default 30)')
+    parser.add_argument('--port', type=int, nargs=1, default=[5990], help='loopback port to use (default 5990)')
+    args = parser.parse_args()
+    benchmark(n_messages=args.messages[0], rate=args.rate[0], port=args.port[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Measures throughput and latency of passing camera frames between processes with
+SharedMemoryBuffers.SharedArrayQueue, as used by CameraRPiController.RawYUV_Processor,
+with multiprocessing.Queue as reference.
+
+Throughput is measured with frames put into the queue as fast as possible.
+Latency is measured from put() to get() with frames put into the queue at specified frame rate.
+"""
+import argparse
+from multiprocessing import Process, Queue, RawArray
+from ctypes import c_uint8, c_double
+from time import time, sleep
+
+import numpy as np
+
+from openEPhys_DACQ.SharedMemoryBuffers import SharedArrayQueue
+
+
+def consume_shared_array_queue(queue, receive_times, consumer):
+    receive_times = np.frombuffer(receive_times, dtype=np.float64)
+    while True:
+        item = queue.get(consumer=consumer)
+        if isinstance(item, str):
+            break
+        receive_times[int(item.flat[0]) + 256 * int(item.flat[1])] = time()
+
+
+def consume_multiprocessing_queue(queue, receive_times):
+    receive_times = np.frombuffer(receive_times, dtype=np.float64)
+    while True:
+        item = queue.get()
+        if not isinstance(item, np.ndarray):
+            break
+        receive_times[int(item.flat[0]) + 256 * int(item.flat[1])] = time()
+
+
+def run(queue_type, frame_shape, n_frames, fps, n_consumers, queue_length):
+    """Returns put times and receive times of each consumer for all frames.
+    """
+    frames = np.random.RandomState(0).randint(0, 256, size=(2,) + frame_shape).astype(np.uint8)
+    receive_times = [RawArray(c_double, n_frames) for _ in range(n_consumers)]
+    if queue_type == 'SharedArrayQueue':
+        queue = SharedArrayQueue(c_uint8, frame_shape, queue_length, n_consumers=n_consumers)
+        consumers = [Process(target=consume_shared_array_queue, args=(queue, receive_times[i], i))
+                     for i in range(n_consumers)]
+        queues = [queue]
+    else:
+        queues = [Queue(queue_length) for _ in range(n_consumers)]
+        consumers = [Process(target=consume_multiprocessing_queue, args=(queues[i], receive_times[i]))
+                     for i in range(n_consumers)]
+    for consumer in consumers:
+        consumer.start()
+    sleep(0.5)
+    put_times = np.zeros(n_frames, dtype=np.float64)
+    start_time = time()
+    for n_frame in range(n_frames):
+        if fps > 0:
+            sleep(max(0, start_time + n_frame / float(fps) - time()))
+        frame = frames[n_frame % 2]
+        frame.flat[0] = n_frame % 256
+        frame.flat[1] = n_frame // 256
+        put_times[n_frame] = time()
+        if queue_type != 'SharedArrayQueue':
+            # multiprocessing.Queue pickles items in a separate thread after put() returns
+            frame = frame.copy()
+        for queue in queues:
+            queue.put(frame, block=True)
+    for queue in queues:
+        queue.put('STOP', block=True)
+    for consumer in consumers:
+        consumer.join()
+
+    return put_times, [np.frombuffer(x, dtype=np.float64) for x in receive_times]
+
+
+def benchmark(frame_shape=(480, 720, 1), n_frames=2000, fps=30.0, n_consumers=1, queue_length=50):
+    print('Frames of shape {} ({:.2f} MB), {} consumer(s), queue length {}'.format(
+        frame_shape, np.prod(frame_shape) / 10 ** 6, n_consumers, queue_length))
+    for queue_type in ('SharedArrayQueue', 'multiprocessing.Queue'):
+        put_times, receive_times = run(queue_type, frame_shape, n_frames, 0, n_consumers, queue_length)
+        duration = max(np.max(x) for x in receive_times) - put_times[0]
+        print('{:<24} throughput {:10.1f} frames/s'.format(queue_type, n_frames / duration))
+        n_latency_frames = int(min(n_frames, 10 * fps))
+        put_times, receive_times = run(queue_type, frame_shape, n_latency_frames, fps, n_consumers, queue_length)
+        latencies = np.concatenate([x - put_times for x in receive_times]) * 1000
+        print('{:<24} latency at {} fps: median {:.3f} ms, 99th percentile {:.3f} ms, max {:.3f} ms'.format(
+            queue_type, fps, np.median(latencies), np.percentile(latencies, 99), np.max(latencies)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark SharedArrayQueue throughput and latency.')
+    parser.add_argument('--frame_shape', type=int, nargs=3, default=[480, 720, 1],
+                        help='frame shape (default 480 720 1)')
+    parser.add_argument('--frames', type=int, nargs=1, default=[2000],
+                        help='number of frames for throughput measurement (default 2000)')
+    parser.add_argument('--fps', type=float, nargs=1, default=[30.0],
+                        help='frame rate for latency measurement (default 30)')
+    parser.add_argument('--consumers', type=int, nargs=1, default=[1], help='number of consumers (default 1)')
+    parser.add_argument('--queue_length', type=int, nargs=1, default=[50], help='queue length (default 50)')
+    args = parser.parse_args()
+    benchmark(frame_shape=tuple(args.frame_shape), n_frames=args.frames[0], fps=args.fps[0],
+              n_consumers=args.consumers[0], queue_length=args.queue_length[0])
+
+
+if __name__ == '__main__':
+    main()
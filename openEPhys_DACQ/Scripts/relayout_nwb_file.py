@@ -0,0 +1,59 @@
+"""
+Rewrites continuous data in an NWB file into chunks of (time x channel group) with optional compression
+using NWBio.relayout_NWB_file and reports read throughput of tetrode-slice and time-slice access patterns
+of each rewritten dataset before and after.
+
+Note that throughput measurements include the effect of file system caching,
+which may favour the rewritten file as it has just been written.
+"""
+import argparse
+import os
+
+from openEPhys_DACQ import NWBio
+
+
+def measure_all(filename, paths, n_reads):
+    return {(path, access_pattern): NWBio.measure_read_throughput(filename, path, access_pattern, n_reads=n_reads)
+            for path in paths for access_pattern in ('tetrode', 'time')}
+
+
+def relayout_and_report(filename, output_filename=None, chunk_samples=16384, channels_per_chunk=4,
+                        compression=None, n_reads=10):
+    paths = NWBio.get_relayout_dataset_paths(filename)
+    size_before = os.path.getsize(filename)
+    throughput_before = measure_all(filename, paths, n_reads)
+    NWBio.relayout_NWB_file(filename, output_filename=output_filename, chunk_samples=chunk_samples,
+                            channels_per_chunk=channels_per_chunk, compression=compression)
+    if output_filename is None:
+        output_filename = filename
+    size_after = os.path.getsize(output_filename)
+    throughput_after = measure_all(output_filename, paths, n_reads)
+    print('File size {:.1f} MB before, {:.1f} MB after'.format(size_before / 10 ** 6, size_after / 10 ** 6))
+    for path, access_pattern in sorted(throughput_before):
+        print('{:<80} {:<8} read {:10.1f} MB/s before, {:10.1f} MB/s after'.format(
+            path, access_pattern, throughput_before[(path, access_pattern)],
+            throughput_after[(path, access_pattern)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rewrite NWB file continuous data into new chunk layout.')
+    parser.add_argument('filename', type=str, nargs=1, help='path to NWB file')
+    parser.add_argument('--output', type=str, nargs=1, default=[None],
+                        help='path to output file (default replaces original file)')
+    parser.add_argument('--chunk_samples', type=int, nargs=1, default=[16384],
+                        help='number of samples in each chunk (default 16384)')
+    parser.add_argument('--channels_per_chunk', type=int, nargs=1, default=[4],
+                        help='number of channels in each chunk (default 4)')
+    parser.add_argument('--compression', type=str, nargs=1, default=['none'],
+                        help='compression: none (default), lzf or gzip (shuffle and gzip level 1)')
+    parser.add_argument('--reads', type=int, nargs=1, default=[10],
+                        help='number of random reads for throughput measurement (default 10)')
+    args = parser.parse_args()
+    compression = None if args.compression[0] == 'none' else args.compression[0]
+    relayout_and_report(args.filename[0], output_filename=args.output[0], chunk_samples=args.chunk_samples[0],
+                        channels_per_chunk=args.channels_per_chunk[0], compression=compression,
+                        n_reads=args.reads[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+"""
+Buffers for passing numpy arrays between processes through pre-allocated shared memory.
+
+This module only depends on numpy and standard library, as it is also copied to
+and used on the Raspberry Pi cameras alongside CameraRPiController.py.
+"""
+from __future__ import division
+import numpy as np
+from multiprocessing import RawArray, Lock
+from ctypes import c_int32, c_int64, c_int8, c_float, c_double
+from functools import reduce
+from time import sleep, time
+
+
+def create_shared_array(ctype, array_shape):
+    '''
+    Returns a multiprocessing.RawArray and its Numpy wrapper.
+    '''
+    numel = int(reduce(lambda x, y: x*y, array_shape, 1))
+    shared_array = RawArray(ctype, numel)
+    shared_array_wrapper = np.frombuffer(shared_array, dtype=ctype).reshape(array_shape)
+
+    return shared_array, shared_array_wrapper
+
+
+class SharedArrayQueue(object):
+    '''
+    Single-producer/multi-consumer ring buffer of numpy arrays with specified size and ctype,
+    for fast transfer of data between processes using pre-allocated shared memory.
+
+    Replicates Queue functionality, but every consumer receives every item in the queue.
+    The write position (head) and the read position of each consumer (tails) are stored in
+    shared memory alongside the data, each written only by a single process, therefore
+    put() and get() do not require Manager proxies and take constant time.
+
+    Positions are only read and written while holding a multiprocessing.Lock. The lock is
+    not needed for mutual exclusion, but acquiring and releasing it is a memory barrier,
+    which guarantees that the data in a slot is visible to a consumer once the head has been
+    advanced past it, and to the producer once the tail has been advanced past it,
+    also on weakly ordered CPUs such as the ARM processor of Raspberry Pi.
+
+    Positions are stored modulo 2 * max_queue_length, to distinguish full queue from empty,
+    which keeps the values small enough for atomic 32-bit access.
+
+    The instance must be passed to consumer processes as an argument at Process creation.
+    Each consumer process must use a different consumer index in get().
+    '''
+    ARRAY_ITEM = 1
+    OTHER_ITEM = 0
+
+    def __init__(self, ctype, array_shape, max_queue_length, n_consumers=1, poll_interval=0.0005):
+        '''
+        ctype - ctypes of the arrays e.g. c_uint8.
+        array_shape - tuple - dimensions of the array, e.g. (480, 720).
+        max_queue_length - int - number of pre-allocated shared arrays.
+            Note! Too high value for large arrays could cause Out Of Memory errors.
+        n_consumers - int - number of consumers that each get all items in the queue.
+        poll_interval - float - seconds to sleep between checks while waiting in get() and put().
+        '''
+        self.ctype = ctype
+        self.array_shape = tuple(array_shape)
+        self.max_queue_length = int(max_queue_length)
+        self.n_consumers = int(n_consumers)
+        self.poll_interval = poll_interval
+        self._position_modulo = 2 * self.max_queue_length
+        self._shared_data, _ = create_shared_array(ctype, (self.max_queue_length,) + self.array_shape)
+        self._shared_item_types, _ = create_shared_array(c_int8, (self.max_queue_length,))
+        self._shared_head, _ = create_shared_array(c_int32, (1,))
+        self._shared_tails, _ = create_shared_array(c_int32, (self.n_consumers,))
+        self._positions_lock = Lock()
+        self._create_wrappers()
+
+    def _create_wrappers(self):
+        self._data = np.frombuffer(self._shared_data, dtype=self.ctype).reshape(
+            (self.max_queue_length,) + self.array_shape)
+        self._item_types = np.frombuffer(self._shared_item_types, dtype=np.int8)
+        self._head = np.frombuffer(self._shared_head, dtype=np.int32)
+        self._tails = np.frombuffer(self._shared_tails, dtype=np.int32)
+        self._pending = np.zeros(self.n_consumers, dtype=bool)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('_data', '_item_types', '_head', '_tails', '_pending'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._create_wrappers()
+
+    def _positions(self):
+        with self._positions_lock:
+            return int(self._head[0]), [int(tail) for tail in self._tails]
+
+    def _n_items(self, head, tail):
+        return (head - tail) % self._position_modulo
+
+    def _slot(self, position):
+        return int(position) % self.max_queue_length
+
+    def _release_pending(self, consumer):
+        if self._pending[consumer]:
+            self._pending[consumer] = False
+            # Slot is made available to the producer only after it has been fully read
+            with self._positions_lock:
+                self._tails[consumer] = (int(self._tails[consumer]) + 1) % self._position_modulo
+
+    def full(self):
+        '''
+        Returns True if no more items can be put into the queue before consumers get items.
+        '''
+        return self.qsize() >= self.max_queue_length
+
+    def put(self, data, block=False):
+        '''
+        Stores data into next location in shared memory if data is numpy.ndarray.
+        If data is not numpy.ndarray, using get on this item in the queue will return string 'IncorrectItem'.
+        If max_queue_length has been reached and block=False (default), an Exception is raised.
+        If max_queue_length has been reached and block=True, method waits until space in queue is available.
+
+        Must only be called from a single process.
+        '''
+        while self.full():
+            if block:
+                sleep(self.poll_interval)
+            else:
+                raise Exception('SharedArrayQueue pre-allocated memory full!')
+        head, _ = self._positions()
+        slot = self._slot(head)
+        if isinstance(data, np.ndarray):
+            np.copyto(self._data[slot], data)
+            self._item_types[slot] = SharedArrayQueue.ARRAY_ITEM
+        else:
+            self._item_types[slot] = SharedArrayQueue.OTHER_ITEM
+        # Item is made available to consumers only after it has been fully written
+        with self._positions_lock:
+            self._head[0] = (head + 1) % self._position_modulo
+
+    def get(self, timeout=None, consumer=0, copy=False):
+        '''
+        Returns the next numpy.ndarray in the queue and waits until available.
+        If anything else has been put into queue, get() returns 'IncorrectItem'.
+        If timeout is specified and item is not available, get()
+        waits until timeout seconds and returns 'TimeoutReached'.
+
+        consumer - int - index of the consumer (0 to n_consumers - 1) calling this method.
+        copy - bool - if False (default), returned array is a view of the shared memory.
+            The view remains valid until the next call to get() or release() by the same consumer,
+            as the producer can not overwrite it before that.
+        '''
+        self._release_pending(consumer)
+        if not (timeout is None):
+            timeout_start_time = time()
+        while True:
+            head, tails = self._positions()
+            if self._n_items(head, tails[consumer]) > 0:
+                break
+            # Return 'TimeoutReached' if timeout has been reached
+            if not (timeout is None) and time() - timeout_start_time > timeout:
+                return 'TimeoutReached'
+            sleep(self.poll_interval)
+        slot = self._slot(tails[consumer])
+        if self._item_types[slot] == SharedArrayQueue.ARRAY_ITEM:
+            if copy:
+                data = self._data[slot].copy()
+                self._pending[consumer] = True
+                self._release_pending(consumer)
+            else:
+                data = self._data[slot]
+                self._pending[consumer] = True
+            return data
+        else:
+            self._pending[consumer] = True
+            self._release_pending(consumer)
+            return 'IncorrectItem'
+
+    def release(self, consumer=0):
+        '''
+        Releases the item last returned by get() to consumer, allowing the producer to overwrite it.
+        This is also done automatically by the next get() call by the same consumer.
+        '''
+        self._release_pending(consumer)
+
+    def qsize(self):
+        '''
+        Returns the largest number of items in the queue not yet released by any consumer.
+        '''
+        head, tails = self._positions()
+        return max(self._n_items(head, tail) for tail in tails)
+
+    def join(self):
+        '''
+        Waits until all items have been acquired from the queue by all consumers.
+        '''
+        while self.qsize() > 0:
+            sleep(self.poll_interval)
+
+
+class PositionHistoryBuffer(object):
+    '''
+    Circular buffer of position samples in shared memory with fixed horizon (maximum number of samples).
+
+    Positions are appended by a single process or thread and can be read from any process,
+    with the cost of a read only depending on the number of samples requested.
+    Missing positions are stored as NaN values and marked invalid.
+
+    As the oldest sample in a full buffer may be overwritten by append() at any time,
+    reads only return the latest horizon - 1 samples once horizon has been reached,
+    e.g. last(len(buffer)) returns horizon - 1 samples from a full buffer.
+
+    The instance must be passed to other processes as an argument at Process creation.
+    '''
+
+    def __init__(self, horizon, n_columns=4):
+        '''
+        horizon - int - maximum number of latest samples kept in the buffer
+        n_columns - int - number of values in each position sample, e.g. 4 for (x1, y1, x2, y2)
+        '''
+        self.horizon = int(horizon)
+        self.n_columns = int(n_columns)
+        self._shared_positions, _ = create_shared_array(c_float, (self.horizon, self.n_columns))
+        self._shared_timestamps, _ = create_shared_array(c_double, (self.horizon,))
+        self._shared_valid, _ = create_shared_array(c_int8, (self.horizon,))
+        self._shared_n_appended, _ = create_shared_array(c_int64, (1,))
+        self._create_wrappers()
+
+    def _create_wrappers(self):
+        self._positions = np.frombuffer(self._shared_positions, dtype=np.float32).reshape(
+            (self.horizon, self.n_columns))
+        self._timestamps = np.frombuffer(self._shared_timestamps, dtype=np.float64)
+        self._valid = np.frombuffer(self._shared_valid, dtype=np.int8)
+        self._n_appended = np.frombuffer(self._shared_n_appended, dtype=np.int64)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('_positions', '_timestamps', '_valid', '_n_appended'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._create_wrappers()
+
+    @property
+    def n_appended(self):
+        '''
+        Total number of samples appended to the buffer.
+        '''
+        return int(self._n_appended[0])
+
+    def __len__(self):
+        '''
+        Returns the number of samples currently available in the buffer.
+        '''
+        return min(self.n_appended, self.horizon)
+
+    def append(self, position, timestamp=None):
+        '''
+        Appends a position sample to the buffer, overwriting the oldest sample if horizon has been reached.
+
+        Must only be called from a single process or thread.
+
+        position - list or numpy array with n_columns elements, or None if position is not available
+        timestamp - float - time of the sample. If None (default), current time is used.
+        '''
+        n_appended = self.n_appended
+        slot = n_appended % self.horizon
+        if position is None:
+            self._positions[slot, :] = np.nan
+            self._valid[slot] = 0
+        else:
+            self._positions[slot, :] = position
+            self._valid[slot] = 1
+        self._timestamps[slot] = time() if timestamp is None else timestamp
+        # Sample is made available to readers only after it has been fully written
+        self._n_appended[0] = n_appended + 1
+
+    def _copy(self, first, last):
+        '''
+        Returns copies of samples from first to last (exclusive) in order of appending.
+        '''
+        slots = np.arange(first, last) % self.horizon
+        return self._timestamps[slots], self._positions[slots, :], self._valid[slots].astype(bool)
+
+    def _read(self, find_first):
+        '''
+        Returns samples from find_first(first_available, last) until the latest sample,
+        repeating the read if any of the samples were overwritten during copying.
+
+        Appending sample m overwrites the slot of sample m - horizon before n_appended is incremented,
+        therefore the copy is only consistent if first > n_appended - horizon after copying
+        and the oldest sample in a full buffer is never available to read.
+        '''
+        while True:
+            last = self.n_appended
+            first = find_first(max(0, last - self.horizon + 1), last)
+            timestamps, positions, valid = self._copy(first, last)
+            if self.n_appended - self.horizon < first:
+                return timestamps, positions, valid
+
+    def last(self, n):
+        '''
+        Returns n latest samples, or all available samples if fewer are available.
+        At most horizon - 1 samples are available once horizon has been reached.
+
+        Returns:
+            timestamps - numpy.ndarray - shape (n,)
+            positions - numpy.ndarray - shape (n, n_columns), with NaN values for missing positions
+            valid - numpy.ndarray - shape (n,), boolean, False for missing positions
+        '''
+        return self._read(lambda first, last: max(first, last - int(n)))
+
+    def since(self, t):
+        '''
+        Returns all available samples with timestamp greater than or equal to t.
+
+        Returns the same output as PositionHistoryBuffer.last()
+        '''
+        def find_first(first, last):
+            # Binary search for first sample with timestamp >= t
+            while first < last:
+                middle = (first + last) // 2
+                if self._timestamps[middle % self.horizon] < t:
+                    first = middle + 1
+                else:
+                    last = middle
+            return first
+
+        return self._read(find_first)
+
+    @staticmethod
+    def as_list(positions, valid):
+        '''
+        Returns positions as a list of lists, with None for positions that are not valid.
+        '''
+        return [position if is_valid else None for position, is_valid in zip(positions.tolist(), valid)]
+
+    def last_as_list(self, n):
+        '''
+        Returns n latest positions as output from PositionHistoryBuffer.as_list()
+        '''
+        _, positions, valid = self.last(n)
+        return PositionHistoryBuffer.as_list(positions, valid)
@@ -1506,7 +1506,7 @@ class PositionList(object):
         while len(self._processed_position_list) <= self.list_len:
             sleep(0.1)
 
-        self._position_list = self._processed_position_list[-self.list_len:]
+        self._position_list = self._processed_position_list.last_as_list(self.list_len)
 
         self.lock = Lock()
         self.updating = True
@@ -1522,7 +1522,7 @@ class PositionList(object):
                 sleep(update_interval * 0.1)
                 continue
 
-            data = copy(self._processed_position_list[-self.list_len:])
+            data = self._processed_position_list.last_as_list(self.list_len)
             with self.lock:
                 self._position_list = data
 
@@ -2843,7 +2843,7 @@ class Core(object):
 
         :param TaskSettings:
         :param multiprocessing.connection open_ephys_message_pipe:
-        :param multiprocessing.managers.List processed_position_list:
+        :param openEPhys_DACQ.SharedMemoryBuffers.PositionHistoryBuffer processed_position_list:
         :param int processed_position_update_interval:
         :param multiprocessing.Array position_histogram_array:
         :param multiprocessing.managers.Dict position_histogram_dict:
@@ -13,7 +13,161 @@ from itertools import combinations
 import numpy as np
 from scipy.spatial.distance import euclidean
 from openEPhys_DACQ import NWBio
-from tqdm import tqdm
+
+
+def get_camera_locations(cameraIDs, CameraSettings):
+    """Returns camera locations as numpy.float32 array with shape (n_cameras, 2) in order of cameraIDs.
+    """
+    camera_locations = []
+    for cameraID in cameraIDs:
+        camera_locations.append(CameraSettings['CameraSpecific'][cameraID]['location_xy'])
+
+    return np.array(camera_locations, dtype=np.float32)
+
+
+def find_camera_data_inside_arena(cameraPos, arena_size, max_error=20):
+    """Returns boolean array that is True where camera data is within arena_size extended by max_error.
+
+    cameraPos - numpy array with (x1,y1,x2,y2) along last dimension, e.g. shape (n_cameras, 4)
+                or (n_timepoints, n_cameras, 4)
+    """
+    x_too_big = cameraPos[..., 0] > arena_size[0] + max_error
+    y_too_big = cameraPos[..., 1] > arena_size[1] + max_error
+    x_too_small = cameraPos[..., 0] < -max_error
+    y_too_small = cameraPos[..., 1] < -max_error
+
+    return np.logical_not(x_too_big | y_too_big | x_too_small | y_too_small)
+
+
+def combine_camera_data_closest_to_last_position(cameraPos, camera_locations, lastCombPos, camera_transfer_radius):
+    """Returns position data from the camera closest to target among cameras that detect target
+    within camera_transfer_radius of lastCombPos, or None if no camera does.
+
+    cameraPos - numpy array with shape (n_cameras, 4) - (x1,y1,x2,y2) for each camera
+    camera_locations - numpy array with shape (n_cameras, 2)
+    lastCombPos - last known combined position (x1,y1,x2,y2)
+    """
+    # Check which cameras provide data close enough to lastCombPos
+    lastCombPos_distances = np.sqrt(np.sum((np.float64(cameraPos[:, :2]) - np.float64(lastCombPos[:2])) ** 2, axis=1))
+    RPi_correct = lastCombPos_distances < camera_transfer_radius
+    # If none were found to be withing search radius, set output to None
+    if not np.any(RPi_correct):
+        return None
+    elif np.sum(RPi_correct) == 1:
+        # If target only detected close enough to lastCombPos in a single camera, use it as output
+        return cameraPos[np.where(RPi_correct)[0][0], :]
+    else:
+        # Use the reading from closest camera to target mean location that detects correct location
+        cameraPos = cameraPos[RPi_correct, :]
+        camera_locations = camera_locations[RPi_correct, :]
+        meanPos = np.mean(cameraPos[:, :2], axis=0)
+        # Find closest distance camera to mean position and output its location coordinates
+        cam_distances = np.sqrt(np.sum((np.float64(camera_locations) - np.float64(meanPos)) ** 2, axis=1))
+        return cameraPos[np.argmin(cam_distances), :]
+
+
+def combine_camera_data_without_last_position(cameraPos, idx_inside, camera_transfer_radius):
+    """Returns position verified by at least two cameras for each timepoint, without using previous positions.
+
+    The position is the mean of the two cameras with best matching detected locations,
+    if their separation is smaller than half of camera_transfer_radius. Second LED values are NaN.
+
+    cameraPos - numpy array with shape (n_timepoints, n_cameras, 4) - (x1,y1,x2,y2) for each camera
+    idx_inside - boolean array with shape (n_timepoints, n_cameras) - False for camera data to ignore
+
+    Returns:
+        combPos - numpy array with shape (n_timepoints, 4)
+        verified - boolean array with shape (n_timepoints,), False where position could not be verified
+
+    NOTE! This solution breaks down if more than two cameras incorrectly identify the same object
+          as the brightes spot, instead of the target LED.
+    """
+    n_timepoints, n_cameras = cameraPos.shape[:2]
+    combPos = np.full((n_timepoints, 4), np.nan, dtype=np.float64)
+    cameraPairs = np.array(list(combinations(range(n_cameras), 2)), dtype=np.int64).reshape((-1, 2))
+    if cameraPairs.shape[0] == 0:
+        return combPos, np.zeros(n_timepoints, dtype=bool)
+    # Compute distances between cameras in each pair, ignoring pairs with any camera data to be ignored
+    pair_deltas = np.float64(cameraPos[:, cameraPairs[:, 0], :2]) - np.float64(cameraPos[:, cameraPairs[:, 1], :2])
+    pairDistances = np.sqrt(np.sum(pair_deltas ** 2, axis=2))
+    pairDistances[np.logical_not(idx_inside[:, cameraPairs[:, 0]] & idx_inside[:, cameraPairs[:, 1]])] = np.inf
+    verified = np.any(pairDistances < (camera_transfer_radius / 2.0), axis=1)
+    # Set output to mean of two cameras with best matching detected locations
+    camerasToUse = cameraPairs[np.argmin(pairDistances, axis=1), :]
+    timepoint_idx = np.arange(n_timepoints)[:, None]
+    combPos[:, :2] = np.mean(cameraPos[timepoint_idx, camerasToUse, :2], axis=1)
+    combPos[np.logical_not(verified), :] = np.nan
+
+    return combPos, verified
+
+
+def combine_multicamera_positions(cameraPos, camera_locations, arena_size, camera_transfer_radius,
+                                  batch_size=100000):
+    """Returns combined position for each timepoint of camera data, identical to calling
+    combineCamerasData at each timepoint with the output of the previous timepoint as lastCombPos.
+
+    The output at each timepoint is data of one of the cameras, the position verified by two cameras
+    (see combine_camera_data_without_last_position) or None, and only depends on which of these
+    was the output at the previous timepoint. The transitions between these states are computed for all
+    timepoints at once, and the state at each timepoint is found by composing the transitions of
+    all preceding timepoints in log2(n_timepoints) steps, without a loop over timepoints.
+    Distances are computed in float64.
+
+    cameraPos - numpy array with shape (n_timepoints, n_cameras, 4) - (x1,y1,x2,y2) for each camera
+    camera_locations - numpy array with shape (n_cameras, 2)
+    batch_size - int - number of timepoints for which transitions are computed at a time
+
+    Returns:
+        combPos - numpy array with shape (n_timepoints, 4), NaN where position was not found
+        idx_found - boolean array with shape (n_timepoints,), False where position was not found
+    """
+    n_timepoints, n_cameras = cameraPos.shape[:2]
+    # States are the index of camera used, verified position (n_cameras) or no position (n_cameras + 1)
+    state_verified = n_cameras
+    state_none = n_cameras + 1
+    # Only work with camera data from inside the enviornment
+    idx_inside = find_camera_data_inside_arena(cameraPos, arena_size)
+    verifiedPos, verified = combine_camera_data_without_last_position(cameraPos, idx_inside,
+                                                                      camera_transfer_radius)
+    # Positions of each state except no position at each timepoint
+    statePos = np.concatenate((np.float64(cameraPos), verifiedPos[:, None, :]), axis=1)
+    # Without previous position, position must be verified by two cameras
+    from_none = np.where(np.any(idx_inside, axis=1) & verified, state_verified, state_none)
+    transitions = np.repeat(from_none[:, None], n_cameras + 2, axis=1)
+    # Transitions from previous positions are computed in batches of timepoints to limit memory use
+    for first in range(1, n_timepoints, batch_size):
+        last = min(first + batch_size, n_timepoints)
+        # Previous positions are used if not all zeros (as with np.any(lastCombPos) in combineCamerasData)
+        lastCombPos = statePos[first - 1:last - 1, :, :]
+        lastCombPos_available = np.any(lastCombPos != 0, axis=2)
+        # Check which cameras provide data close enough to previous position of each state
+        currPos = np.float64(cameraPos[first:last, None, :, :2])
+        lastCombPos_distances = np.sqrt(np.sum((currPos - lastCombPos[:, :, None, :2]) ** 2, axis=3))
+        RPi_correct = (lastCombPos_distances < camera_transfer_radius) & idx_inside[first:last, None, :]
+        n_correct = np.sum(RPi_correct, axis=2)
+        # Use the reading from closest camera to target mean location that detects correct location
+        meanPos = np.sum(np.where(RPi_correct[:, :, :, None], cameraPos[first:last, None, :, :2], np.float32(0)),
+                         axis=2)
+        meanPos = (meanPos / np.maximum(n_correct, 1)[:, :, None]).astype(np.float32)
+        cam_distances = np.sqrt(np.sum((np.float64(camera_locations)[None, None, :, :]
+                                        - np.float64(meanPos)[:, :, None, :]) ** 2, axis=3))
+        cam_distances[np.logical_not(RPi_correct)] = np.inf
+        closest_camera = np.argmin(cam_distances, axis=2)
+        from_previous = np.where(n_correct > 0, closest_camera, state_none)
+        transitions[first:last, :state_none] = np.where(lastCombPos_available, from_previous,
+                                                        from_none[first:last, None])
+    # Compose transitions of preceding timepoints, so that prefix[t, k] is the state at t if state was k before 0
+    prefix = transitions
+    offset = 1
+    while offset < n_timepoints:
+        prefix = np.concatenate((prefix[:offset], np.take_along_axis(prefix[offset:], prefix[:-offset], axis=1)))
+        offset *= 2
+    states = prefix[:, state_none]
+    idx_found = states != state_none
+    combPos = np.full((n_timepoints, 4), np.nan, dtype=np.float64)
+    combPos[idx_found, :] = statePos[np.where(idx_found)[0], states[idx_found], :]
+
+    return combPos, idx_found
 
 
 def combineCamerasData(cameraPos, lastCombPos, cameraIDs, CameraSettings, arena_size):
@@ -32,83 +186,51 @@ def combineCamerasData(cameraPos, lastCombPos, cameraIDs, CameraSettings, arena_
     #   If successful, closest mean coordinate is set as output
     #   If unsuccessful, output is None
 
-    N_RPis = len(cameraPos)
     cameraPos = np.array(cameraPos, dtype=np.float32)
-    camera_locations = []
-    for cameraID in cameraIDs:
-        camera_locations.append(CameraSettings['CameraSpecific'][cameraID]['location_xy'])
-    camera_locations = np.array(camera_locations, dtype=np.float32)
+    camera_locations = get_camera_locations(cameraIDs, CameraSettings)
+    camera_transfer_radius = CameraSettings['General']['camera_transfer_radius']
 
     # Only work with camera data from inside the enviornment
-    # Find bad pos data lines
-    idxBad = np.zeros(cameraPos.shape[0], dtype=bool)
-    # Points beyond arena size
-    x_too_big = cameraPos[:,0] > arena_size[0] + 20
-    y_too_big = cameraPos[:,1] > arena_size[1] + 20
-    idxBad = np.logical_or(idxBad, np.logical_or(x_too_big, y_too_big))
-    x_too_small = cameraPos[:,0] < -20
-    y_too_small = cameraPos[:,1] < -20
-    idxBad = np.logical_or(idxBad, np.logical_or(x_too_small, y_too_small))
-    # Only keep camera data from within the environment
-    N_RPis = np.sum(np.logical_not(idxBad))
+    idx_inside = find_camera_data_inside_arena(cameraPos, arena_size)
     # Only continue if at least one RPi data remains
-    if N_RPis > 0:
-        cameraPos = cameraPos[np.logical_not(idxBad),:]
-        camera_locations = camera_locations[np.logical_not(idxBad),:]
-        if np.any(lastCombPos):
-            # Check which cameras provide data close enough to lastCombPos
-            RPi_correct = []
-            for nRPi in range(N_RPis):
-                lastCombPos_distance = euclidean(cameraPos[nRPi, :2], lastCombPos[:2])
-                RPi_correct.append(lastCombPos_distance < CameraSettings['General']['camera_transfer_radius'])
-            RPi_correct = np.array(RPi_correct, dtype=bool)
-            # If none were found to be withing search radius, set output to None
-            if not np.any(RPi_correct):
-                combPos = None
-            else:
-                # Use the reading from closest camera to target mean location that detects correct location
-                if np.sum(RPi_correct) > 1:
-                    # Only use correct cameras
-                    N_RPis = np.sum(RPi_correct)
-                    cameraPos = cameraPos[RPi_correct, :]
-                    camera_locations = camera_locations[RPi_correct, :]
-                    meanPos = np.mean(cameraPos[:, :2], axis=0)
-                    # Find mean position distance from all cameras
-                    cam_distances = []
-                    for nRPi in range(N_RPis):
-                        camera_loc = camera_locations[nRPi, :]
-                        cam_distances.append(euclidean(camera_loc, meanPos))
-                    # Find closest distance camera and output its location coordinates
-                    closest_camera = np.argmin(np.array(cam_distances))
-                    combPos = cameraPos[closest_camera, :]
-                else:
-                    # If target only detected close enough to lastCombPos in a single camera, use it as output
-                    combPos = cameraPos[np.where(RPi_correct)[0][0], :]
-        else:
-            # If no lastCombPos provided, check if position can be verified from more than one camera
-            #### NOTE! This solution breaks down if more than two cameras incorrectly identify the same object
-            ####       as the brightes spot, instead of the target LED.
-            cameraPairs = []
-            pairDistances = []
-            for c in combinations(range(N_RPis), 2):
-                pairDistances.append(euclidean(cameraPos[c[0], :2], cameraPos[c[1], :2]))
-                cameraPairs.append(np.array(c))
-            cameraPairs = np.array(cameraPairs)
-            cameraPairs_Match = np.array(pairDistances) < (CameraSettings['General']['camera_transfer_radius'] / 2.0)
-            # If position can not be verified from multiple cameras, set output to none
-            if not np.any(cameraPairs_Match):
-                combPos = None
-            else:
-                # Otherwise, set output to mean of two cameras with best matching detected locations
-                pairToUse = np.argmin(pairDistances)
-                camerasToUse = np.array(cameraPairs[pairToUse, :])
-                combPos = np.mean(cameraPos[camerasToUse, :2], axis=0)
-                # Add NaN values for second LED
-                combPos = np.append(combPos, np.empty(2) * np.nan)
+    if not np.any(idx_inside):
+        return None
+    if np.any(lastCombPos):
+        return combine_camera_data_closest_to_last_position(cameraPos[idx_inside, :],
+                                                            camera_locations[idx_inside, :],
+                                                            lastCombPos, camera_transfer_radius)
     else:
-        combPos = None
+        # If no lastCombPos provided, check if position can be verified from more than one camera
+        combPos, verified = combine_camera_data_without_last_position(cameraPos[None, :, :],
+                                                                      idx_inside[None, :],
+                                                                      camera_transfer_radius)
+        return combPos[0, :] if verified[0] else None
+
+
+def find_closest_timestamp_indices(timepoints, timestamps):
+    """Returns the index of the closest value in timestamps for each value in timepoints.
+
+    The output is the same as np.argmin(np.abs(timepoint - timestamps)) for each timepoint,
+    including returning the first of equally close values, if timestamps are in ascending order,
+    but all timepoints are matched at once using numpy.searchsorted.
+
+    :param numpy.ndarray timepoints: shape (N,)
+    :param numpy.ndarray timestamps: shape (M,)
+    :return: closest_indices
+    :rtype: numpy.ndarray
+    """
+    if timestamps.size == 1:
+        return np.zeros(timepoints.shape, dtype=np.int64)
+    sorted_idx = np.argsort(timestamps, kind='stable')
+    sorted_timestamps = timestamps[sorted_idx]
+    idx_hi = np.clip(np.searchsorted(sorted_timestamps, timepoints, side='left'), 1, sorted_timestamps.size - 1)
+    idx_lo = idx_hi - 1
+    use_lo = np.abs(timepoints - sorted_timestamps[idx_lo]) <= np.abs(timepoints - sorted_timestamps[idx_hi])
+    closest = np.where(use_lo, idx_lo, idx_hi)
+    # If the closest value is repeated, use its first occurrence
+    closest = np.searchsorted(sorted_timestamps, sorted_timestamps[closest], side='left')
 
-    return combPos
+    return sorted_idx[closest]
 
 
 def remove_tracking_data_outside_boundaries(posdata, arena_size, max_error=20):
@@ -186,6 +308,8 @@ def iteratively_combine_multicamera_data_for_recording(
     if len(posdatas) > 1:
         # If data from multiple cameras available, combine it
         PosDataFramesPerSecond = 30.0
+        camera_locations = get_camera_locations(cameraIDs, CameraSettings)
+        camera_transfer_radius = CameraSettings['General']['camera_transfer_radius']
         # Find first and last timepoint for position data
         first_timepoints = []
         last_timepoints = []
@@ -195,31 +319,19 @@ def iteratively_combine_multicamera_data_for_recording(
         # Combine position data step-wise from first to last timepoint at PosDataFramesPerSecond
         # At each timepoint the closest matchin datapoints will be taken from different cameras
         timepoints = np.arange(np.array(first_timepoints).min(), np.array(last_timepoints).max(), 1.0 / PosDataFramesPerSecond)
-        combPosData = [None]
-        listNaNs = []
+        # Find closest matching datapoint from all RPis for all timepoints
+        cameraPos = np.stack([posdata[find_closest_timestamp_indices(timepoints, posdata[:, 0]), 1:5]
+                              for posdata in posdatas], axis=1).astype(np.float32)
         if verbose:
-            print('Combining iteratively camera data for each position timepoint')
-        for npoint in (tqdm(range(len(timepoints))) if verbose else range(len(timepoints))):
-            # Find closest matchin timepoint from all RPis
-            idx_tp = np.zeros(4, dtype=np.int32)
-            for nRPi in range(len(posdatas)):
-                idx_tp[nRPi] = np.argmin(np.abs(timepoints[npoint] - posdatas[nRPi][:,0]))
-            # Convert posdatas for use in combineCamerasData function
-            cameraPos = []
-            for nRPi in range(len(posdatas)):
-                cameraPos.append(posdatas[nRPi][idx_tp[nRPi], 1:5])
-            tmp_comb_data = combineCamerasData(cameraPos, combPosData[-1], cameraIDs, CameraSettings, arena_size)
-            combPosData.append(tmp_comb_data)
-            if tmp_comb_data is None:
-                listNaNs.append(npoint)
-        # Remove the extra element from combPosData
-        del combPosData[0]
-        # Remove all None elements
-        for nanElement in listNaNs[::-1]:
-            del combPosData[nanElement]
-        timepoints = np.delete(timepoints, listNaNs)
+            print('Combining camera data for all position timepoints')
+        combPosData, idx_found = combine_multicamera_positions(cameraPos, camera_locations, arena_size,
+                                                               camera_transfer_radius)
+        # Remove all timepoints where position was not found
+        listNaNs = np.where(np.logical_not(idx_found))[0]
+        timepoints = timepoints[idx_found]
+        combPosData = combPosData[idx_found, :]
         # Combine timepoints and position data
-        ProcessedPos = np.concatenate((np.expand_dims(np.array(timepoints), axis=1), np.array(combPosData)), axis=1)
+        ProcessedPos = np.concatenate((np.expand_dims(np.array(timepoints), axis=1), combPosData), axis=1)
         # Print info about None elements
         if len(listNaNs) > 0:
             print('Total of ' + str(len(listNaNs) * (1.0 / PosDataFramesPerSecond)) + ' seconds of position data was lost')
@@ -4,16 +4,16 @@ ops.verbose             = 1; % whether to print command line progress
 ops.showfigures         = 0; % whether to plot figures during optimization		
 		
 ops.datatype            = 'dat';  % binary ('dat', 'bin') or 'openEphys'		
-ops.fbinary             = fullfile(pname, 'experiment_1.dat'); % will be created for 'openEphys'		
+ops.fbinary             = fbinary; % will be created for 'openEphys'		
 ops.fproc               = fullfile(pname, 'temp_wh.dat'); % residual from RAM of preprocessed data		
 ops.root                = pname; % 'openEphys' only: where raw files are		
 		
 ops.fs                  = 30000;        % sampling rate		(omit if already in chanMap file)
 ops.NchanTOT            = nchannels;           % total number of channels (omit if already in chanMap file)
-ops.Nchan               = nchannels;           % number of active channels (omit if already in chanMap file)
+ops.Nchan               = numel(channels);     % number of active channels (omit if already in chanMap file)
 ops.Nfilt               = num_clusters;           % number of clusters to use (2-4 times more than Nchan, should be a multiple of 32)     		
-ops.nNeighPC            = nchannels; % visualization only (Phy): number of channnels to mask the PCs, leave empty to skip (12)		
-ops.nNeigh              = nchannels; % visualization only (Phy): number of neighboring templates to retain projections of (16)		
+ops.nNeighPC            = numel(channels); % visualization only (Phy): number of channnels to mask the PCs, leave empty to skip (12)		
+ops.nNeigh              = numel(channels); % visualization only (Phy): number of neighboring templates to retain projections of (16)		
 		
 % options for channel whitening		
 ops.whitening           = 'full'; % type of whitening (default 'full', for 'noSpikes' set options for spike detection below)		
@@ -21,7 +21,7 @@ ops.nSkipCov            = 1; % compute whitening matrix from every N-th batch (1
 ops.whiteningRange      = Inf; % how many channels to whiten together (Inf for whole probe whitening, should be fine if Nchan<=32)		
 		
 % define the channel map as a filename (string) or simply an array	
-filename = createChannelMap(nchannels);
+filename = createChannelMap(channels);
 ops.chanMap             = fullfile(filename); % make this file using createChannelMapFile.m		
 ops.criterionNoiseChannels = 0.2; % fraction of "noise" templates allowed to span all channel groups (see createChannelMapFile for more info). 		
 % ops.chanMap = 1:ops.Nchan; % treated13962300.0 as linear probe if a chanMap file		
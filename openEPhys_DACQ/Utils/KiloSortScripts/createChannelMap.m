@@ -1,9 +1,11 @@
-function filename = createChannelMap(nchannels)
+function filename = createChannelMap(channels)
+% channels - rows in binary file (starting from 1) of channels to sort
+nchannels = numel(channels);
 % Load 64 channels sample
 load('chanMap64.mat')
 % Change channel map
-chanMap = chanMap(1:nchannels);
-chanMap0ind = chanMap0ind(1:nchannels);
+chanMap = reshape(double(channels), size(chanMap(1:nchannels)));
+chanMap0ind = chanMap - 1;
 connected = connected(1:nchannels);
 kcoords = kcoords(1:nchannels);
 xcoords = xcoords(1:nchannels);
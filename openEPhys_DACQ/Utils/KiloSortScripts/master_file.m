@@ -1,10 +1,20 @@
-function [ varargout ] = master_file (nchannels, pname, num_clusters)
+function [ varargout ] = master_file (nchannels, pname, num_clusters, fbinary, channels)
+% nchannels - total number of channels in binary file
+% pname     - folder for output and temporary files
+% fbinary   - binary file, default is experiment_1.dat in pname
+% channels  - channels (rows in binary file starting from 1) to sort, default is all channels
 
-if nargin == 2
+if nargin < 3
     num_clusters = 32;
 else
     num_clusters = round(ceil(num_clusters / 32) * 32);
 end
+if nargin < 4
+    fbinary = fullfile(pname, 'experiment_1.dat');
+end
+if nargin < 5
+    channels = 1:nchannels;
+end
 
 originalChannels = 4;
 % default options are in parenthesis after the comment
@@ -4,6 +4,9 @@ from time import sleep, time
 import traceback
 import socket
 import pickle
+import json
+import struct
+import numpy as np
 
 
 def get_localhost_ip():
@@ -152,6 +155,53 @@ def encode_pickled_message(data):
     return pickle.dumps(data)
 
 
+# Fixed layout of position messages published by OnlineTracker:
+# timestamp (float64), xcoord and ycoord of first and second LED, luminance of first and second LED (float32)
+POSITION_MESSAGE_STRUCT = struct.Struct('<d6f')
+POSITION_MESSAGE_DTYPE = np.dtype([('timestamp', '<f8'), ('linedata', '<f4', (6,))])
+
+
+def encode_position_message(linedata, timestamp=None):
+    """
+    Returns linedata as binary position message of POSITION_MESSAGE_STRUCT layout.
+
+    linedata - list - 6 values as output by OnlineTracker, None values are encoded as NaN
+    timestamp - float - time of the sample. If None (default), current time is used.
+    """
+    if timestamp is None:
+        timestamp = time()
+    return POSITION_MESSAGE_STRUCT.pack(timestamp, *[float('nan') if x is None else x for x in linedata])
+
+
+def decode_position_messages(messages, out=None):
+    """
+    Returns a numpy array of POSITION_MESSAGE_DTYPE with one element for each message.
+
+    messages - list of bytes - messages created with encode_position_message
+    out - numpy array of POSITION_MESSAGE_DTYPE - if provided, messages are decoded into
+          first elements of this array and a view of these elements is returned.
+
+    Messages that are not of POSITION_MESSAGE_STRUCT size, such as truncated messages
+    or messages in JSON format, are skipped with a printed warning.
+    """
+    valid_messages = [message for message in messages if len(message) == POSITION_MESSAGE_STRUCT.size]
+    if len(valid_messages) < len(messages):
+        print('Skipped {} position messages of incorrect size.'.format(len(messages) - len(valid_messages)))
+    data = np.frombuffer(b''.join(valid_messages), dtype=POSITION_MESSAGE_DTYPE)
+    if out is None:
+        return data
+    out[:data.size] = data
+    return out[:data.size]
+
+
+def encode_json_position_message(linedata):
+    return json.dumps(linedata).encode()
+
+
+def decode_json_position_message(message):
+    return json.loads(message.decode())
+
+
 class remote_controlled_object(paired_messenger):
     """
     When instantiated with an object this class executes any incoming commands on that object.
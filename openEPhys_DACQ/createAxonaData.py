@@ -23,25 +23,48 @@ def AxonaDataEEG_SamplingRate():
 def AxonaDataEGF_SamplingRate():
     return 4800
 
+def linear_interpolation_matrix(original_bins, target_bins):
+    '''
+    Returns a matrix of shape (original_bins.size, target_bins.size) that linearly
+    interpolates values sampled at original_bins to target_bins, when values are multiplied
+    with it along their last dimension, as with scipy.interpolate.interp1d.
+    All target_bins must be within the range of original_bins.
+    '''
+    # Find the original bins on each side of each target bin
+    idx_hi = np.clip(np.searchsorted(original_bins, target_bins, side='left'), 1, original_bins.size - 1)
+    idx_lo = idx_hi - 1
+    # Compute weight of value at the higher bin for each target bin
+    weight_hi = (target_bins - original_bins[idx_lo]) / (original_bins[idx_hi] - original_bins[idx_lo])
+    matrix = np.zeros((original_bins.size, target_bins.size), dtype=np.float32)
+    target_idx = np.arange(target_bins.size)
+    matrix[idx_lo, target_idx] = 1 - weight_hi
+    matrix[idx_hi, target_idx] += weight_hi
+
+    return matrix
+
 def interpolate_waveforms(waves, input_sampling_frequency=30000, 
                           output_sampling_frequency=48000, output_timestemps=50):
     '''
     Resamples waves to output_sampling_frequency.
     Input waves must have enough timesteps to cover output_timesteps.
+
+    waves - numpy array with timesteps along the last dimension, for example
+            shape (n_waves, n_timesteps) or (n_spikes, n_channels, n_timesteps).
+            All waves are resampled in a single matrix multiplication.
+
+    Returns int8 array with the same shape as waves, except output_timestemps along the last dimension.
     '''
     input_sample_step = 1000.0 / float(input_sampling_frequency)
-    original_bins = np.arange(0.0, input_sample_step * waves.shape[1], 
+    original_bins = np.arange(0.0, input_sample_step * waves.shape[-1], 
                               input_sample_step).astype(np.float32)
     output_sample_step = 1000.0 / float(output_sampling_frequency)
     target_bins = np.arange(0.0, output_sample_step * output_timestemps, 
                             output_sample_step).astype(np.float32)
     if target_bins[-1] > original_bins[-1]:
         raise ValueError('Input waves do not have enough samples to interpolate requested output.')
-    new_waves = np.zeros((waves.shape[0], output_timestemps), dtype=np.int8)
-    for nwave in range(waves.shape[0]):
-        # Interpolate each waveform
-        interfunct = interpolate.interp1d(original_bins, waves[nwave,:].astype(np.float32))
-        new_waves[nwave,:] = np.int8(np.round(interfunct(target_bins)))
+    interpolation_matrix = linear_interpolation_matrix(original_bins, target_bins)
+    new_waves = np.matmul(waves.astype(np.float32), interpolation_matrix)
+    new_waves = np.round(new_waves).astype(np.int8)
 
     return new_waves
 
@@ -95,12 +118,12 @@ def create_DACQ_waveform_data_for_single_tetrode(spike_data_tet, data_time_edges
     # Where channels are missing, add 0 values to waveform values
     if waves.shape[2] < 4:
         waves = np.concatenate((waves, np.zeros((waves.shape[0], waves.shape[1], 4 - waves.shape[2]))), axis=2)
+    # Interpolate waveforms of all spikes and channels to 48000 Hz resolution
+    waves = interpolate_waveforms(np.transpose(waves, (0, 2, 1)), input_sampling_frequency, 
+                                  output_sampling_frequency, output_timestemps)
     # Reshape 3D waveform matrix into 2D matrix such that waveforms for 
     # first spike from all four channels are on consecutive rows.
-    waves = np.reshape(np.ravel(np.transpose(waves, (0, 2, 1)), 'C'), (nspikes * 4, waves.shape[1]))
-    # Interpolate waveforms to 48000 Hz resolution
-    waves = interpolate_waveforms(waves, input_sampling_frequency, 
-                                  output_sampling_frequency, output_timestemps)
+    waves = np.reshape(waves, (nspikes * 4, waves.shape[2]))
     # Create DACQ datatype structured array
     waveform_data_dacq = np.zeros(nspikes * 4, dtype=dacq_waveform_dtype)
     # Input waveform values, leaving a trailing end of zeros due to lower sampling rate
@@ -276,12 +299,11 @@ def create_DACQ_eeg_or_egf_data(eeg_or_egf, data, data_time_edges, target_range=
         raise ValueError('Input data dtype is not numpy.float32.')
     lowpass_frequency = output_SamplingRate / 2.0
     # Filter data with lowpass butter filter
-    data_in_processing = []
-    for n_chan in range(data['data'].shape[1]):
-        data_in_processing.append(hfunct.butter_lowpass_filter(data['data'][:, n_chan].copy(), 
-                                                               sampling_rate=float(data['sampling_rate']), 
-                                                               lowpass_frequency=lowpass_frequency, 
-                                                               filt_order=4))
+    data_in_processing = hfunct.butter_lowpass_filter_multichannel(data['data'],
+                                                                   sampling_rate=float(data['sampling_rate']),
+                                                                   lowpass_frequency=lowpass_frequency,
+                                                                   filt_order=4, axis=0)
+    data_in_processing = [data_in_processing[:, n_chan] for n_chan in range(data_in_processing.shape[1])]
     # Crop data outside data_time_edges
     idx_outside_data_time = data['timestamps'] < data_time_edges[0]
     idx_outside_data_time = np.logical_or(idx_outside_data_time, data['timestamps'] > data_time_edges[1])
@@ -0,0 +1,113 @@
+"""
+Tests that spikes extracted by Processing.process_raw_data_with_kilosort from the binary file
+in chunks are identical to extracting them with Processing.ContinuousDataPreloader.get_channels
+and Processing.extract_spikes_from_tetrode from all data at once, using tests/stubs/kilosort_sorter
+in place of KiloSort.
+
+Run with: python -m pytest tests
+"""
+import os
+import subprocess
+import sys
+
+import h5py
+import numpy as np
+import pytest
+
+from openEPhys_DACQ import HelperFunctions as hfunct
+from openEPhys_DACQ import NWBio
+from openEPhys_DACQ import Processing
+
+KILOSORT_STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs', 'kilosort_sorter')
+
+BAD_CHANNEL = 3
+
+
+def create_nwb_file(filename, n_samples, n_channels=16, seed=0):
+    rng = np.random.RandomState(seed)
+    data = rng.normal(0, 30, (n_samples, n_channels))
+    for sample in rng.randint(0, n_samples - 50, n_samples // 300):
+        data[sample:sample + 10, rng.randint(n_channels)] -= np.hanning(10) * 600
+    path = '/acquisition/timeseries/recording1/continuous/processor102_100/'
+    with h5py.File(filename, 'w') as h5file:
+        h5file[path + 'data'] = data.astype(np.int16)
+        h5file[path + 'timestamps'] = np.arange(n_samples) / 30000.0 + 5.0
+        h5file['/general/data_collection/Settings/General/badChan'] = str(BAD_CHANNEL)
+
+
+@pytest.mark.parametrize('chunk_size', [7, 1000, 30000, 10 ** 6])
+def test_extract_spikes_at_indices_in_chunks(chunk_size):
+    rng = np.random.RandomState(0)
+    continuous = (rng.randn(4, 100000) * 200).astype(np.int16)
+    spike_indices = np.concatenate([rng.randint(0, 100000, 500), [0, 5, 6, 29999, 30000, 30005, 99965, 99966, 99999]])
+    filtered = continuous.copy()
+    filtered[:, :] = hfunct.butter_bandpass_filter_multichannel(continuous, sampling_rate=30000.0,
+                                                                highpass_frequency=300, lowpass_frequency=6000,
+                                                                filt_order=4, axis=1)
+    waveforms, indices, idx_keep = Processing.extract_spikes_from_tetrode(filtered, spike_indices)
+    chunked = Processing.extract_spikes_at_indices_in_chunks(continuous.T, spike_indices, chunk_size=chunk_size)
+    assert np.array_equal(chunked[0], waveforms)
+    assert np.array_equal(chunked[1], indices.reshape(-1))
+    assert np.array_equal(chunked[2], idx_keep)
+
+
+def test_process_raw_data_with_kilosort_matches_preloaded_extraction(tmp_path, monkeypatch):
+    filenames = [str(tmp_path / 'recording_a.nwb'), str(tmp_path / 'recording_b.nwb')]
+    for n_dataset, filename in enumerate(filenames):
+        create_nwb_file(filename, n_samples=30000 * (3 + n_dataset), seed=n_dataset)
+    pos_edges = [0, 1e9]
+    monkeypatch.setattr(NWBio, 'get_processed_tracking_data_timestamp_edges', lambda filename: pos_edges)
+    channels = list(range(16))
+    sorter = Processing.ProcessKiloSortBackend([sys.executable, KILOSORT_STUB], n_processes=2)
+    spike_datas = Processing.process_raw_data_with_kilosort(filenames, channels, threshold=5, noise_cut_off=1000,
+                                                            sorter=sorter, n_processes=2, chunk_duration=1.0)
+
+    datas_shape = [(len(channels), NWBio.load_raw_data_timestamps_as_array(filename).size)
+                   for filename in filenames]
+    binary_filename = str(tmp_path / 'binary.dat')
+    with open(binary_filename, 'wb') as f:
+        f.truncate(sum(data_shape[1] for data_shape in datas_shape) * len(channels) * 2)
+    preloaders = []
+    for filename in filenames:
+        preloader = Processing.ContinuousDataPreloader(filename, channels)
+        preloader.prepare_referencing('other_channels')
+        preloaders.append(preloader)
+    for n_tet, tetrode_nr in enumerate(hfunct.get_tetrode_nrs(channels)):
+        # Same spikes as found by the stub sorter in process_raw_data_with_kilosort
+        channel_map = [chan for chan in hfunct.tetrode_channels(tetrode_nr) if chan != BAD_CHANNEL]
+        output_folder = str(tmp_path / ('tetrode_' + str(tetrode_nr + 1)))
+        os.mkdir(output_folder)
+        subprocess.check_call([sys.executable, KILOSORT_STUB, binary_filename, str(len(channels)),
+                               ','.join(map(str, channel_map)), output_folder, '31'])
+        clusterIDs, spike_indices = Processing.load_KiloSort_output(output_folder)
+        datas_clusterIDs, datas_spike_indices = Processing.split_KiloSort_output(clusterIDs, spike_indices,
+                                                                                 datas_shape)
+        for n_dataset, preloader in enumerate(preloaders):
+            data_tet = preloader.get_channels(hfunct.tetrode_channels(tetrode_nr), referenced=True,
+                                              filter_freqs=[300, 6000], no_badChan=False)
+            waveforms, indices, idx_extracted = Processing.extract_spikes_from_tetrode(
+                data_tet, datas_spike_indices[n_dataset])
+            timestamps = preloader.timestamps[indices].squeeze()
+            idx_keep = Processing.filter_spike_data({'waveforms': np.int16(waveforms), 'timestamps': timestamps},
+                                                    pos_edges, 5, 1000, verbose=False)
+            spike_data_tet = spike_datas[n_dataset][n_tet]
+            assert spike_data_tet['waveforms'].shape[0] > 0
+            assert np.array_equal(spike_data_tet['waveforms'], waveforms)
+            assert np.array_equal(spike_data_tet['timestamps'], timestamps)
+            assert np.array_equal(spike_data_tet['idx_keep'], idx_keep)
+            assert np.array_equal(spike_data_tet['clusterIDs'], datas_clusterIDs[n_dataset][idx_extracted][idx_keep])
+
+
+def test_processing_with_kilosort_sorter_does_not_require_matlab(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'experiment_1.nwb')
+    create_nwb_file(filename, n_samples=30000 * 3)
+    monkeypatch.setattr(Processing, 'matlab_available', False)
+    monkeypatch.setattr(Processing, 'ensure_processed_position_data_is_available', lambda *args, **kwargs: None)
+    monkeypatch.setattr(NWBio, 'get_processed_tracking_data_timestamp_edges', lambda filename: [0, 1e9])
+    channel_map = {'area': {'list': list(range(8))}}
+    sorter = Processing.ProcessKiloSortBackend([sys.executable, KILOSORT_STUB])
+    Processing.processing(filename, processing_method='kilosort', channel_map=channel_map, make_AxonaData=False,
+                          kilosort_sorter=sorter)
+    spike_data = NWBio.load_spikes(filename, spike_name='spikes_kilosort', verbose=False)
+    assert [spike_data_tet['nr_tetrode'] for spike_data_tet in spike_data] == [0, 1]
+    assert all(spike_data_tet['clusterIDs'].size > 0 for spike_data_tet in spike_data)
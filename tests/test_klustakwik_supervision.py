@@ -0,0 +1,96 @@
+"""
+Tests supervision of KlustaKwik processes by KlustaKwikWrapper.Kluster.kluster
+and handling of failed tetrodes in Processing.Multiprocess_KlustaKwik,
+using tests/stubs/KlustaKwik in place of KlustaKwik.
+
+Run with: python -m pytest tests
+"""
+import os
+
+import numpy as np
+import pytest
+
+from openEPhys_DACQ import KlustaKwikWrapper
+from openEPhys_DACQ import Processing
+
+KLUSTAKWIK_STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs', 'KlustaKwik')
+
+
+def create_kluster(folder, n_spikes=200):
+    features = np.random.RandomState(0).randn(n_spikes, 13)
+    kluster = KlustaKwikWrapper.Kluster(os.path.join(str(folder), 'KK'), 0, features)
+    kluster.make_fet()
+    kluster.make_fmask(kluster.get_mask())
+
+    return kluster
+
+
+def read_stub_log(folder):
+    with open(os.path.join(str(folder), 'KK.stub_log')) as f:
+        return [line.split() for line in f.read().splitlines()]
+
+
+def test_kluster_writes_cut_file(tmp_path, monkeypatch):
+    monkeypatch.setenv('KLUSTAKWIK_STUB_MODE', 'ok')
+    kluster = create_kluster(tmp_path)
+    kluster.kluster(kk_path=KLUSTAKWIK_STUB)
+    assert len(kluster.attempts) == 1
+    assert kluster.attempts[0]['returncode'] == 0
+    assert kluster.attempts[0]['iteration'] == 2
+    assert kluster.attempts[0]['clusters'] == 29
+    clusterIDs = KlustaKwikWrapper.read_clu_file(str(tmp_path / 'KK.clu.0'))[1:]
+    assert clusterIDs.size == 200
+
+
+def test_kluster_timeout_kills_and_retries_with_halved_max_possible_clusters(tmp_path, monkeypatch):
+    monkeypatch.setenv('KLUSTAKWIK_STUB_MODE', 'hang_above_10')
+    kluster = create_kluster(tmp_path)
+    kluster.kluster(max_possible_clusters=31, timeout=1.0, kk_path=KLUSTAKWIK_STUB)
+    assert [attempt['max_possible_clusters'] for attempt in kluster.attempts] == [31, 15, 7]
+    assert [attempt['timed_out'] for attempt in kluster.attempts] == [True, True, False]
+    # Killed processes report progress up to the time they were stopped
+    assert kluster.attempts[0]['returncode'] != 0
+    assert kluster.attempts[0]['iteration'] == 2
+    assert [int(value) for _, value in read_stub_log(tmp_path)] == [31, 15, 7]
+    assert os.path.isfile(str(tmp_path / 'KK.clu.0'))
+
+
+def test_kluster_does_not_retry_below_min_clusters(tmp_path, monkeypatch):
+    monkeypatch.setenv('KLUSTAKWIK_STUB_MODE', 'hang_above_1')
+    kluster = create_kluster(tmp_path)
+    with pytest.raises(RuntimeError, match='timed out'):
+        kluster.kluster(max_possible_clusters=12, timeout=0.5, max_attempts=3, kk_path=KLUSTAKWIK_STUB)
+    assert [attempt['max_possible_clusters'] for attempt in kluster.attempts] == \
+        [12, 6, KlustaKwikWrapper.KLUSTAKWIK_MIN_CLUSTERS]
+
+
+def test_kluster_raises_runtime_error_on_nonzero_exit(tmp_path, monkeypatch):
+    monkeypatch.setenv('KLUSTAKWIK_STUB_MODE', 'fail')
+    kluster = create_kluster(tmp_path)
+    with pytest.raises(RuntimeError, match='exit code 3'):
+        kluster.kluster(max_possible_clusters=31, max_attempts=2, kk_path=KLUSTAKWIK_STUB)
+    assert [attempt['returncode'] for attempt in kluster.attempts] == [3, 3]
+    assert [attempt['max_possible_clusters'] for attempt in kluster.attempts] == [31, 15]
+    assert not os.path.isfile(str(tmp_path / 'KK.clu.0'))
+
+
+def fail_on_second_tetrode(spike_data_tet, **kwargs):
+    if spike_data_tet['nr_tetrode'] == 1:
+        raise RuntimeError('KlustaKwik failed')
+    clusterIDs = np.full(spike_data_tet['idx_keep'].size, spike_data_tet['nr_tetrode'])
+
+    return clusterIDs, {'start': 0.0, 'end': 1.0, 'n_spikes': clusterIDs.size}, None
+
+
+def test_multiprocess_klustakwik_keeps_results_of_other_tetrodes(monkeypatch):
+    # Worker processes are forked and use the replaced function
+    monkeypatch.setattr(Processing, 'applyKlustaKwik_on_spike_data_tet_with_timing', fail_on_second_tetrode)
+    mp_KlustaKwik = Processing.Multiprocess_KlustaKwik(memory_available_percent=0.0, pin_cpu_cores=False)
+    for nr_tetrode in range(3):
+        mp_KlustaKwik.add({'nr_tetrode': nr_tetrode, 'idx_keep': np.ones(10, dtype=bool)})
+    all_clusterIDs = mp_KlustaKwik.get()
+    assert mp_KlustaKwik.get_failed() == [1]
+    assert all_clusterIDs[1] is None
+    assert np.all(all_clusterIDs[0] == 0) and np.all(all_clusterIDs[2] == 2)
+    assert mp_KlustaKwik.get_features() == [None, None, None]
+    assert [tetrode['nr_tetrode'] for tetrode in mp_KlustaKwik.timing_report()['tetrodes']] == [0, 2]
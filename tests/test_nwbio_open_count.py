@@ -0,0 +1,74 @@
+"""
+Tests that NWBio functions loading spikes of one or multiple tetrodes open the NWB file only once,
+as counted by NWBio.get_h5file_open_count.
+
+Run with: python -m pytest tests
+"""
+import h5py
+import numpy as np
+import pytest
+
+from openEPhys_DACQ import NWBio
+
+N_TETRODES = 4
+BAD_CHANNEL = 5
+
+
+def create_nwb_file(filename, n_spikes=100, seed=0):
+    rng = np.random.RandomState(seed)
+    path = '/acquisition/timeseries/recording1/continuous/processor102_100/'
+    with h5py.File(filename, 'w') as h5file:
+        h5file[path + 'data'] = np.zeros((3000, 4 * N_TETRODES), dtype=np.int16)
+        h5file[path + 'timestamps'] = np.arange(3000) / 30000.0
+        h5file['/general/data_collection/Settings/General/badChan'] = str(BAD_CHANNEL + 1)
+    for tetrode_nr in range(N_TETRODES):
+        waveforms = rng.randint(-500, 500, (n_spikes, 4, 40)).astype(np.int16)
+        timestamps = np.sort(rng.uniform(0, 10, n_spikes))
+        NWBio.save_spikes(filename, tetrode_nr, waveforms, timestamps)
+
+
+@pytest.fixture(scope='module')
+def nwb_filename(tmp_path_factory):
+    filename = str(tmp_path_factory.mktemp('spikes') / 'experiment_1.nwb')
+    create_nwb_file(filename)
+
+    return filename
+
+
+@pytest.mark.parametrize('kwargs', [{},
+                                    {'tetrode_nrs': [2]},
+                                    {'tetrode_nrs': [0, 1, 3], 'use_badChan': True},
+                                    {'use_badChan': True, 'concatenate': True},
+                                    {'no_waveforms': True, 'time_window': (2.0, 5.0)}])
+def test_load_spikes_opens_file_once(nwb_filename, kwargs):
+    open_count = NWBio.get_h5file_open_count()
+    spike_data = NWBio.load_spikes(nwb_filename, verbose=False, **kwargs)
+    assert NWBio.get_h5file_open_count() - open_count == 1
+    n_tetrodes = len(kwargs.get('tetrode_nrs', range(N_TETRODES)))
+    if kwargs.get('concatenate', False):
+        assert spike_data['offsets'].size == n_tetrodes + 1
+    else:
+        assert len(spike_data) == n_tetrodes
+
+
+def test_load_spikes_sets_bad_channel_to_zero(nwb_filename):
+    spike_data = NWBio.load_spikes(nwb_filename, tetrode_nrs=[1], use_badChan=True, verbose=False)
+    assert np.all(spike_data[0]['waveforms'][:, BAD_CHANNEL % 4, :] == 0)
+    assert np.any(spike_data[0]['waveforms'][:, (BAD_CHANNEL + 1) % 4, :] != 0)
+
+
+def test_count_spikes_opens_file_once(nwb_filename):
+    open_count = NWBio.get_h5file_open_count()
+    count = NWBio.count_spikes(nwb_filename, list(range(N_TETRODES)))
+    assert NWBio.get_h5file_open_count() - open_count == 1
+    assert count == [100] * N_TETRODES
+
+
+def test_session_opens_file_once_for_multiple_loaders(nwb_filename):
+    open_count = NWBio.get_h5file_open_count()
+    with NWBio.NWBFileSession() as session:
+        tetrode_nrs = NWBio.get_tetrode_nrs_if_spikes_available(nwb_filename, session=session)
+        NWBio.count_spikes(nwb_filename, tetrode_nrs, session=session)
+        NWBio.load_spikes(nwb_filename, tetrode_nrs=tetrode_nrs, use_badChan=True, verbose=False, session=session)
+        NWBio.load_spikes(nwb_filename, concatenate=True, verbose=False, session=session)
+    assert NWBio.get_h5file_open_count() - open_count == 1
@@ -0,0 +1,73 @@
+"""
+Tests that spikes detected and extracted from raw data in chunks with
+Processing.extract_spikes_from_raw_data_in_chunks are identical to detecting and extracting them
+from all data at once with Processing.ContinuousDataPreloader, as in klustakwik_raw processing before.
+
+Run with: python -m pytest tests
+"""
+import h5py
+import numpy as np
+import pytest
+
+from openEPhys_DACQ import HelperFunctions as hfunct
+from openEPhys_DACQ import Processing
+
+THRESHOLD = 50
+TOOCLOSE = 30
+
+
+def create_nwb_file(filename, n_samples, n_channels=8, bad_channel=2, seed=0):
+    rng = np.random.RandomState(seed)
+    data = rng.normal(0, 30, (n_samples, n_channels))
+    # Spikes at random positions and spanning the edges of chunks of 0.1 s and 1 s
+    spike_samples = np.concatenate([rng.randint(0, n_samples - 50, n_samples // 300),
+                                    np.arange(3000, n_samples, 3000) - 5,
+                                    np.arange(30000, n_samples, 30000) - 20])
+    for sample in spike_samples:
+        data[sample:sample + 10, rng.randint(n_channels)] -= np.hanning(10) * 600
+    path = '/acquisition/timeseries/recording1/continuous/processor102_100/'
+    with h5py.File(filename, 'w') as h5file:
+        h5file[path + 'data'] = data.astype(np.int16)
+        h5file[path + 'timestamps'] = np.arange(n_samples) / 30000.0 + 5.0
+        h5file['/general/data_collection/Settings/General/badChan'] = str(bad_channel)
+
+
+def extract_spikes_from_preloaded_data(filename, channels):
+    preloaded_data = Processing.ContinuousDataPreloader(filename, channels)
+    preloaded_data.prepare_referencing('other_channels')
+    spike_data = []
+    for tetrode_nr in hfunct.get_tetrode_nrs(channels):
+        data_tet = preloaded_data.get_channels(hfunct.tetrode_channels(tetrode_nr),
+                                               referenced=True, filter_freqs=[300, 6000])
+        spike_indices = Processing.detect_threshold_crossings_on_tetrode(data_tet, THRESHOLD, TOOCLOSE,
+                                                                         detection_method='negative')
+        waveforms, spike_indices, _ = Processing.extract_spikes_from_tetrode(data_tet, spike_indices,
+                                                                             waveform_length=[6, 34])
+        spike_data.append({'waveforms': np.int16(waveforms),
+                           'timestamps': np.float64(preloaded_data.timestamps[spike_indices].squeeze()),
+                           'nr_tetrode': tetrode_nr})
+    preloaded_data.close()
+
+    return spike_data
+
+
+@pytest.fixture(scope='module')
+def nwb_filename(tmp_path_factory):
+    filename = str(tmp_path_factory.mktemp('raw') / 'experiment_1.nwb')
+    create_nwb_file(filename, n_samples=30000 * 3 + 17)
+
+    return filename
+
+
+@pytest.mark.parametrize('chunk_duration', [0.001, 0.0015, 0.01, 0.1, 1.0, 10.0])
+def test_extract_spikes_from_raw_data_in_chunks_matches_whole_array(nwb_filename, chunk_duration):
+    channels = list(range(8))
+    expected = extract_spikes_from_preloaded_data(nwb_filename, channels)
+    spike_data = Processing.extract_spikes_from_raw_data_in_chunks(nwb_filename, channels, THRESHOLD, TOOCLOSE,
+                                                                   chunk_duration=chunk_duration)
+    assert len(spike_data) == len(expected)
+    for spike_data_tet, expected_tet in zip(spike_data, expected):
+        assert expected_tet['waveforms'].shape[0] > 100
+        assert spike_data_tet['nr_tetrode'] == expected_tet['nr_tetrode']
+        assert np.array_equal(spike_data_tet['waveforms'], expected_tet['waveforms'])
+        assert np.array_equal(spike_data_tet['timestamps'], expected_tet['timestamps'])
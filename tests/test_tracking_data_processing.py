@@ -0,0 +1,155 @@
+"""
+Tests that TrackingDataProcessing.iteratively_combine_multicamera_data_for_recording output is identical
+to the previous implementation, that called combineCamerasData at every timepoint in a loop.
+
+Run with: python -m pytest tests
+"""
+from itertools import combinations
+
+import numpy as np
+import pytest
+from scipy.spatial.distance import euclidean
+
+from openEPhys_DACQ import TrackingDataProcessing
+
+ARENA_SIZE = np.array([100.0, 80.0])
+
+
+def previous_combineCamerasData(cameraPos, lastCombPos, cameraIDs, CameraSettings, arena_size):
+    # combineCamerasData before vectorization
+    N_RPis = len(cameraPos)
+    cameraPos = np.array(cameraPos, dtype=np.float32)
+    camera_locations = []
+    for cameraID in cameraIDs:
+        camera_locations.append(CameraSettings['CameraSpecific'][cameraID]['location_xy'])
+    camera_locations = np.array(camera_locations, dtype=np.float32)
+    idxBad = np.zeros(cameraPos.shape[0], dtype=bool)
+    x_too_big = cameraPos[:,0] > arena_size[0] + 20
+    y_too_big = cameraPos[:,1] > arena_size[1] + 20
+    idxBad = np.logical_or(idxBad, np.logical_or(x_too_big, y_too_big))
+    x_too_small = cameraPos[:,0] < -20
+    y_too_small = cameraPos[:,1] < -20
+    idxBad = np.logical_or(idxBad, np.logical_or(x_too_small, y_too_small))
+    N_RPis = np.sum(np.logical_not(idxBad))
+    if N_RPis > 0:
+        cameraPos = cameraPos[np.logical_not(idxBad),:]
+        camera_locations = camera_locations[np.logical_not(idxBad),:]
+        if np.any(lastCombPos):
+            RPi_correct = []
+            for nRPi in range(N_RPis):
+                lastCombPos_distance = euclidean(cameraPos[nRPi, :2], lastCombPos[:2])
+                RPi_correct.append(lastCombPos_distance < CameraSettings['General']['camera_transfer_radius'])
+            RPi_correct = np.array(RPi_correct, dtype=bool)
+            if not np.any(RPi_correct):
+                combPos = None
+            else:
+                if np.sum(RPi_correct) > 1:
+                    N_RPis = np.sum(RPi_correct)
+                    cameraPos = cameraPos[RPi_correct, :]
+                    camera_locations = camera_locations[RPi_correct, :]
+                    meanPos = np.mean(cameraPos[:, :2], axis=0)
+                    cam_distances = []
+                    for nRPi in range(N_RPis):
+                        camera_loc = camera_locations[nRPi, :]
+                        cam_distances.append(euclidean(camera_loc, meanPos))
+                    closest_camera = np.argmin(np.array(cam_distances))
+                    combPos = cameraPos[closest_camera, :]
+                else:
+                    combPos = cameraPos[np.where(RPi_correct)[0][0], :]
+        else:
+            cameraPairs = []
+            pairDistances = []
+            for c in combinations(range(N_RPis), 2):
+                pairDistances.append(euclidean(cameraPos[c[0], :2], cameraPos[c[1], :2]))
+                cameraPairs.append(np.array(c))
+            cameraPairs = np.array(cameraPairs)
+            cameraPairs_Match = np.array(pairDistances) < (CameraSettings['General']['camera_transfer_radius'] / 2.0)
+            if not np.any(cameraPairs_Match):
+                combPos = None
+            else:
+                pairToUse = np.argmin(pairDistances)
+                camerasToUse = np.array(cameraPairs[pairToUse, :])
+                combPos = np.mean(cameraPos[camerasToUse, :2], axis=0)
+                combPos = np.append(combPos, np.empty(2) * np.nan)
+    else:
+        combPos = None
+
+    return combPos
+
+
+def previous_combine_multicamera_data(CameraSettings, arena_size, posdatas):
+    # Multiple camera branch of iteratively_combine_multicamera_data_for_recording before vectorization
+    cameraIDs = sorted(CameraSettings['CameraSpecific'].keys())
+    first_timepoints = [posdata[0, 0] for posdata in posdatas]
+    last_timepoints = [posdata[-1, 0] for posdata in posdatas]
+    timepoints = np.arange(np.array(first_timepoints).min(), np.array(last_timepoints).max(), 1.0 / 30.0)
+    combPosData = [None]
+    listNaNs = []
+    for npoint in range(len(timepoints)):
+        idx_tp = np.zeros(4, dtype=np.int32)
+        for nRPi in range(len(posdatas)):
+            idx_tp[nRPi] = np.argmin(np.abs(timepoints[npoint] - posdatas[nRPi][:,0]))
+        cameraPos = []
+        for nRPi in range(len(posdatas)):
+            cameraPos.append(posdatas[nRPi][idx_tp[nRPi], 1:5])
+        tmp_comb_data = previous_combineCamerasData(cameraPos, combPosData[-1], cameraIDs, CameraSettings,
+                                                    arena_size)
+        combPosData.append(tmp_comb_data)
+        if tmp_comb_data is None:
+            listNaNs.append(npoint)
+    del combPosData[0]
+    for nanElement in listNaNs[::-1]:
+        del combPosData[nanElement]
+    timepoints = np.delete(timepoints, listNaNs)
+    ProcessedPos = np.concatenate((np.expand_dims(np.array(timepoints), axis=1), np.array(combPosData)), axis=1)
+    ProcessedPos = TrackingDataProcessing.remove_tracking_data_outside_boundaries(ProcessedPos, arena_size,
+                                                                                   max_error=10)
+
+    return ProcessedPos.astype(np.float64)
+
+
+def create_camera_data(n_cameras, duration, seed):
+    rng = np.random.RandomState(seed)
+    camera_locations = [[0.0, 0.0], [100.0, 0.0], [0.0, 80.0], [100.0, 80.0]][:n_cameras]
+    CameraSettings = {'General': {'camera_transfer_radius': 15.0},
+                      'CameraSpecific': {str(n): {'location_xy': location}
+                                         for n, location in enumerate(camera_locations)}}
+    # Smooth trajectory of the animal through the arena
+    t = np.arange(0, duration + 1.0, 0.01)
+    trajectory = np.stack([50 + 40 * np.sin(t / 3.0) + 5 * np.sin(t * 1.7),
+                           40 + 30 * np.sin(t / 4.1 + 1.0) + 4 * np.cos(t * 2.3)], axis=1)
+    posdatas = []
+    for n in range(n_cameras):
+        # Cameras sample at about 30 Hz with jitter and different start and end times
+        timestamps = np.cumsum(rng.uniform(0.025, 0.042, int(duration * 30)))
+        timestamps = timestamps[timestamps < duration - 0.1] + rng.uniform(0, 0.5)
+        position = trajectory[np.searchsorted(t, timestamps)] + rng.normal(0, 1.5, (timestamps.size, 2))
+        posdata = np.full((timestamps.size, 5), np.nan)
+        posdata[:, 0] = timestamps
+        posdata[:, 1:3] = position
+        posdata[:, 3:5] = position + rng.normal(0, 3, (timestamps.size, 2))
+        # Reflections detected elsewhere in the arena, data outside arena, missing second LED and zero data.
+        # Missing first LED data is not included, as the previous implementation raised ValueError on it.
+        idx = rng.rand(timestamps.size)
+        posdata[idx < 0.08, 1:3] = rng.uniform(0, 100, (np.sum(idx < 0.08), 2))
+        posdata[(idx > 0.08) & (idx < 0.1), 1] = 150.0
+        posdata[(idx > 0.1) & (idx < 0.13), 3:5] = np.nan
+        posdata[(idx > 0.13) & (idx < 0.135), 1:5] = 0.0
+        # Epoch where all cameras report zeros, which is not used as previous position
+        posdata[(timestamps > 40) & (timestamps < 41), 1:5] = 0.0
+        # Epoch where camera does not see the animal
+        posdata[(timestamps > 20 + 5 * n) & (timestamps < 23 + 5 * n), 1] = -50.0
+        posdatas.append(posdata)
+
+    return CameraSettings, posdatas
+
+
+@pytest.mark.parametrize('n_cameras,seed', [(2, 0), (3, 1), (4, 2), (4, 3)])
+def test_combined_positions_equal_previous_implementation(n_cameras, seed):
+    CameraSettings, posdatas = create_camera_data(n_cameras, duration=60.0, seed=seed)
+    expected = previous_combine_multicamera_data(CameraSettings, ARENA_SIZE, [p.copy() for p in posdatas])
+    ProcessedPos = TrackingDataProcessing.iteratively_combine_multicamera_data_for_recording(
+        CameraSettings, ARENA_SIZE, [p.copy() for p in posdatas], None)
+    assert ProcessedPos.shape == expected.shape
+    assert ProcessedPos.shape[0] > 1000
+    np.testing.assert_array_equal(ProcessedPos, expected)